@@ -0,0 +1,5 @@
+from .backend import CompletionBackend, AnthropicBackend, MessageReplayStream
+from .replay import ReplayBackend, CacheMiss, get_request_key
+from .scripted import ScriptedBackend, tool_use
+
+__all__ = ['CompletionBackend', 'AnthropicBackend', 'MessageReplayStream', 'ReplayBackend', 'CacheMiss', 'get_request_key', 'ScriptedBackend', 'tool_use']
\ No newline at end of file
@@ -0,0 +1,68 @@
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, List
+
+import anthropic
+from anthropic.lib.streaming import TextEvent, ContentBlockStopEvent
+
+
+class CompletionBackend(ABC):
+    # what the gateway needs from a model. create returns an anthropic Message. stream returns an async context manager
+    # that iterates text and content_block_stop events and has get_final_message(), like client.messages.stream
+    @abstractmethod
+    async def create(self, **request) -> anthropic.types.Message:
+        ...
+
+    @abstractmethod
+    def stream(self, **request) -> Any:
+        ...
+
+
+class AnthropicBackend(CompletionBackend):
+    def __init__(self, client: anthropic.AsyncAnthropic):
+        self.client = client
+
+    async def create(self, **request) -> anthropic.types.Message:
+        return await self.client.messages.create(**request)
+
+    def stream(self, **request) -> Any:
+        return self.client.messages.stream(**request)
+
+
+class MessageReplayStream():
+    # streams a finished message back as the events the gateway reads, a word at a time
+    def __init__(self, message: anthropic.types.Message, first_delay: float = 0.0, chunk_delay: float = 0.0):
+        self.message = message
+        self.first_delay = first_delay
+        self.chunk_delay = chunk_delay
+
+    async def __aenter__(self) -> "MessageReplayStream":
+        await asyncio.sleep(self.first_delay)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        snapshot = ""
+        for i, block in enumerate(self.message.content):
+            if block.type == "text":
+                for word in get_chunks(block.text):
+                    await asyncio.sleep(self.chunk_delay)
+                    snapshot += word
+                    yield TextEvent(type="text", text=word, snapshot=snapshot)
+            yield ContentBlockStopEvent(type="content_block_stop", index=i, content_block=block)
+
+    async def get_final_message(self) -> anthropic.types.Message:
+        return self.message
+
+
+def get_chunks(text: str) -> List[str]:
+    # words with their trailing space, so the chunks join back into the text
+    chunks, start = [], 0
+    while start < len(text):
+        end = text.find(" ", start)
+        end = len(text) if end == -1 else end + 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
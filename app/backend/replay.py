@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import re
+from typing import Any, Optional
+
+import anthropic
+
+from .backend import CompletionBackend, MessageReplayStream
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+EVICT_TO = 0.9 # evicting down to a bit under the limit so every write past it doesn't rescan the directory
+
+
+# dates as the prompts write them, see app.prompts. they come from the clock and from when rows were written, so they differ
+# between runs of the same conversation
+VOLATILE_DATE = re.compile(r"(?:January|February|March|April|May|June|July|August|September|October|November|December)(?: \d{2},)? \d{4}(?: at \d{2}:\d{2} [AP]M PT)?")
+TURN_CONTEXT_MARKER = "approximate current time"
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+def strip_cache_control(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: strip_cache_control(v) for k, v in value.items() if k != "cache_control"}
+    if isinstance(value, list):
+        return [strip_cache_control(v) for v in value]
+    return value
+
+
+def mask_dates(value: Any) -> Any:
+    if isinstance(value, str):
+        return VOLATILE_DATE.sub("<date>", value)
+    if isinstance(value, dict):
+        return {k: mask_dates(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [mask_dates(v) for v in value]
+    return value
+
+
+def mask_turn_context(messages: Any) -> Any:
+    # the block with knowledge, recall and the current time that rides on the last user message, see ContextBuilder.build
+    if not isinstance(messages, list):
+        return messages
+    return [{**m, "content": [mask_dates(b) if isinstance(b, dict) and TURN_CONTEXT_MARKER in str(b.get("text", "")) else b for b in m["content"]]} if isinstance(m, dict) and isinstance(m.get("content"), list) else m for m in messages]
+
+
+def get_request_key(request: dict) -> str:
+    # content address of what decides the response. cache breakpoints move between turns without changing the prompt,
+    # so they're left out, and so are the dates in the system prompt and the turn context, which depend on when it ran.
+    # what the user and the model said is kept as is
+    normalized = strip_cache_control({k: request.get(k) for k in ("model", "system", "tools", "messages")})
+    normalized["system"] = mask_dates(normalized["system"])
+    normalized["messages"] = mask_turn_context(normalized["messages"])
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+
+class ReplayBackend(CompletionBackend):
+    # record/replay cache in front of another backend. responses are stored one json file per request key under `directory`,
+    # sharded by the key's first two characters. with no backend it only replays, and a request it hasn't seen raises
+    # CacheMiss. once the files pass `max_bytes` the least recently used are deleted, hits refresh a file's mtime
+    def __init__(self, directory: str, backend: Optional[CompletionBackend] = None, max_bytes: int = DEFAULT_MAX_BYTES, chunk_delay: float = 0.0):
+        self.directory = directory
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.chunk_delay = chunk_delay
+        self.size: Optional[int] = None # bytes on disk, counted on first write
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def load(self, request: dict) -> Optional[anthropic.types.Message]:
+        path = self.get_path(get_request_key(request))
+        try:
+            with open(path) as f:
+                message = anthropic.types.Message.model_validate_json(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            if self.backend is None:
+                raise CacheMiss(path)
+            return None
+        os.utime(path)
+        self.hits += 1
+        return message
+
+    def save(self, request: dict, message: anthropic.types.Message):
+        path = self.get_path(get_request_key(request))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = message.model_dump_json()
+        with open(f"{path}.tmp", "w") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path) # readers never see half a file
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.get_files())
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def get_files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(root, name))
+                    yield os.path.join(root, name), stat.st_size, stat.st_mtime
+
+    def evict(self):
+        files = sorted(self.get_files(), key=lambda f: f[2])
+        self.size = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            os.remove(path)
+            self.size -= size
+
+    async def create(self, **request) -> anthropic.types.Message:
+        message = self.load(request)
+        if message is None:
+            message = await self.backend.create(**request)
+            self.save(request, message)
+        return message
+
+    def stream(self, **request) -> Any:
+        message = self.load(request)
+        if message is None:
+            return RecordingStream(self, request)
+        return MessageReplayStream(message, chunk_delay=self.chunk_delay)
+
+
+class RecordingStream():
+    # passes a live stream through and saves its final message once it finishes cleanly
+    def __init__(self, replay: ReplayBackend, request: dict):
+        self.replay = replay
+        self.request = request
+        self.manager = replay.backend.stream(**request)
+        self.stream = None
+
+    async def __aenter__(self) -> "RecordingStream":
+        self.stream = await self.manager.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        result = await self.manager.__aexit__(exc_type, exc_val, exc_tb)
+        if exc_type is None:
+            self.replay.save(self.request, await self.stream.get_final_message())
+        return result
+
+    def __aiter__(self):
+        return self.stream.__aiter__()
+
+    async def get_final_message(self) -> anthropic.types.Message:
+        return await self.stream.get_final_message()
@@ -0,0 +1,53 @@
+import asyncio
+import itertools
+import json
+import uuid
+from typing import Any, Callable, Dict, List, Sequence, Union
+
+import anthropic
+from anthropic.types import TextBlock, ToolUseBlock
+
+from app.model import estimate_tokens
+from .backend import CompletionBackend, MessageReplayStream
+
+
+Response = Union[str, List[Union[str, TextBlock, ToolUseBlock]]]
+
+
+def tool_use(name: str, input: Dict[str, Any] = {}) -> ToolUseBlock:
+    return ToolUseBlock(type="tool_use", id=f"toolu_{uuid.uuid4().hex[:24]}", name=name, input=input)
+
+
+def get_message(request: dict, response: Response) -> anthropic.types.Message:
+    content = [TextBlock(type="text", text=b) if isinstance(b, str) else b for b in ([response] if isinstance(response, str) else response)]
+    input_tokens = estimate_tokens(json.dumps([request.get("system"), request.get("tools"), request.get("messages")], default=str))
+    output_tokens = sum(estimate_tokens(b.text if b.type == "text" else json.dumps(b.input)) for b in content)
+    return anthropic.types.Message(
+        id=f"msg_{uuid.uuid4().hex[:24]}", type="message", role="assistant", model=request.get("model", "scripted"), content=content,
+        stop_reason="tool_use" if any(b.type == "tool_use" for b in content) else "end_turn", stop_sequence=None,
+        usage=anthropic.types.Usage(input_tokens=input_tokens, output_tokens=output_tokens),
+    )
+
+
+class ScriptedBackend(CompletionBackend):
+    # a fake model for offline runs. `script` is either a function from the request to a response, or responses to play in
+    # order and then repeat. a response is text or a list of text and content blocks, see tool_use. every call waits `latency`
+    # before its first output, streams wait `chunk_delay` per word after that
+    def __init__(self, script: Union[Callable[[dict], Response], Sequence[Response]], latency: float = 0.0, chunk_delay: float = 0.0):
+        self.respond = script if callable(script) else itertools.cycle(script).__next__
+        self.scripted = not callable(script)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.requests: List[dict] = []
+
+    def get_message(self, request: dict) -> anthropic.types.Message:
+        self.requests.append(request)
+        return get_message(request, self.respond() if self.scripted else self.respond(request))
+
+    async def create(self, **request) -> anthropic.types.Message:
+        message = self.get_message(request)
+        await asyncio.sleep(self.latency)
+        return message
+
+    def stream(self, **request) -> Any:
+        return MessageReplayStream(self.get_message(request), first_delay=self.latency, chunk_delay=self.chunk_delay)
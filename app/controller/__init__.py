@@ -1,3 +1,4 @@
 from .chat import ChatController
+from .session import ChatSession
 
-__all__ = ['ChatController']
\ No newline at end of file
+__all__ = ['ChatController', 'ChatSession']
\ No newline at end of file
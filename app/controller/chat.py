@@ -1,99 +1,140 @@
 import asyncio
+import threading
+from datetime import datetime
+from typing import Optional
 
 from rich.console import Console
+from rich.live import Live
 from rich.panel import Panel
+from rich.text import Text
 from rich.theme import Theme
 from rich.prompt import Prompt
+from rich.rule import Rule
 
-from app.model import Message, Contact, Role, MessageType, Fact
-from app.repository import Repository
+from app.model import AnyMessage, Contact, Role, MessageType
+from app.repository import Repository, MessageCursor
 from app.gateway import CompletionGateway, ActionType
+from app.worker import BackgroundWorker
 from app.constants import DEFAULT_TIMEZONE, UTC
+from .session import ChatSession
+
+
+HISTORY_COMMAND = "/history" # typed at the prompt to load the page of history before what's on screen
+CHAT_THEME = Theme({
+    "user": "green",
+    "assistant": "cornflower_blue",
+    "system": "yellow",
+    "timestamp": "dim",
+    "tool": "grey70",
+})
 
 
 class ChatController():
-    def __init__(self, repository: Repository, completion_gateway: CompletionGateway):
+    def __init__(self, repository: Repository, completion_gateway: CompletionGateway, worker: BackgroundWorker):
         self.repository = repository
         self.completion_gateway = completion_gateway
+        self.worker = worker
 
-    async def run_chat(self, contact: Contact):
-        console = Console(theme=Theme({
-            "user": "green",
-            "assistant": "cornflower_blue",
-            "system": "yellow",
-            "timestamp": "dim",
-            "tool": "grey70",
-        }))
-        console.clear()
-
-        conversation = await self.repository.get_conversation(contact.id)
-        if not conversation:
-            conversation = await self.repository.create_conversation(contact.id)
-        
-        messages = reversed(await self.repository.get_messages(contact.id)) 
-        for message in messages:
+    async def print_history(self, contact: Contact, console: Console, limit: int, before: Optional[MessageCursor] = None) -> Optional[MessageCursor]:
+        # prints one page of history ending at `before` and returns the cursor for the page before it, or None at the start
+        page = await self.repository.get_history_page(contact.id, before=before, limit=limit)
+        for message, summary in reversed(page):
             if message.message_type == MessageType.CHAT:
                 print_message(message, console)
             elif message.message_type == MessageType.TOOL_USE and message.role == Role.ASSISTANT:
                 if message.tool_use_name == ActionType.REMEMBER_FACT.value:
-                    console.print(Panel(f"{message.tool_use_input['fact']}", title="Fact", title_align="left",  border_style="tool", style="tool"))
+                    console.print(get_tool_panel("Fact", message.tool_use_input['fact']))
                 elif message.tool_use_name == ActionType.TOPIC_CHANGED.value:
-                    msg_conversation = await self.repository.get_conversation_for_message(message.id)
-                    console.print(Panel(f"{msg_conversation.summary}", title="Summary", title_align="left",  border_style="tool", style="tool"))
-        
-        if messages:
-            print()
+                    console.print(get_tool_panel("Summary", summary))
+
+        if len(page) < limit:
+            return None
+        return (page[-1][0].timestamp, page[-1][0].id)
+
+    async def run_chat(self, contact: Contact):
+        console = Console(theme=CHAT_THEME)
+        console.clear()
+
+        session = await ChatSession.open(self.repository, self.completion_gateway, self.worker, contact)
+        history_cursor = await self.print_history(contact, console, max(console.height // 3, 10))
+        print()
 
         while True:
-            user_input = Prompt.ask("[green]You[/green]")
+            session.prefetch() # while they type
+            user_input = await ask("[green]You[/green]")
             print("\033[2A\033[2K", end="")
 
-            message = await self.repository.create_message(Message(role=Role.USER, content=user_input, conversation_id=conversation.id, contact_id=contact.id))
-            print_message(message, console)
-            
-            has_text_response = False
-            has_follow_up_response = False
-            while not has_text_response or has_follow_up_response:
-                completion_task = asyncio.create_task(self.completion_gateway.complete(contact, conversation))
-                has_follow_up_response = False
-                
-                while not completion_task.done():
-                    for dots in range(0, 4):
-                        print("\033[90m" + "..."[0:dots] + "\033[0m", end="", flush=True)
-                        await asyncio.sleep(0.3)
-                        print("\r\033[K", end="")
-
-                responses = await completion_task
-                await self.repository.create_messages(responses)
-
-                for response in responses:
+            if user_input.strip() == HISTORY_COMMAND:
+                if history_cursor is None:
+                    console.print(Rule("no earlier messages", style="timestamp"))
+                else:
+                    console.print(Rule("earlier messages", style="timestamp"))
+                    history_cursor = await self.print_history(contact, console, max(console.height // 3, 10), before=history_cursor)
+                    console.print(Rule(style="timestamp"))
+                print()
+                continue
+
+            turn = session.turn(user_input)
+            print_notices(session, console)
+            print_message(await anext(turn), console)
+
+            text = ""
+            with Live(Text("...", style="timestamp"), console=console, transient=True, refresh_per_second=15) as live:
+                async for response in turn:
+                    if isinstance(response, str):
+                        text += response
+                        live.update(get_message_panel(Role.ASSISTANT, text, datetime.now(tz=UTC)))
+                        continue
+
                     if response.message_type == MessageType.CHAT:
-                        has_text_response = True
-                        print_message(response, console)
-
-                    elif response.message_type == MessageType.TOOL_USE:
-                        if response.tool_use_name == ActionType.REMEMBER_FACT.value:
-                            console.print(Panel(f"{response.tool_use_input['fact']}", title="Fact", title_align="left",  border_style="tool", style="tool"))
-                            await self.repository.create_fact(Fact(content=response.tool_use_input["fact"], contact_id=contact.id))
-                        elif response.tool_use_name == ActionType.TOPIC_CHANGED.value:
-                            prior_conversation = conversation # so that we don't include the message that triggered the tool use in the summary
-
-                            conversation = await self.repository.create_conversation(contact_id=contact.id)
-                            await self.repository.create_message(message)
-
-                            summary = await self.completion_gateway.summarize_conversation(prior_conversation)
-                            console.print(Panel(f"{summary}", title="Summary", title_align="left",  border_style="tool", style="tool"))
-                        elif response.tool_use_name == ActionType.REQUIRES_FOLLOW_UP.value:
-                            has_follow_up_response = True # prompt the model again without waiting for user response
-
-                        # create matching user response message for tool use response
-                        await self.repository.create_message(Message(role=Role.USER, message_type=MessageType.TOOL_USE, content=response.content, conversation_id=conversation.id, contact_id=contact.id, tool_use_id=response.tool_use_id, tool_use_name=response.tool_use_name, tool_use_input=response.tool_use_input))
-        
+                        text = ""
+                        live.update(Text("...", style="timestamp"))
+                        live.console.print(get_message_panel(response.role, response.content, response.timestamp))
+                    elif response.tool_use_name == ActionType.REMEMBER_FACT.value:
+                        live.console.print(get_tool_panel("Fact", response.tool_use_input['fact']))
+
+            print_notices(session, console)
             print()
 
 
-def print_message(message: Message, console: Console):
-    time_str = message.timestamp.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime("%I:%M:%S %p")
-    title = f"{'You' if message.role == Role.USER else 'Yui'} • [timestamp]{time_str}[/timestamp]"
-    style = message.role.lower()
-    console.print(Panel(message.content, title=title, style=style, title_align="left", border_style=style))
\ No newline at end of file
+async def ask(prompt: str) -> str:
+    # Prompt.ask blocks, so read input on a daemon thread and keep the event loop free for background jobs
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(fn, value):
+        if not future.done():
+            fn(value)
+
+    def read():
+        try:
+            result = Prompt.ask(prompt)
+            loop.call_soon_threadsafe(resolve, future.set_result, result)
+        except BaseException as e:
+            try:
+                loop.call_soon_threadsafe(resolve, future.set_exception, e)
+            except RuntimeError:
+                pass # the loop has already shut down
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+def print_notices(session: ChatSession, console: Console):
+    while session.notices:
+        console.print(get_tool_panel(*session.notices.pop(0)))
+
+
+def print_message(message: AnyMessage, console: Console):
+    console.print(get_message_panel(message.role, message.content, message.timestamp))
+
+
+def get_message_panel(role: Role, content: str, timestamp: datetime) -> Panel:
+    time_str = timestamp.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime("%I:%M:%S %p")
+    title = f"{'You' if role == Role.USER else 'Yui'} • [timestamp]{time_str}[/timestamp]"
+    style = role.lower()
+    return Panel(content, title=title, style=style, title_align="left", border_style=style)
+
+
+def get_tool_panel(title: str, content: str) -> Panel:
+    return Panel(f"{content}", title=title, title_align="left",  border_style="tool", style="tool")
\ No newline at end of file
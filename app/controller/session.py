@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import suppress
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+from app.model import Message, Contact, Conversation, Role, MessageType, Fact
+from app.repository import Repository
+from app.gateway import CompletionGateway, ActionType
+from app.knowledge import FactMemory
+from app.worker import BackgroundWorker
+from app.tracing import tracer
+
+
+class ChatSession():
+    # one contact's side of the chat, without any terminal or network io. turns must not overlap for a contact,
+    # the caller serializes them
+    def __init__(self, repository: Repository, completion_gateway: CompletionGateway, worker: BackgroundWorker, contact: Contact, conversation: Conversation):
+        self.repository = repository
+        self.completion_gateway = completion_gateway
+        self.worker = worker
+        self.contact = contact
+        self.conversation = conversation
+        self.notices: List[Tuple[str, str]] = [] # (title, content) from finished background jobs, shown at the next turn
+        self.prefetching: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def open(cls, repository: Repository, completion_gateway: CompletionGateway, worker: BackgroundWorker, contact: Contact) -> "ChatSession":
+        conversation = await repository.get_conversation(contact.id)
+        if not conversation:
+            conversation = await repository.create_conversation(contact.id)
+
+        await worker.submit("rollup_conversations", completion_gateway.rollup_conversations, contact.id) # days may have closed since the last run
+        await worker.submit("consolidate_facts", completion_gateway.consolidate_facts, contact.id)
+        await worker.submit("archive_conversations", repository.archive_conversations, contact.id)
+        completion_gateway.load_knowledge_graph(contact.id) # ready by the first turn unless it's big
+        return cls(repository, completion_gateway, worker, contact, conversation)
+
+    async def put_fact(self, memory: FactMemory, fact: Fact):
+        memory.put(fact)
+        if memory.needs_consolidation:
+            await self.worker.submit("consolidate_facts", self.completion_gateway.consolidate_facts, self.contact.id)
+
+    def prefetch(self):
+        # reads the next turn's context while the caller waits on the user, turn() picks it up. call it between turns
+        if self.prefetching is None or self.prefetching.done():
+            self.prefetching = asyncio.create_task(self.run_prefetch())
+
+    def close(self):
+        # a prefetch still running would fill the gateway's caches again after the caller dropped them
+        if self.prefetching:
+            self.prefetching.cancel()
+            self.prefetching = None
+
+    async def run_prefetch(self):
+        await self.completion_gateway.prefetch(self.contact, self.conversation)
+        if self.completion_gateway.warm_cache:
+            await self.worker.submit("warm_cache", self.completion_gateway.warm, self.contact, self.conversation, retries=0)
+
+    async def turn(self, user_input: str) -> AsyncIterator[Union[str, Message]]:
+        # yields the user message, then text deltas as they stream and each response message once it's handled.
+        # everything the turn writes is committed together at the end, so a turn that fails part way leaves no trace of itself.
+        # the turn span is open across the yields, so in the trace its own time is mostly the caller rendering what it gets
+        if self.prefetching:
+            with suppress(Exception): # the turn reads whatever's missing itself
+                await self.prefetching
+            self.prefetching = None
+
+        with tracer.span("turn", contact=self.contact.name, conversation=self.conversation.id):
+            uow = self.repository.unit_of_work()
+            conversation = self.conversation
+            message = uow.add(Message(role=Role.USER, content=user_input, conversation_id=conversation.id, contact_id=self.contact.id))
+            yield message
+
+            has_text_response = False
+            has_follow_up_response = False
+            while not has_text_response or has_follow_up_response:
+                has_follow_up_response = False
+
+                async for response in self.completion_gateway.stream(self.contact, conversation, uow.messages):
+                    if isinstance(response, str):
+                        yield response
+                        continue
+
+                    if response.message_type == MessageType.CHAT:
+                        uow.add(response)
+                        has_text_response = True
+
+                    elif response.message_type == MessageType.TOOL_USE:
+                        with tracer.span("tool.handle", tool=response.tool_use_name):
+                            if response.tool_use_name == ActionType.REMEMBER_FACT.value:
+                                memory = await self.completion_gateway.get_fact_memory(self.contact.id)
+                                fact, reinforced = memory.remember(response.tool_use_input["fact"])
+                                if reinforced:
+                                    uow.merge(fact)
+                                else:
+                                    uow.add(fact)
+                                uow.after_commit(lambda fact=fact: self.put_fact(memory, fact))
+                            elif response.tool_use_name == ActionType.TOPIC_CHANGED.value:
+                                prior_conversation = conversation # so that we don't include the message that triggered the tool use in the summary
+                                conversation = uow.add(Conversation(contact_id=self.contact.id))
+
+                                # the jobs read what this turn writes
+                                uow.after_commit(lambda prior_conversation=prior_conversation: self.worker.submit("summarize_conversation", self.completion_gateway.summarize_conversation, prior_conversation, on_done=lambda summary: self.notices.append(("Summary", summary))))
+                                uow.after_commit(lambda: self.worker.submit("rollup_conversations", self.completion_gateway.rollup_conversations, self.contact.id))
+                            elif response.tool_use_name == ActionType.REQUIRES_FOLLOW_UP.value:
+                                has_follow_up_response = True # prompt the model again without waiting for user response
+
+                            # create matching user response message for tool use response, written together with the tool use
+                            uow.add(response, Message(role=Role.USER, message_type=MessageType.TOOL_USE, content=response.content, conversation_id=conversation.id, contact_id=self.contact.id, tool_use_id=response.tool_use_id, tool_use_name=response.tool_use_name, tool_use_input=response.tool_use_input))
+
+                    yield response
+
+            await uow.commit()
+            self.conversation = conversation
@@ -1,3 +1,4 @@
 from .completion import CompletionGateway, ActionType
+from .scheduler import RequestScheduler, Priority
 
-__all__ = ['CompletionGateway', 'ActionType']
\ No newline at end of file
+__all__ = ['CompletionGateway', 'ActionType', 'RequestScheduler', 'Priority']
\ No newline at end of file
@@ -0,0 +1,52 @@
+from dataclasses import dataclass
+from typing import Callable, List, TypeVar
+
+from app.model import AnyMessage, Role, MessageType
+
+
+T = TypeVar('T')
+
+
+@dataclass
+class TokenBudget():
+    total: int = 60000 # everything sent per turn, well under the context window
+    facts: int = 2000
+    prior_conversations: int = 4000
+    turn_context: int = 1500 # knowledge and recalled messages added to the last message
+    low_water: float = 0.75 # history over budget is trimmed to this fraction so the cached prefix start moves rarely
+
+
+def fit_newest(items: List[T], estimate: Callable[[T], int], budget: int) -> List[T]:
+    # keeps the newest items (the end of the list) that fit, dropping the oldest first
+    used = 0
+    for i in range(len(items) - 1, -1, -1):
+        used += estimate(items[i])
+        if used > budget:
+            return items[i + 1:]
+    return items
+
+
+def is_turn_start(message: AnyMessage) -> bool:
+    # a user chat message never sits between a tool use and its tool result, so history can be cut before one
+    return message.role == Role.USER and message.message_type == MessageType.CHAT
+
+
+def is_tool_result(message: AnyMessage) -> bool:
+    return message.role == Role.USER and message.message_type == MessageType.TOOL_USE
+
+
+def trim_history(messages: List[AnyMessage], tokens: int, budget: int, low_water: float) -> int:
+    # number of messages to drop from the front of the history, oldest first. it lands on a turn start when there's one to
+    # cut at, otherwise it keeps the newest messages that fit and only skips the tool results whose tool use was cut
+    target = budget * low_water if tokens > budget else tokens
+    drop = 0
+    while drop < len(messages) and tokens > target:
+        tokens -= messages[drop].token_estimate
+        drop += 1
+
+    for i in range(drop, len(messages)):
+        if is_turn_start(messages[i]):
+            return i
+    while drop < len(messages) and is_tool_result(messages[drop]):
+        drop += 1
+    return drop
\ No newline at end of file
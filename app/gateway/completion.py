@@ -1,21 +1,35 @@
 import os
-from typing import List
+import json
+import asyncio
+from typing import Callable, List, Dict, AsyncIterator, Sequence, Tuple, Union, Optional
 from enum import Enum
 from datetime import datetime, timedelta
 
 import anthropic
 import dotenv
 
-from app.repository import Repository
-from app.model import Contact, Message, Conversation, MessageType
+from app.repository import Repository, SearchResult
+from app.model import Contact, Message, Conversation, ConversationRollup, RollupPeriod, MessageType, Role, Entity, Triple, Fact, estimate_tokens
 from app.mapper import messages_to_anthropic_message, anthropic_messages_to_messages
-from app.prompts import get_chat_system_prompt, get_facts_prompt, get_prior_conversations_prompt, BASE_SYSTEM_PROMPT
+from app.prompts import get_facts_prompt, get_prior_conversations_prompt, get_persona_prompt, BASE_SYSTEM_PROMPT
 from app.constants import DEFAULT_TIMEZONE, UTC
+from app.knowledge import KnowledgeGraph, FactMemory, normalize_entity
+from app.backend import CompletionBackend, AnthropicBackend
+from app.tracing import traced
+from .context import ContextBuilder, PrefetchedContext
+from .history import HistoryBuffer
+from .budget import TokenBudget, fit_newest
+from .scheduler import RequestScheduler, Priority
+from .rollup import RollupSource, to_local, group_closed_periods, is_stale, select_prior_conversations
 
 
 dotenv.load_dotenv()
-client = anthropic.AsyncAnthropic(api_key=os.getenv('CLAUDE_API_KEY', ''))
+client = anthropic.AsyncAnthropic(api_key=os.getenv('CLAUDE_API_KEY', ''), max_retries=0) # retries are up to the scheduler
 MODEL_NAME = "claude-3-7-sonnet-latest"
+HISTORY_WINDOW = 100 # messages loaded from before the current conversation when a history buffer is seeded
+KNOWLEDGE_K = 10 # triples from the knowledge graph added to each turn
+RECALL_K = 5 # old messages recalled by full text search for each turn
+RECALL_CHARS = 300
 
 class ActionType(str, Enum):
     REMEMBER_FACT = "remember_fact"
@@ -66,35 +80,237 @@ CORPUS_TOOLS = [
     },
 ]
 
+FIXED_TOKENS = estimate_tokens(get_persona_prompt()) + estimate_tokens(json.dumps(TOOLS)) + 100 # plus the section headers and current time
+
+
+def get_recalled_line(result: SearchResult) -> str:
+    content = result.content if len(result.content) <= RECALL_CHARS else result.content[:RECALL_CHARS] + "..."
+    return f"({to_local(result.timestamp).strftime('%B %d, %Y')}) {result.role.lower()}: {content}"
+
 
 class CompletionGateway():
-    def __init__(self, repository: Repository):
+    def __init__(self, repository: Repository, budget: Optional[TokenBudget] = None, backend: Optional[CompletionBackend] = None, scheduler: Optional[RequestScheduler] = None, warm_cache: bool = False, clock: Optional[Callable[[], datetime]] = None):
         self.repository = repository
+        self.backend = backend or AnthropicBackend(client) # or a replay cache or scripted fake, see app.backend
+        self.scheduler = scheduler or RequestScheduler(self.backend) # every request goes through here, one per process shares the rate limits
+        self.budget = budget or TokenBudget()
+        self.clock = clock or (lambda: datetime.now(tz=DEFAULT_TIMEZONE)) # what the prompts call now, fixed for replays
         self.cached_time = None
-    
-    async def complete(self, contact: Contact, conversation: Conversation) -> List[Message]:
-        db_messages = await self.repository.get_messages(contact.id)
-        messages = messages_to_anthropic_message(list(reversed(db_messages)))
+        self.histories: Dict[str, HistoryBuffer] = {} # keyed by contact id
+        self.context_builder = ContextBuilder()
+        self.rollup_locks: Dict[str, asyncio.Lock] = {}
+        self.knowledge_graphs: Dict[str, KnowledgeGraph] = {}
+        self.graph_loads: Dict[str, asyncio.Task] = {} # contact id -> knowledge graph being loaded
+        self.fact_memories: Dict[str, FactMemory] = {}
+        self.fact_locks: Dict[str, asyncio.Lock] = {}
+        self.prefetched: Dict[str, PrefetchedContext] = {} # keyed by contact id, see prefetch
+        self.warm_cache = warm_cache
 
-        facts = get_facts_prompt(await self.repository.get_facts(contact.id))
-        conversations = await self.repository.get_conversations(contact.id)
-        conversations_with_summaries = [c for c in reversed(conversations) if c.summary]
-        prior_conversations = get_prior_conversations_prompt(conversations_with_summaries)
-        
-        if self.cached_time is None or self.cached_time < datetime.now(tz=DEFAULT_TIMEZONE) - timedelta(minutes=10):
-            self.cached_time = datetime.now(tz=DEFAULT_TIMEZONE)
+    async def get_history(self, contact: Contact, conversation: Conversation) -> HistoryBuffer:
+        history = self.histories.get(contact.id)
+        if history is None or history.conversation_id != conversation.id or history.cursor is None:
+            history = HistoryBuffer(conversation.id, list(reversed(await self.repository.get_message_window(contact.id, conversation.id, HISTORY_WINDOW))))
+            history.trim(self.budget.total) # the window can start mid-turn, this drops up to the first user chat message if there is one
+            self.histories[contact.id] = history
+        else:
+            history.extend(list(reversed(await self.repository.get_messages_after(contact.id, history.cursor))))
+        return history
+
+    def forget(self, contact_id: str):
+        # drops what's cached for the contact, its next turn reads it again. a lock that's held stays, along with the fact
+        # memory a running consolidation writes through
+        for cache in (self.histories, self.knowledge_graphs, self.prefetched, self.graph_loads):
+            cache.pop(contact_id, None)
+        for locks in (self.rollup_locks, self.fact_locks):
+            if contact_id in locks and not locks[contact_id].locked():
+                del locks[contact_id]
+        if contact_id not in self.fact_locks:
+            self.fact_memories.pop(contact_id, None)
+        self.context_builder.forget(contact_id)
+
+    async def get_knowledge_graph(self, contact_id: str) -> KnowledgeGraph:
+        graph = self.knowledge_graphs.get(contact_id)
+        if graph is None:
+            graph = await asyncio.shield(self.load_knowledge_graph(contact_id))
+        return graph
+
+    def load_knowledge_graph(self, contact_id: str) -> asyncio.Task:
+        # starts loading the contact's graph unless it already is. turns don't wait for it, see get_chat_request, since a big
+        # graph takes seconds to build. that happens on a thread, so turns for other contacts carry on meanwhile
+        task = self.graph_loads.get(contact_id)
+        if task is None:
+            async def load() -> KnowledgeGraph:
+                graph = KnowledgeGraph()
+                entities, triples = await self.repository.get_entities(contact_id), await self.repository.get_triples(contact_id)
+                await asyncio.to_thread(graph.load, entities, ((*t[:6], to_local(t[6]).timestamp()) for t in triples))
+                return graph
+
+            def loaded(task: asyncio.Task):
+                if self.graph_loads.get(contact_id) is not task: # forgotten meanwhile
+                    return
+                del self.graph_loads[contact_id]
+                if not task.cancelled() and task.exception() is None:
+                    self.knowledge_graphs[contact_id] = task.result()
+
+            task = asyncio.create_task(load())
+            task.add_done_callback(loaded)
+            self.graph_loads[contact_id] = task
+        return task
+
+    async def add_triples(self, contact_id: str, triples: List[dict]) -> List[Triple]:
+        # normalizes, dedups and ranks extracted triples, then persists whatever was new or reinforced
+        graph = await self.get_knowledge_graph(contact_id)
+        entities, changed = [], {}
+        for t in triples:
+            triple, created = graph.add_triple(t['subject'], t['predicate'], t['object'], int(t['importance']))
+            entities.extend(Entity(id=e, name=graph.names[e], normalized_name=normalize_entity(graph.names[e]), contact_id=contact_id) for e in created)
+            if triple:
+                changed[triple.id] = Triple(id=triple.id, subject_id=triple.subject, predicate=triple.predicate, object_id=triple.object, importance=triple.importance, mentions=triple.mentions, timestamp=datetime.fromtimestamp(triple.timestamp, tz=UTC), contact_id=contact_id)
+        await self.repository.save_knowledge(entities, list(changed.values()))
+        return list(changed.values())
 
-        system_prompt = get_chat_system_prompt(facts, prior_conversations, self.cached_time.strftime('%B %d, %Y at %I:%M %p PT'))
+    async def get_fact_memory(self, contact_id: str) -> FactMemory:
+        memory = self.fact_memories.get(contact_id)
+        if memory is None:
+            memory = FactMemory(contact_id, await self.repository.get_facts(contact_id))
+            self.fact_memories[contact_id] = memory
+        return memory
 
-        res = await client.messages.create(
+    async def consolidate_facts(self, contact_id: str) -> List[Fact]:
+        # rewrites groups of related facts as what's still true of them, then evicts whatever is over capacity.
+        # returns the facts that were written. a turn can reinforce a fact this deletes, which puts it back, and the
+        # next run catches it again
+        async with self.fact_locks.setdefault(contact_id, asyncio.Lock()):
+            memory = await self.get_fact_memory(contact_id)
+            checked = set(memory.unchecked)
+            saved, deleted = [], []
+            for cluster in memory.get_clusters():
+                contents = await self.merge_facts(cluster)
+                if not contents or sorted(contents) == sorted(f.content for f in cluster):
+                    continue
+                saved.extend(memory.consolidate(cluster, contents))
+                deleted.extend(f.id for f in cluster if f.id in memory.facts)
+
+            for fact_id in deleted:
+                memory.remove(fact_id)
+            for fact in saved:
+                memory.put(fact, checked=True)
+            evicted = [f.id for f in memory.get_evictions()]
+            for fact_id in evicted:
+                memory.remove(fact_id)
+            saved = [f for f in saved if f.id in memory.facts]
+
+            try:
+                await self.repository.save_facts(contact_id, saved, deleted + evicted)
+            except Exception:
+                self.fact_memories.pop(contact_id, None) # reloaded from what was actually written
+                raise
+            memory.unchecked -= checked
+            return saved
+
+    async def merge_facts(self, facts: List[Fact]) -> List[str]:
+        system_prompt = f'''
+        {BASE_SYSTEM_PROMPT}
+
+        these are facts you remembered about the user at different times, oldest first, and they overlap. rewrite them as the fewest facts that keep everything that is still true, where they disagree the later one is newer. respond with only the facts, one per line starting with "- ".'''
+
+        res = await self.scheduler.create(
+            Priority.BACKGROUND,
             model=MODEL_NAME,
-            tools=TOOLS,
-            system=[{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
-            messages=messages,
-            max_tokens=1500,
+            messages=[anthropic.types.MessageParam(role="user", content="\n".join(f"- {f.content}" for f in facts))],
+            max_tokens=500,
+            system=system_prompt,
         )
+        return [line[2:].strip() for line in res.content[0].text.splitlines() if line.startswith("- ") and line[2:].strip()]
+
+    @traced("context")
+    async def prefetch(self, contact: Contact, conversation: Conversation) -> PrefetchedContext:
+        # everything of the next turn's context that doesn't depend on what the user says, so it can be read while they type.
+        # it's good until the repository writes anything for the contact. must not overlap a turn for the same contact,
+        # the history buffer is shared with it
+        version = self.repository.get_version(contact.id) # before reading, so a write that lands part way makes it stale
+        if contact.id not in self.knowledge_graphs:
+            self.load_knowledge_graph(contact.id)
+        facts = fit_newest((await self.get_fact_memory(contact.id)).get_facts(), lambda f: estimate_tokens(f.content), self.budget.facts)
+        conversations = await self.repository.get_conversations(contact.id)
+        prior_conversations = select_prior_conversations([c for c in reversed(conversations) if c.summary], await self.repository.get_rollups(contact.id), self.clock())
+        prior_conversations = fit_newest(prior_conversations, lambda c: estimate_tokens(c.summary), self.budget.prior_conversations)
+        prefetched = PrefetchedContext(conversation.id, version, get_facts_prompt(facts), get_prior_conversations_prompt(prior_conversations))
+
+        history = await self.get_history(contact, conversation)
+        history.trim(self.get_history_budget(prefetched), self.budget.low_water)
+        self.prefetched[contact.id] = prefetched
+        return prefetched
+
+    async def get_prefetched(self, contact: Contact, conversation: Conversation) -> PrefetchedContext:
+        prefetched = self.prefetched.get(contact.id)
+        if prefetched is None or prefetched.conversation_id != conversation.id or prefetched.version != self.repository.get_version(contact.id):
+            prefetched = await self.prefetch(contact, conversation)
+        return prefetched
+
+    def get_history_budget(self, prefetched: PrefetchedContext, pending: Sequence[Message] = ()) -> int:
+        # history gets whatever the fixed prompt, facts and summaries leave over
+        return self.budget.total - FIXED_TOKENS - self.budget.turn_context - estimate_tokens(prefetched.facts_prompt) - estimate_tokens(prefetched.prior_conversations_prompt) - sum(m.token_estimate for m in pending)
+
+    @traced("context")
+    async def get_chat_request(self, contact: Contact, conversation: Conversation, pending: Sequence[Message] = ()) -> Tuple[dict, int]:
+        # `pending` are this turn's messages that aren't committed yet, they go after the history. returns the request and its
+        # input token estimate, added up from the parts rather than by serializing the whole request every turn
+        prefetched = await self.get_prefetched(contact, conversation)
+        history = self.histories[contact.id] # caught up by the prefetch, nothing was written since
+        history.trim(self.get_history_budget(prefetched, pending), self.budget.low_water)
+        messages = [*history.messages, *pending]
+        
+        if self.cached_time is None or self.cached_time < self.clock() - timedelta(minutes=10):
+            self.cached_time = self.clock()
+
+        # these depend on what the user said, so they can't be prefetched
+        user_messages = [m.content for m in messages[-8:] if m.role == Role.USER and m.message_type == MessageType.CHAT]
+        graph = self.knowledge_graphs.get(contact.id)
+        if graph is None:
+            self.load_knowledge_graph(contact.id) # for a later turn, this one goes without rather than wait
+        knowledge = [graph.describe(t) for t in graph.get_relevant_triples(user_messages[-1] if user_messages else "", KNOWLEDGE_K)] if graph is not None else []
+        # only recall what has already fallen out of the history window
+        recalled = [get_recalled_line(r) for r in await self.repository.search_messages(contact.id, user_messages[-1], RECALL_K, before=messages[0].timestamp)] if user_messages else []
+
+        context = self.context_builder.build(contact.id, TOOLS, prefetched.facts_prompt, prefetched.prior_conversations_prompt, messages, self.cached_time.strftime('%B %d, %Y at %I:%M %p PT'), knowledge, recalled)
+        tokens = FIXED_TOKENS + estimate_tokens(prefetched.facts_prompt) + estimate_tokens(prefetched.prior_conversations_prompt) + history.tokens + sum(m.token_estimate for m in pending) + sum(estimate_tokens(line) for line in [*knowledge, *recalled])
+        return dict(model=MODEL_NAME, max_tokens=1500, **context), tokens
+
+    async def warm(self, contact: Contact, conversation: Conversation) -> bool:
+        # writes the prompt cache through the end of the history, the reply the last turn ended with included, with a one token
+        # background request while the user types. the next turn's first request then reads all of it instead of processing
+        # the tail before its first token. costs a request per turn, so it's off unless asked for. returns whether one was sent
+        prefetched = self.prefetched.get(contact.id)
+        history = self.histories.get(contact.id)
+        if prefetched is None or prefetched.conversation_id != conversation.id or prefetched.version != self.repository.get_version(contact.id) or not history or not history.messages:
+            return False
+
+        request = self.context_builder.build_prefix(contact.id, TOOLS, prefetched.facts_prompt, prefetched.prior_conversations_prompt, history.messages)
+        if request["messages"][-1]["role"] == Role.ASSISTANT.value:
+            request["messages"].append(anthropic.types.MessageParam(role="user", content=".")) # after the breakpoint, so not part of what's cached
+        res = await self.scheduler.create(Priority.BACKGROUND, model=MODEL_NAME, max_tokens=1, **request)
+        self.context_builder.record_usage(contact.id, res.usage)
+        return True
+
+    async def complete(self, contact: Contact, conversation: Conversation, pending: Sequence[Message] = ()) -> List[Message]:
+        request, tokens = await self.get_chat_request(contact, conversation, pending)
+        res = await self.scheduler.create(Priority.INTERACTIVE, tokens, **request)
+        self.context_builder.record_usage(contact.id, res.usage)
         return anthropic_messages_to_messages(res.content, contact.id, conversation.id)
 
+    async def stream(self, contact: Contact, conversation: Conversation, pending: Sequence[Message] = ()) -> AsyncIterator[Union[str, Message]]:
+        # yields text deltas as they arrive, and each content block as a Message as soon as it finishes streaming
+        request, tokens = await self.get_chat_request(contact, conversation, pending)
+        async with self.scheduler.stream(Priority.INTERACTIVE, tokens, **request) as stream:
+            async for event in stream:
+                if event.type == "text":
+                    yield event.text
+                elif event.type == "content_block_stop":
+                    for message in anthropic_messages_to_messages([event.content_block], contact.id, conversation.id):
+                        yield message
+            self.context_builder.record_usage(contact.id, (await stream.get_final_message()).usage)
+
     async def summarize_conversation(self, conversation: Conversation) -> str:
         db_messages = await self.repository.get_messages_for_conversation(conversation.id)
         db_messages = [m for m in db_messages if m.message_type == MessageType.CHAT] # filter out tool use
@@ -106,7 +322,8 @@ class CompletionGateway():
         summarize the following conversation in one to two sentences from your perspective for your own memory.'''
         messages.append(anthropic.types.MessageParam(role="user", content="summarize the conversation in one to two sentences from your perspective for your own memory.")) # we have to end on a user message i guess lol
 
-        res = await client.messages.create(
+        res = await self.scheduler.create(
+            Priority.BACKGROUND,
             model=MODEL_NAME,
             messages=messages,
             max_tokens=1500,
@@ -118,9 +335,55 @@ class CompletionGateway():
         await self.repository.update_conversation(conversation)
         return conversation.summary
 
+    async def summarize_summaries(self, period: RollupPeriod, summaries: List[str]) -> str:
+        system_prompt = f'''
+        {BASE_SYSTEM_PROMPT}
+
+        these are your own memories of separate conversations from the same {period.value}. condense them into one to two sentences from your perspective for your own memory, keeping what matters most about the user.'''
+
+        res = await self.scheduler.create(
+            Priority.BACKGROUND,
+            model=MODEL_NAME,
+            messages=[anthropic.types.MessageParam(role="user", content="\n".join(f"- {summary}" for summary in summaries))],
+            max_tokens=1500,
+            system=system_prompt,
+        )
+        return res.content[0].text
+
+    async def rollup_conversations(self, contact_id: str) -> List[ConversationRollup]:
+        # condenses summaries into day rollups, days into weeks, weeks into months and months into years,
+        # only redoing closed periods whose sources changed. returns the rollups that were written
+        async with self.rollup_locks.setdefault(contact_id, asyncio.Lock()):
+            now = self.clock()
+            existing = {(r.period, to_local(r.period_start)): r for r in await self.repository.get_rollups(contact_id)}
+            sources = [RollupSource(c.start_time, c.summary, c.end_time) for c in await self.repository.get_conversations(contact_id) if c.summary and c.end_time]
+
+            changed = []
+            for period in RollupPeriod:
+                level = []
+                for start, group in group_closed_periods(sources, period, now).items():
+                    rollup = existing.get((period, start))
+                    if rollup is None or is_stale(rollup, group):
+                        summary = group[0].summary if len(group) == 1 else await self.summarize_summaries(period, [s.summary for s in group])
+                        rollup = ConversationRollup(
+                            **({"id": rollup.id} if rollup else {}),
+                            period=period,
+                            period_start=start.astimezone(tz=UTC),
+                            summary=summary,
+                            source_count=len(group),
+                            source_updated=max(to_local(s.updated) for s in group).astimezone(tz=UTC),
+                            contact_id=contact_id,
+                        )
+                        changed.append(rollup)
+                    level.append(RollupSource(rollup.period_start, rollup.summary, rollup.updated_at))
+                sources = level
+
+            await self.repository.save_rollups(changed)
+            return changed
+
     async def extract_triples(self, corpus: str) -> List[str]:
-        print(corpus)
-        res = await client.messages.create(
+        res = await self.scheduler.create(
+            Priority.BACKGROUND,
             model=MODEL_NAME,
             messages=[anthropic.types.MessageParam(role="user", content=corpus)],
             max_tokens=1500,
@@ -0,0 +1,99 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List
+
+import anthropic
+
+from app.model import AnyMessage, Role
+from app.mapper import MessageMapper
+from app.prompts import get_persona_prompt, get_facts_section, get_prior_conversations_section, get_knowledge_prompt, get_recall_prompt, get_current_time_prompt
+
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+@dataclass
+class TurnUsage():
+    contact_id: str
+    input_tokens: int
+    output_tokens: int
+    cache_creation_input_tokens: int
+    cache_read_input_tokens: int
+
+
+@dataclass
+class PrefetchedContext():
+    # the parts of a turn's context read before the user's message is in, see CompletionGateway.prefetch
+    conversation_id: str
+    version: int # of the contact's writes in the repository when it was read
+    facts_prompt: str
+    prior_conversations_prompt: str
+
+
+# lays the request out from most to least stable so each change only invalidates the cache after it:
+# tools, persona | facts, prior conversations | history up to the last turn | this turn | knowledge, recall, current time.
+# the api allows four cache breakpoints, one goes at each | above. knowledge and messages recalled for this turn and the current
+# time ride along after the last breakpoint in the final user message, so they never invalidate anything.
+class ContextBuilder():
+    def __init__(self, max_usage: int = 1000):
+        self.breakpoints: Dict[str, str] = {} # contact id -> id of the message the last request was cached up to
+        self.mappers: Dict[str, MessageMapper] = {} # contact id -> history mapped so far, so a turn only maps what's new
+        self.usage: Deque[TurnUsage] = deque(maxlen=max_usage)
+
+    def get_system(self, facts: str, prior_conversations: str) -> List[dict]:
+        return [
+            {"type": "text", "text": get_persona_prompt(), "cache_control": EPHEMERAL},
+            {"type": "text", "text": get_facts_section(facts)},
+            {"type": "text", "text": get_prior_conversations_section(prior_conversations), "cache_control": EPHEMERAL},
+        ]
+
+    def get_messages(self, contact_id: str, history: List[AnyMessage]) -> List[anthropic.types.MessageParam]:
+        # reading back the prefix the previous request wrote keeps older history cached, the last message writes it for the next turn
+        breakpoints = {len(history) - 1}
+        previous = self.breakpoints.get(contact_id)
+        for i in range(len(history) - 2, -1, -1):
+            if history[i].id == previous:
+                breakpoints.add(i)
+                break
+        if history:
+            self.breakpoints[contact_id] = history[-1].id
+
+        return self.mappers.setdefault(contact_id, MessageMapper()).map(history, breakpoints)
+
+    def build(self, contact_id: str, tools: List[dict], facts: str, prior_conversations: str, history: List[AnyMessage], current_time: str, knowledge: List[str] = [], recalled: List[str] = []) -> dict:
+        system = self.get_system(facts, prior_conversations)
+        messages = self.get_messages(contact_id, history)
+        time_block = anthropic.types.TextBlockParam(type="text", text="\n\n".join(filter(None, [get_knowledge_prompt(knowledge), get_recall_prompt(recalled), get_current_time_prompt(current_time)])))
+        if messages and messages[-1]["role"] == Role.USER.value:
+            messages[-1] = anthropic.types.MessageParam(role=messages[-1]["role"], content=[*messages[-1]["content"], time_block]) # the mapper's, so not in place
+        else:
+            system.append(time_block)
+
+        return dict(tools=tools, system=system, messages=messages)
+
+    def build_prefix(self, contact_id: str, tools: List[dict], facts: str, prior_conversations: str, history: List[AnyMessage]) -> dict:
+        # what the next turn's request starts with, up to and including the last message of `history` with a cache breakpoint
+        # on it. sending it writes the prompt cache the next turn reads, see CompletionGateway.warm
+        return dict(tools=tools, system=self.get_system(facts, prior_conversations), messages=self.get_messages(contact_id, history))
+
+    def record_usage(self, contact_id: str, usage: anthropic.types.Usage) -> TurnUsage:
+        turn = TurnUsage(
+            contact_id=contact_id,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cache_creation_input_tokens=usage.cache_creation_input_tokens or 0,
+            cache_read_input_tokens=usage.cache_read_input_tokens or 0,
+        )
+        self.usage.append(turn)
+        return turn
+
+    def forget(self, contact_id: str):
+        self.breakpoints.pop(contact_id, None)
+        self.mappers.pop(contact_id, None)
+
+    @property
+    def cache_hit_rate(self) -> float:
+        # share of prompt tokens served from the cache over the recorded turns
+        read = sum(u.cache_read_input_tokens for u in self.usage)
+        total = read + sum(u.cache_creation_input_tokens + u.input_tokens for u in self.usage)
+        return read / total if total else 0.0
@@ -0,0 +1,26 @@
+from typing import List, Optional
+
+from app.model import AnyMessage
+from .budget import trim_history
+
+
+class HistoryBuffer():
+    def __init__(self, conversation_id: str, messages: List[AnyMessage]):
+        self.conversation_id = conversation_id
+        self.messages: List[AnyMessage] = [] # oldest first, appended to as rows are written and trimmed from the front
+        self.tokens = 0
+        self.extend(messages)
+
+    @property
+    def cursor(self):
+        return (self.messages[-1].timestamp, self.messages[-1].id) if self.messages else None
+
+    def extend(self, messages: List[AnyMessage]):
+        self.messages.extend(messages)
+        self.tokens += sum(m.token_estimate for m in messages)
+
+    def trim(self, budget: int, low_water: float = 1.0):
+        drop = trim_history(self.messages, self.tokens, budget, low_water)
+        if drop:
+            self.tokens -= sum(m.token_estimate for m in self.messages[:drop])
+            del self.messages[:drop]
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+from app.model import Conversation, ConversationRollup, RollupPeriod
+from app.constants import DEFAULT_TIMEZONE, UTC
+
+
+class RollupSource(NamedTuple):
+    start: datetime
+    summary: str
+    updated: datetime
+
+
+def to_local(dt: datetime) -> datetime:
+    # rows come back from sqlite as naive utc
+    return (dt if dt.tzinfo else dt.replace(tzinfo=UTC)).astimezone(tz=DEFAULT_TIMEZONE)
+
+
+def get_period_start(dt: datetime, period: RollupPeriod) -> datetime:
+    day = to_local(dt).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == RollupPeriod.DAY:
+        return day
+    elif period == RollupPeriod.WEEK:
+        return max(day - timedelta(days=day.weekday()), day.replace(day=1))
+    elif period == RollupPeriod.MONTH:
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+
+def group_closed_periods(sources: List[RollupSource], period: RollupPeriod, now: datetime) -> Dict[datetime, List[RollupSource]]:
+    # the period containing now is still open, its sources stay verbatim or at the level below
+    current = get_period_start(now, period)
+    groups: Dict[datetime, List[RollupSource]] = {}
+    for source in sorted(sources, key=lambda s: to_local(s.start)):
+        start = get_period_start(source.start, period)
+        if start != current:
+            groups.setdefault(start, []).append(source)
+    return groups
+
+
+def is_stale(rollup: ConversationRollup, sources: List[RollupSource]) -> bool:
+    return rollup.source_count != len(sources) or to_local(rollup.source_updated) < max(to_local(s.updated) for s in sources)
+
+
+def get_prompt_tier(dt: datetime, now: datetime) -> Union[RollupPeriod, None]:
+    # today verbatim, earlier this week by day, earlier this month by week, earlier this year by month, then by year
+    if get_period_start(dt, RollupPeriod.DAY) == get_period_start(now, RollupPeriod.DAY):
+        return None
+    for period, parent in ((RollupPeriod.DAY, RollupPeriod.WEEK), (RollupPeriod.WEEK, RollupPeriod.MONTH), (RollupPeriod.MONTH, RollupPeriod.YEAR)):
+        if get_period_start(dt, parent) == get_period_start(now, parent):
+            return period
+    return RollupPeriod.YEAR
+
+
+def select_prior_conversations(conversations: List[Conversation], rollups: List[ConversationRollup], now: datetime) -> List[Union[Conversation, ConversationRollup]]:
+    # replaces summaries with the rollup for their tier where one exists, oldest first
+    by_period: Dict[Tuple[RollupPeriod, datetime], ConversationRollup] = {(r.period, to_local(r.period_start)): r for r in rollups}
+    selected: Dict[str, Union[Conversation, ConversationRollup]] = {}
+    for conversation in conversations:
+        tier = get_prompt_tier(conversation.start_time, now)
+        rollup = by_period.get((tier, get_period_start(conversation.start_time, tier))) if tier else None
+        item = rollup or conversation
+        selected[item.id] = item
+    return sorted(selected.values(), key=lambda c: to_local(c.period_start if isinstance(c, ConversationRollup) else c.start_time))
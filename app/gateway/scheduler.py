@@ -0,0 +1,262 @@
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import anthropic
+
+from app.model import estimate_tokens
+from app.backend import CompletionBackend
+from app.tracing import tracer, Span
+
+
+BURST_SECONDS = 10 # the api enforces per minute limits over shorter windows, so don't spend a whole minute's worth at once
+RETRY_STATUSES = {429, 500, 502, 503, 504, 529} # 529 is the api being overloaded
+BACKGROUND_RESERVE = 0.2 # share of each bucket that only interactive requests may use
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class TokenBucket():
+    def __init__(self, per_minute: float, now: float, burst_seconds: float = 60):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.level = self.capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, amount: float, now: float, reserve: float = 0.0) -> float:
+        # seconds until `amount` can be taken while leaving `reserve` of capacity. requests bigger than the bucket wait for a full one
+        self.refill(now)
+        floor = reserve * self.capacity
+        missing = min(amount, self.capacity - floor) + floor - self.level
+        return max(missing, 0) / self.rate
+
+    def take(self, amount: float, now: float):
+        # can go negative, later requests then wait for the debt to refill
+        self.refill(now)
+        self.level -= amount
+
+
+@dataclass(order=True)
+class Ticket():
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    granted: asyncio.Future = field(compare=False)
+
+
+def get_request_tokens(request: dict) -> int:
+    # input tokens the request will count against the limit, from the same chars per token estimate as messages
+    return estimate_tokens(json.dumps([request.get("system"), request.get("tools"), request.get("messages")], default=str))
+
+
+def get_retry_after(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers["retry-after"]) if response is not None else None
+    except (KeyError, ValueError):
+        return None
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, anthropic.APIStatusError):
+        return e.status_code in RETRY_STATUSES
+    return isinstance(e, anthropic.APIConnectionError) # includes timeouts
+
+
+class RequestScheduler():
+    # sits in front of the model backend. requests wait for a slot, then for the requests and input tokens per minute buckets.
+    # interactive requests always go first and background requests leave BACKGROUND_RESERVE of each bucket to them, so when
+    # we're throttled it's batch work that waits and chat latency stays flat. retryable errors back off with full jitter, and
+    # a retry-after pauses everyone since the limits are shared. identical creates in flight share one request.
+    def __init__(self, backend: CompletionBackend, requests_per_minute: float = 50, tokens_per_minute: float = 40000, max_concurrency: int = 8, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, burst_seconds: float = BURST_SECONDS):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.requests: Optional[TokenBucket] = None # created on first use, they need the running loop's clock
+        self.tokens: Optional[TokenBucket] = None
+        self.waiting: List[Ticket] = []
+        self.seq = itertools.count()
+        self.active = 0
+        self.paused_until = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.retries = 0
+        self.coalesced = 0
+
+    def dispatch(self):
+        # grants waiting tickets in priority order until the head has to wait, then checks again when it could go
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.requests is None:
+            self.requests = TokenBucket(self.requests_per_minute, now, self.burst_seconds)
+            self.tokens = TokenBucket(self.tokens_per_minute, now, self.burst_seconds)
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        while self.waiting:
+            ticket = self.waiting[0]
+            if ticket.granted.done(): # cancelled while waiting
+                heapq.heappop(self.waiting)
+                continue
+            if self.active >= self.max_concurrency:
+                return # release dispatches again
+
+            reserve = 0.0 if ticket.priority == Priority.INTERACTIVE else BACKGROUND_RESERVE
+            delay = max(self.paused_until - now, self.requests.get_delay(1, now, reserve), self.tokens.get_delay(ticket.tokens, now, reserve))
+            if delay > 0:
+                self.timer = loop.call_later(delay, self.dispatch)
+                return
+
+            heapq.heappop(self.waiting)
+            self.requests.take(1, now)
+            self.tokens.take(ticket.tokens, now)
+            self.active += 1
+            ticket.granted.set_result(None)
+
+    async def acquire(self, priority: Priority, tokens: int):
+        ticket = Ticket(priority, next(self.seq), tokens, asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiting, ticket)
+        self.dispatch()
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                self.release() # granted just as we were cancelled
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    def settle(self, estimate: int, usage: Any):
+        # swap the estimate for what the api actually counted, cache reads don't count toward the input limit
+        if usage is None or self.tokens is None:
+            return
+        actual = usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        self.tokens.take(actual - estimate, asyncio.get_running_loop().time())
+
+    def get_retry_delay(self, e: Exception, attempt: int) -> Optional[float]:
+        # None when the error should go to the caller
+        if attempt >= self.max_retries or not is_retryable(e):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + retry_after)
+            delay = max(delay, retry_after)
+        self.retries += 1
+        return delay
+
+    async def call(self, priority: Priority, tokens: int, fn: Callable[[], Awaitable[Any]], model: str = "") -> Any:
+        attempt = 0
+        while True:
+            with tracer.span("scheduler.wait", priority=priority.name.lower()):
+                await self.acquire(priority, tokens)
+            try:
+                with tracer.span("model.create", model=model, priority=priority.name.lower(), attempt=attempt) as span:
+                    response = await fn()
+                    tracer.record_usage(span, getattr(response, "usage", None))
+                    return response
+            except Exception as e:
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.release()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def create(self, priority: Priority, tokens: Optional[int] = None, **request) -> Any:
+        # `tokens` is the caller's own input estimate, saves serializing the request again to count it
+        key = json.dumps(request, sort_keys=True, default=str)
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        tokens = tokens if tokens is not None else get_request_tokens(request)
+        future = asyncio.ensure_future(self.call(priority, tokens, lambda: self.backend.create(**request), request.get("model", "")))
+        self.in_flight[key] = future
+        future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        response = await asyncio.shield(future)
+        self.settle(tokens, getattr(response, "usage", None))
+        return response
+
+    def stream(self, priority: Priority, tokens: Optional[int] = None, **request) -> "ScheduledStream":
+        # streams aren't coalesced, every caller needs its own events
+        return ScheduledStream(self, priority, request, tokens)
+
+
+class ScheduledStream():
+    # async context manager in place of backend.stream. it holds a slot for as long as the stream is open and can
+    # only retry until the response starts, which is when the api reports rate limits
+    def __init__(self, scheduler: RequestScheduler, priority: Priority, request: dict, tokens: Optional[int] = None):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.request = request
+        self.tokens = tokens if tokens is not None else get_request_tokens(request)
+        self.manager = None
+        self.stream = None
+        self.span = None
+
+    async def __aenter__(self) -> "ScheduledStream":
+        attempt = 0
+        while True:
+            with tracer.span("scheduler.wait", priority=self.priority.name.lower()):
+                await self.scheduler.acquire(self.priority, self.tokens)
+            # open until the stream closes, so whatever the caller does with the events nests under it
+            self.span = tracer.span("model.stream", model=self.request.get("model", ""), priority=self.priority.name.lower(), attempt=attempt).__enter__()
+            try:
+                self.manager = self.scheduler.backend.stream(**self.request)
+                self.stream = await self.manager.__aenter__()
+                return self
+            except BaseException as e: # cancelled while opening too, or the slot is never given back
+                self.span.end(type(e))
+                self.scheduler.release()
+                delay = self.scheduler.get_retry_delay(e, attempt) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return await self.manager.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.scheduler.release()
+            self.span.end(exc_type)
+
+    def __aiter__(self):
+        if not isinstance(self.span, Span):
+            return self.stream.__aiter__()
+        return self.timed_events()
+
+    async def timed_events(self):
+        async for event in self.stream:
+            if "first_event_ms" not in self.span.attrs:
+                self.span.set(first_event_ms=round((time.perf_counter() - self.span.started) * 1000, 3))
+            yield event
+
+    async def get_final_message(self) -> Any:
+        message = await self.stream.get_final_message()
+        self.scheduler.settle(self.tokens, message.usage)
+        tracer.record_usage(self.span, message.usage)
+        return message
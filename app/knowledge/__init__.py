@@ -0,0 +1,4 @@
+from .graph import KnowledgeGraph, KnowledgeTriple, normalize_entity, normalize_predicate
+from .facts import FactMemory, MinHasher
+
+__all__ = ['KnowledgeGraph', 'KnowledgeTriple', 'normalize_entity', 'normalize_predicate', 'FactMemory', 'MinHasher']
\ No newline at end of file
@@ -0,0 +1,167 @@
+import random
+import re
+import zlib
+from datetime import datetime, UTC
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.model import Fact
+
+
+SHINGLE_SIZE = 3 # characters, facts are too short for word shingles
+NUM_PERM = 64
+# facts share a bucket from about (1 / BANDS) ** (BANDS / NUM_PERM) = 0.18 similarity, well under RELATED_THRESHOLD,
+# and candidates are then checked against the whole signature
+BANDS = 32 # of NUM_PERM // BANDS rows each
+DUPLICATE_THRESHOLD = 0.85 # the same fact again, reinforces the one already known
+RELATED_THRESHOLD = 0.5 # probably about the same thing, consolidated in the background
+FACT_CAPACITY = 100 # per contact, the least valuable facts over it are evicted
+FACT_HALF_LIFE_DAYS = 90
+MERSENNE_PRIME = (1 << 61) - 1
+
+Signature = Tuple[int, ...]
+
+
+def normalize_fact(content: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", content.lower()).split())
+
+
+def get_shingles(content: str) -> Set[int]:
+    text = normalize_fact(content)
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode())}
+    return {zlib.crc32(text[i:i + SHINGLE_SIZE].encode()) for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def get_similarity(a: Signature, b: Signature) -> float:
+    # estimated jaccard similarity of the shingles the signatures came from
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def as_utc(timestamp: datetime) -> datetime:
+    # rows read back from sqlite lose their timezone, they were written as utc
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=UTC)
+
+
+class MinHasher():
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(num_perm)]
+
+    def get_signature(self, content: str) -> Signature:
+        shingles = get_shingles(content)
+        return tuple(min((a * s + b) % MERSENNE_PRIME for s in shingles) for a, b in self.permutations)
+
+
+HASHER = MinHasher()
+
+
+class FactMemory():
+    # one contact's facts, with minhash signatures bucketed by band so near duplicates are found without comparing every pair.
+    # it only changes once writes are committed: `remember` returns what to write and `put` applies it afterwards
+    def __init__(self, contact_id: str, facts: Iterable[Fact] = (), capacity: int = FACT_CAPACITY, hasher: MinHasher = HASHER):
+        self.contact_id = contact_id
+        self.capacity = capacity
+        self.hasher = hasher
+        self.rows = len(hasher.permutations) // BANDS
+        self.facts: Dict[str, Fact] = {}
+        self.signatures: Dict[str, Signature] = {}
+        self.buckets: Dict[Tuple[int, Signature], Set[str]] = {}
+        self.unchecked: Set[str] = set() # facts not yet looked at for consolidation, everything loaded is
+        self.ordered: Optional[List[Fact]] = None
+        for fact in facts:
+            self.put(fact)
+
+    def get_bands(self, signature: Signature) -> Iterable[Tuple[int, Signature]]:
+        return ((i, signature[i * self.rows:(i + 1) * self.rows]) for i in range(BANDS))
+
+    def put(self, fact: Fact, checked: bool = False):
+        # adds or replaces a fact, a new text needs checking for consolidation again
+        existing = self.facts.get(fact.id)
+        self.ordered = None
+        if existing is not None and existing.content == fact.content:
+            self.facts[fact.id] = fact
+            return
+        self.remove(fact.id)
+        signature = self.hasher.get_signature(fact.content)
+        self.facts[fact.id] = fact
+        self.signatures[fact.id] = signature
+        for band in self.get_bands(signature):
+            self.buckets.setdefault(band, set()).add(fact.id)
+        if not checked:
+            self.unchecked.add(fact.id)
+
+    def remove(self, fact_id: str):
+        signature = self.signatures.pop(fact_id, None)
+        if signature is None:
+            return
+        del self.facts[fact_id]
+        self.unchecked.discard(fact_id)
+        self.ordered = None
+        for band in self.get_bands(signature):
+            bucket = self.buckets[band]
+            bucket.discard(fact_id)
+            if not bucket:
+                del self.buckets[band]
+
+    def get_similar(self, signature: Signature, threshold: float, exclude: Optional[str] = None) -> List[Tuple[float, Fact]]:
+        # most similar first
+        candidates = set().union(*(self.buckets.get(band, ()) for band in self.get_bands(signature)))
+        candidates.discard(exclude)
+        similar = [(get_similarity(signature, self.signatures[i]), self.facts[i]) for i in candidates]
+        return sorted(((s, f) for s, f in similar if s >= threshold), key=lambda sf: -sf[0])
+
+    def remember(self, content: str, now: Optional[datetime] = None) -> Tuple[Fact, bool]:
+        # the fact to write for `content` and whether it's a near duplicate of one already known, which comes back reinforced
+        # rather than as a new fact. both are new objects, the memory itself changes when they're put after the commit
+        now = now or datetime.now(tz=UTC)
+        similar = self.get_similar(self.hasher.get_signature(content), DUPLICATE_THRESHOLD)
+        if similar:
+            _, existing = similar[0]
+            return Fact(id=existing.id, content=existing.content, timestamp=existing.timestamp, mentions=existing.mentions + 1, last_seen=now, contact_id=self.contact_id), True
+        return Fact(content=content, timestamp=now, last_seen=now, contact_id=self.contact_id), False
+
+    def get_facts(self) -> List[Fact]:
+        # oldest first, so new facts go at the end of the prompt's facts section and reinforcing one doesn't move anything
+        if self.ordered is None:
+            self.ordered = sorted(self.facts.values(), key=lambda f: (as_utc(f.timestamp), f.id))
+        return self.ordered
+
+    def get_clusters(self) -> List[List[Fact]]:
+        # groups of related facts that include at least one unchecked fact, each oldest first
+        parents: Dict[str, str] = {}
+
+        def find(i: str) -> str:
+            while parents.setdefault(i, i) != i:
+                i = parents[i]
+            return i
+
+        for i in self.unchecked:
+            for _, fact in self.get_similar(self.signatures[i], RELATED_THRESHOLD, exclude=i):
+                parents[find(fact.id)] = find(i)
+
+        clusters: Dict[str, List[Fact]] = {}
+        for i in parents:
+            clusters.setdefault(find(i), []).append(self.facts[i])
+        return [sorted(c, key=lambda f: (as_utc(f.timestamp), f.id)) for c in clusters.values()]
+
+    def consolidate(self, cluster: List[Fact], contents: List[str]) -> List[Fact]:
+        # the facts that replace a cluster, in place of its oldest so the facts section before it stays the same
+        mentions = sum(f.mentions for f in cluster) if len(contents) == 1 else max(f.mentions for f in cluster)
+        last_seen = max(as_utc(f.last_seen) for f in cluster)
+        return [Fact(content=c, timestamp=as_utc(cluster[0].timestamp), mentions=mentions, last_seen=last_seen, contact_id=self.contact_id) for c in contents]
+
+    def get_score(self, fact: Fact, now: datetime) -> float:
+        age_days = max((now - as_utc(fact.last_seen)).total_seconds(), 0) / 86400
+        return fact.mentions * 0.5 ** (age_days / FACT_HALF_LIFE_DAYS)
+
+    def get_evictions(self, now: Optional[datetime] = None) -> List[Fact]:
+        # the lowest scoring facts over capacity, by mentions decayed by the time since the fact last came up
+        now = now or datetime.now(tz=UTC)
+        over = len(self.facts) - self.capacity
+        if over <= 0:
+            return []
+        return sorted(self.facts.values(), key=lambda f: (self.get_score(f, now), as_utc(f.timestamp)))[:over]
+
+    @property
+    def needs_consolidation(self) -> bool:
+        return len(self.facts) > self.capacity or any(self.get_similar(self.signatures[i], RELATED_THRESHOLD, exclude=i) for i in self.unchecked)
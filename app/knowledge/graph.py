@@ -0,0 +1,241 @@
+import heapq
+import math
+import re
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+
+ALPHA = 0.15 # teleport probability
+EPSILON = 1e-6 # push threshold per neighbor of the global rank
+TURN_EPSILON = 1e-4 # coarser threshold for the per turn rank, which is recomputed every turn
+TURN_SEEDS = 32 # most entities a turn's rank is personalized to
+TURN_WEIGHT = 4.0 # how much more the entities the current turn mentions count than overall relevance to the user
+RECENCY_HALF_LIFE_DAYS = 30
+
+SELF_ENTITY = "user"
+SELF_REFERENCES = {"i", "me", "myself", "user", "the user"}
+STOPWORDS = {"the", "and", "for", "with", "you", "your", "that", "this", "are", "was", "have", "has", "but", "not", "what", "about", "just", "like"}
+
+
+def normalize_entity(name: str) -> str:
+    normalized = " ".join(re.sub(r"[^\w\s'-]", " ", name.lower()).split())
+    if normalized in SELF_REFERENCES:
+        return SELF_ENTITY
+    for article in ("the ", "a ", "an "):
+        if normalized.startswith(article):
+            return normalized[len(article):]
+    return normalized
+
+
+def normalize_predicate(predicate: str) -> str:
+    return " ".join(predicate.lower().split())
+
+
+def get_tokens(text: str) -> Set[str]:
+    return {t for t in re.findall(r"\w+", text.lower()) if len(t) > 2 and t not in STOPWORDS}
+
+
+class KnowledgeTriple():
+    __slots__ = ("id", "subject", "predicate", "object", "importance", "mentions", "timestamp")
+
+    def __init__(self, id: str, subject: str, predicate: str, object: str, importance: int, mentions: int = 1, timestamp: Optional[float] = None):
+        self.id = id
+        self.subject = subject # entity ids
+        self.predicate = predicate
+        self.object = object
+        self.importance = importance
+        self.mentions = mentions
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+
+def forward_push(adjacency: Dict[str, Dict[str, float]], degree: Dict[str, float], seeds: Dict[str, float], rank: Dict[str, float], residual: Dict[str, float], queue: Deque[str], alpha: float, epsilon: float):
+    # moves residual mass into rank until every node's residual is under epsilon per neighbor. keeps the invariant
+    # rank(u) + alpha * residual(u) = alpha * seeds(u) + (1 - alpha) * sum over x of rank(x) * P(x, u)
+    # where P spreads by edge weight, and nodes without edges send everything back to the seeds
+    queued = set(queue)
+    while queue:
+        u = queue.popleft()
+        queued.discard(u)
+        r = residual.get(u, 0.0)
+        if abs(r) <= epsilon * max(len(adjacency.get(u, ())), 1):
+            continue
+        residual[u] = 0.0
+        rank[u] = rank.get(u, 0.0) + alpha * r
+        neighbors = adjacency.get(u)
+        targets = ((v, w / degree[u]) for v, w in neighbors.items()) if neighbors else seeds.items()
+        for v, share in targets:
+            residual[v] = residual.get(v, 0.0) + (1 - alpha) * r * share
+            if v not in queued and abs(residual[v]) > epsilon * max(len(adjacency.get(v, ())), 1):
+                queue.append(v)
+                queued.add(v)
+
+
+class KnowledgeGraph():
+    def __init__(self, alpha: float = ALPHA, epsilon: float = EPSILON):
+        self.alpha = alpha
+        self.epsilon = epsilon
+
+        self.names: Dict[str, str] = {} # entity id -> display name
+        self.entity_ids: Dict[str, str] = {} # normalized name -> entity id
+        self.entity_tokens: Dict[str, Set[str]] = {} # name (and incoming predicate) token -> entity ids
+        self.triples: Dict[Tuple[str, str, str], KnowledgeTriple] = {} # (subject id, predicate, object id)
+        self.incident: Dict[str, List[KnowledgeTriple]] = {}
+
+        # undirected, weighted by the summed importance of every mention of every triple between two entities
+        self.adjacency: Dict[str, Dict[str, float]] = {}
+        self.degree: Dict[str, float] = {}
+
+        # personalized pagerank from the user entity, kept up to date as edges arrive
+        self.seed: Optional[str] = None
+        self.rank: Dict[str, float] = {}
+        self.residual: Dict[str, float] = {}
+        self.queue: Deque[str] = deque()
+
+        self.version = 0
+        self.top_nodes_cache: Optional[List[str]] = None
+        self.top_incident_cache: Dict[str, List[KnowledgeTriple]] = {}
+
+    def __len__(self):
+        return len(self.triples)
+
+    def add_entity(self, name: str, entity_id: Optional[str] = None) -> Tuple[str, bool]:
+        normalized = normalize_entity(name)
+        if normalized in self.entity_ids:
+            return self.entity_ids[normalized], False
+
+        entity_id = entity_id or str(uuid.uuid4())
+        self.entity_ids[normalized] = entity_id
+        self.names[entity_id] = SELF_ENTITY if normalized == SELF_ENTITY else name.strip()
+        for token in get_tokens(normalized):
+            self.entity_tokens.setdefault(token, set()).add(entity_id)
+        if normalized == SELF_ENTITY and self.seed is None:
+            # every rank is still zero here, so starting all the mass on the seed satisfies the invariant
+            self.seed = entity_id
+            self.residual[entity_id] = 1.0
+            self.queue.append(entity_id)
+        return entity_id, True
+
+    def add_triple(self, subject: str, predicate: str, object: str, importance: int, timestamp: Optional[float] = None, triple_id: Optional[str] = None, mentions: int = 1, push: bool = True) -> Tuple[Optional[KnowledgeTriple], List[str]]:
+        # returns the new or reinforced triple, or None if it was dropped, and the ids of entities it created
+        subject_id, subject_created = self.add_entity(subject)
+        object_id, object_created = self.add_entity(object)
+        created = [e for e, c in ((subject_id, subject_created), (object_id, object_created)) if c]
+        predicate = normalize_predicate(predicate)
+        if subject_id == object_id or not predicate:
+            return None, created
+
+        key = (subject_id, predicate, object_id)
+        triple = self.triples.get(key)
+        if triple is None:
+            triple = KnowledgeTriple(triple_id or str(uuid.uuid4()), subject_id, predicate, object_id, importance, mentions, timestamp)
+            self.triples[key] = triple
+            self.incident.setdefault(subject_id, []).append(triple)
+            self.incident.setdefault(object_id, []).append(triple)
+            for token in get_tokens(predicate):
+                self.entity_tokens.setdefault(token, set()).add(object_id) # "enjoys films" makes the object a film
+        else:
+            triple.importance = max(triple.importance, importance)
+            triple.mentions += mentions
+            triple.timestamp = max(triple.timestamp, timestamp or time.time())
+
+        self.add_edge(subject_id, object_id, float(importance * mentions))
+        if push:
+            self.push()
+        self.version += 1
+        self.top_nodes_cache = None
+        self.top_incident_cache.clear()
+        return triple, created
+
+    def add_edge(self, u: str, v: str, weight: float):
+        for x, y in ((u, v), (v, u)):
+            self.update_out_edge(x, y, weight)
+            neighbors = self.adjacency.setdefault(x, {})
+            neighbors[y] = neighbors.get(y, 0.0) + weight
+            self.degree[x] = self.degree.get(x, 0.0) + weight
+
+    def update_out_edge(self, x: str, y: str, weight: float):
+        # restores the push invariant in O(1) before x's transition row changes (Zhang, Lofgren and Goel, 2016).
+        # scaling rank(x) by W_old / W_new leaves every old neighbor's share unchanged, so only x and y need fixing
+        if self.seed is None:
+            return
+        p = self.rank.get(x, 0.0)
+        if p == 0.0:
+            return
+        old_degree = self.degree.get(x, 0.0)
+        if old_degree == 0.0:
+            # x used to send its mass back to the seed, now it all goes to y
+            self.adjust_residual(self.seed, -(1 - self.alpha) * p / self.alpha)
+            self.adjust_residual(y, (1 - self.alpha) * p / self.alpha)
+            return
+        delta = p * weight / old_degree
+        self.rank[x] = p + delta
+        self.adjust_residual(x, -delta / self.alpha)
+        self.adjust_residual(y, (1 - self.alpha) * delta / self.alpha)
+
+    def adjust_residual(self, node: str, amount: float):
+        self.residual[node] = self.residual.get(node, 0.0) + amount
+        self.queue.append(node)
+
+    def push(self):
+        if self.seed is not None:
+            forward_push(self.adjacency, self.degree, {self.seed: 1.0}, self.rank, self.residual, self.queue, self.alpha, self.epsilon)
+
+    def get_turn_rank(self, text: str) -> Dict[str, float]:
+        # a coarse rank personalized to the entities the current turn mentions, computed locally around them
+        matches: Dict[str, float] = {}
+        for token in get_tokens(text):
+            for entity_id in self.entity_tokens.get(token, ()):
+                matches[entity_id] = matches.get(entity_id, 0.0) + 1.0
+        if not matches:
+            return {}
+        if len(matches) > TURN_SEEDS:
+            matches = {e: matches[e] for e in heapq.nlargest(TURN_SEEDS, matches, key=lambda e: (matches[e], self.rank.get(e, 0.0)))}
+        total = sum(matches.values())
+        seeds = {e: m / total for e, m in matches.items()}
+        rank: Dict[str, float] = {}
+        forward_push(self.adjacency, self.degree, seeds, rank, dict(seeds), deque(seeds), self.alpha, TURN_EPSILON)
+        return rank
+
+    def get_top_nodes(self, n: int) -> List[str]:
+        if self.top_nodes_cache is None or len(self.top_nodes_cache) < n:
+            self.top_nodes_cache = heapq.nlargest(n, self.rank, key=self.rank.get)
+        return self.top_nodes_cache[:n]
+
+    def get_top_incident(self, node: str, n: int) -> List[KnowledgeTriple]:
+        cached = self.top_incident_cache.get(node)
+        if cached is None or len(cached) < n:
+            cached = heapq.nlargest(n, self.incident.get(node, ()), key=lambda t: (t.importance, t.timestamp))
+            self.top_incident_cache[node] = cached
+        return cached[:n]
+
+    def get_relevant_triples(self, text: str, k: int = 10, now: Optional[float] = None) -> List[KnowledgeTriple]:
+        # scores triples by the rank of their entities (global plus this turn), importance and recency
+        now = now or time.time()
+        turn_rank = self.get_turn_rank(text)
+        nodes = set(self.get_top_nodes(k * 4)) | set(heapq.nlargest(k * 4, turn_rank, key=turn_rank.get))
+        candidates = {t.id: t for node in nodes for t in self.get_top_incident(node, k * 4)}
+
+        def get_node_score(node: str) -> float:
+            # the user is on nearly every triple, so their own rank would only drown out the other end
+            return 0.0 if node == self.seed else self.rank.get(node, 0.0) + TURN_WEIGHT * turn_rank.get(node, 0.0)
+
+        def score(t: KnowledgeTriple) -> float:
+            relevance = get_node_score(t.subject) + get_node_score(t.object)
+            recency = 0.5 + 0.5 * math.pow(0.5, (now - t.timestamp) / 86400 / RECENCY_HALF_LIFE_DAYS)
+            return relevance * t.importance * recency
+
+        return heapq.nlargest(k, candidates.values(), key=score)
+
+    def describe(self, triple: KnowledgeTriple) -> str:
+        return f"{self.names[triple.subject]} {triple.predicate} {self.names[triple.object]}"
+
+    def load(self, entities: Iterable[Tuple[str, str]], triples: Iterable[Tuple[str, str, str, str, int, int, float]]):
+        # bulk load of (id, name) entities and (id, subject id, predicate, object id, importance, mentions, timestamp)
+        # triples, with a single push at the end
+        for entity_id, name in entities:
+            self.add_entity(name, entity_id)
+        for triple_id, subject_id, predicate, object_id, importance, mentions, timestamp in triples:
+            self.add_triple(self.names[subject_id], predicate, self.names[object_id], importance, timestamp, triple_id, mentions, push=False)
+        self.push()
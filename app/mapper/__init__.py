@@ -1,3 +1,3 @@
-from .anthropic import messages_to_anthropic_message, anthropic_messages_to_messages
+from .anthropic import MessageMapper, messages_to_anthropic_message, anthropic_messages_to_messages
 
-__all__ = ["messages_to_anthropic_message", "anthropic_messages_to_messages"]
\ No newline at end of file
+__all__ = ["MessageMapper", "messages_to_anthropic_message", "anthropic_messages_to_messages"]
\ No newline at end of file
@@ -1,27 +1,83 @@
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
 import anthropic
 
-from app.model import Message, MessageType, Role, Contact
+from app.model import Message, AnyMessage, MessageType, Role, Contact
 
 
-def messages_to_anthropic_message(messages: List[Message]) -> List[anthropic.types.MessageParam]:
-    results = []
+EPHEMERAL = {"type": "ephemeral"}
 
-    for i, message in enumerate(messages):
-        cache_control = None
-        if i == len(messages) - 1:
-            cache_control = {"type": "ephemeral"}
 
-        if message.message_type == MessageType.CHAT:
-            results.append(anthropic.types.MessageParam(role=message.role.value, content=[anthropic.types.TextBlockParam(type="text", text=message.content, cache_control=cache_control)]))
-        elif message.message_type == MessageType.TOOL_USE:
-            if message.role == Role.ASSISTANT:
-                results.append(anthropic.types.MessageParam(role=message.role.value, content=[anthropic.types.ToolUseBlockParam(id=message.tool_use_id, name=message.tool_use_name, input=message.tool_use_input, type="tool_use", cache_control=cache_control)]))
-            elif message.role == Role.USER:
-                results.append(anthropic.types.MessageParam(role=message.role.value, content=[anthropic.types.ToolResultBlockParam(tool_use_id=message.tool_use_id, content=message.content, type="tool_result", cache_control=cache_control)]))
-    
-    return results
+def message_to_block(message: AnyMessage) -> Optional[dict]:
+    if message.message_type == MessageType.CHAT:
+        return anthropic.types.TextBlockParam(type="text", text=message.content)
+    elif message.message_type == MessageType.TOOL_USE:
+        if message.role == Role.ASSISTANT:
+            return anthropic.types.ToolUseBlockParam(id=message.tool_use_id, name=message.tool_use_name, input=message.tool_use_input, type="tool_use")
+        elif message.role == Role.USER:
+            return anthropic.types.ToolResultBlockParam(tool_use_id=message.tool_use_id, content=message.content, type="tool_result")
+    return None
+
+
+class MessageMapper():
+    # maps one contact's history turn after turn. between trims history only grows at the end, so a call converts just the
+    # messages it hasn't seen, and consecutive messages from one role go out as one api message. results share their blocks
+    # with each other and with later calls, anything that changes one has to copy it first
+    def __init__(self):
+        self.blocks: Dict[str, dict] = {} # message id -> block, without cache_control
+        self.ids: List[str] = []
+        self.results: List[anthropic.types.MessageParam] = []
+        self.positions: List[Optional[Tuple[int, int]]] = [] # per message, (index into results, index into its content)
+
+    def get_block(self, message: AnyMessage) -> Optional[dict]:
+        block = self.blocks.get(message.id)
+        if block is None:
+            block = self.blocks[message.id] = message_to_block(message)
+        return block
+
+    def append(self, message: AnyMessage):
+        self.ids.append(message.id)
+        block = self.get_block(message)
+        if block is None:
+            self.positions.append(None)
+            return
+
+        role = message.role.value
+        last = self.results[-1] if self.results else None
+        # tool results have to lead their user message, so one never joins a message that has anything else
+        if last and last["role"] == role and (block["type"] != "tool_result" or all(b["type"] == "tool_result" for b in last["content"])):
+            self.results[-1] = anthropic.types.MessageParam(role=role, content=[*last["content"], block]) # a copy, earlier results still hold the old one
+        else:
+            self.results.append(anthropic.types.MessageParam(role=role, content=[block]))
+        self.positions.append((len(self.results) - 1, len(self.results[-1]["content"]) - 1))
+
+    def map(self, messages: List[AnyMessage], cache_breakpoints: Optional[Set[int]] = None) -> List[anthropic.types.MessageParam]:
+        # cache_breakpoints are indexes into messages that get a cache_control marker, defaulting to the last message
+        n = len(self.ids)
+        if not n or len(messages) < n or messages[0].id != self.ids[0] or messages[n - 1].id != self.ids[-1]:
+            # first call, trimmed from the front or a turn that was never committed. still cached blocks are reused
+            self.blocks = {m.id: self.blocks[m.id] for m in messages if m.id in self.blocks}
+            self.ids, self.results, self.positions = [], [], []
+            n = 0
+        for message in messages[n:]:
+            self.append(message)
+
+        if cache_breakpoints is None:
+            cache_breakpoints = {len(messages) - 1}
+        results = list(self.results)
+        for i in cache_breakpoints:
+            position = self.positions[i] if 0 <= i < len(messages) else None
+            if position is None:
+                continue
+            r, b = position
+            content = list(results[r]["content"])
+            content[b] = {**content[b], "cache_control": EPHEMERAL}
+            results[r] = anthropic.types.MessageParam(role=results[r]["role"], content=content)
+        return results
+
+
+def messages_to_anthropic_message(messages: List[AnyMessage], cache_breakpoints: Optional[Set[int]] = None) -> List[anthropic.types.MessageParam]:
+    return MessageMapper().map(messages, cache_breakpoints)
 
 
 def anthropic_messages_to_messages(messages: List[anthropic.types.MessageParam], contact_id: str, conversation_id: str) -> List[Message]:
@@ -1,3 +1,5 @@
-from .model import Role, MessageType, Message, Conversation, Contact, Fact
+from .model import Role, MessageType, Message, Conversation, Contact, Fact, RollupPeriod, ConversationRollup, ConversationArchive, Entity, Triple, ExtractionCheckpoint
+from .records import MessageRecord, AnyMessage
+from .tokens import estimate_tokens, estimate_message_tokens
 
-__all__ = ['Role', 'MessageType', 'Message', 'Conversation', 'Contact', 'Fact']
\ No newline at end of file
+__all__ = ['Role', 'MessageType', 'Message', 'MessageRecord', 'AnyMessage', 'Conversation', 'Contact', 'Fact', 'RollupPeriod', 'ConversationRollup', 'ConversationArchive', 'Entity', 'Triple', 'ExtractionCheckpoint', 'estimate_tokens', 'estimate_message_tokens']
\ No newline at end of file
@@ -2,6 +2,7 @@ from datetime import datetime, UTC
 from typing import Optional, List
 from enum import Enum
 from sqlmodel import SQLModel, Field, Relationship, JSON
+from sqlalchemy import Index
 import uuid
 
 
@@ -16,6 +17,11 @@ class MessageType(str, Enum):
 
 
 class Message(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_message_contact_id_timestamp", "contact_id", "timestamp", "id"),
+        Index("ix_message_conversation_id_timestamp_id", "conversation_id", "timestamp", "id"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     timestamp: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
     role: Role
@@ -25,12 +31,17 @@ class Message(SQLModel, table=True):
     tool_use_id: Optional[str] = None
     tool_use_name: Optional[str] = None
     tool_use_input: Optional[dict] = Field(default=None, sa_type=JSON)
+    token_estimate: int = 0 # set by the repository on insert, see app.model.tokens
 
     conversation_id: str = Field(foreign_key="conversation.id")
     contact_id: str = Field(foreign_key="contact.id")
 
 
 class Conversation(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_conversation_contact_id_start_time", "contact_id", "start_time"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     start_time: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
     end_time: Optional[datetime] = None
@@ -39,14 +50,104 @@ class Conversation(SQLModel, table=True):
     contact_id: str = Field(foreign_key="contact.id")
 
 
+class RollupPeriod(str, Enum):
+    DAY = "day"
+    WEEK = "week" # monday to sunday, clipped to the month so weeks nest inside months
+    MONTH = "month"
+    YEAR = "year"
+
+
+class ConversationRollup(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_conversationrollup_contact_id_period_start", "contact_id", "period", "period_start"),
+    )
+
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    period: RollupPeriod
+    period_start: datetime
+    summary: str
+    source_count: int # conversations (for days) or rollups of the period below that were condensed
+    source_updated: datetime # latest end_time or updated_at among the sources, to spot stale rollups
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+
+    contact_id: str = Field(foreign_key="contact.id")
+
+
 class Fact(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_fact_contact_id_timestamp", "contact_id", "timestamp"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     content: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+    mentions: int = 1 # times it was remembered, near duplicates count towards the fact they duplicate
+    last_seen: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+
+    contact_id: str = Field(foreign_key="contact.id")
+
+
+class ConversationArchive(SQLModel, table=True):
+    # the messages of a closed conversation, moved out of the message table. see app.repository.archive
+    __table_args__ = (
+        Index("ix_conversationarchive_contact_id_start_time", "contact_id", "start_time"),
+    )
+
+    conversation_id: str = Field(foreign_key="conversation.id", primary_key=True)
+    start_time: datetime # the conversation's, no message in the archive is older
+    message_count: int
+    data: bytes # zlib compressed json rows
+    archived_at: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+
+    contact_id: str = Field(foreign_key="contact.id")
+
+
+class Entity(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_entity_contact_id_normalized_name", "contact_id", "normalized_name", unique=True),
+    )
+
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    name: str
+    normalized_name: str # see app.knowledge.normalize_entity
+
+    contact_id: str = Field(foreign_key="contact.id")
+
+
+class Triple(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_triple_contact_id_subject_id", "contact_id", "subject_id", "predicate", "object_id"),
+    )
+
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    subject_id: str = Field(foreign_key="entity.id")
+    predicate: str
+    object_id: str = Field(foreign_key="entity.id")
+    importance: int
+    mentions: int = 1
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+
+    contact_id: str = Field(foreign_key="contact.id")
+
+
+class ExtractionCheckpoint(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_extractioncheckpoint_contact_id", "contact_id"),
+    )
+
+    conversation_id: str = Field(foreign_key="conversation.id", primary_key=True)
+    message_count: int
+    chunk_count: int
+    triple_count: int
+    processed_at: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
 
     contact_id: str = Field(foreign_key="contact.id")
 
 
 class Contact(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_contact_name", "name"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     name: str
@@ -0,0 +1,40 @@
+import json
+import sys
+from datetime import datetime
+from typing import Optional, Union
+
+from .model import Role, MessageType, Message
+
+
+UNDECODED = object()
+
+
+class MessageRecord():
+    # a message as read back for history, without the pydantic and orm state a Message carries. reads only, anything that
+    # writes works with Message. tool_use_input stays the stored json until something reads it, most history never does
+    __slots__ = ("id", "timestamp", "role", "message_type", "content", "tool_use_id", "tool_use_name", "token_estimate", "conversation_id", "tool_use_json", "decoded_input")
+
+    def __init__(self, id: str, timestamp: datetime, role: Role, message_type: MessageType, content: str, tool_use_id: Optional[str], tool_use_name: Optional[str], tool_use_json: Optional[str], token_estimate: int, conversation_id: str):
+        self.id = id
+        self.timestamp = timestamp
+        self.role = role
+        self.message_type = message_type
+        self.content = content
+        self.tool_use_id = tool_use_id
+        self.tool_use_name = tool_use_name
+        self.tool_use_json = None if tool_use_json == "null" else tool_use_json
+        self.decoded_input = UNDECODED
+        self.token_estimate = token_estimate
+        self.conversation_id = sys.intern(conversation_id) # shared by every message in the conversation
+
+    @property
+    def tool_use_input(self) -> Optional[dict]:
+        if self.decoded_input is UNDECODED:
+            self.decoded_input = json.loads(self.tool_use_json) if self.tool_use_json is not None else None
+        return self.decoded_input
+
+    def __repr__(self) -> str:
+        return f"MessageRecord(id={self.id!r}, role={self.role.value}, message_type={self.message_type.value}, content={self.content[:40]!r})"
+
+
+AnyMessage = Union[Message, MessageRecord] # history mixes rows read back with messages written this turn
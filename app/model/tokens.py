@@ -0,0 +1,15 @@
+import json
+from typing import Optional
+
+
+CHARS_PER_TOKEN = 4 # close enough for english chat, the budgets leave headroom for the error
+MESSAGE_OVERHEAD_TOKENS = 4 # role and block framing
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    return len(text) // CHARS_PER_TOKEN if text else 0
+
+
+def estimate_message_tokens(content: Optional[str], tool_use_input: Optional[dict] = None) -> int:
+    # must agree with the backfill in migrations.py, which measures the stored json the same way
+    return MESSAGE_OVERHEAD_TOKENS + (len(content or "") + (len(json.dumps(tool_use_input)) if tool_use_input is not None else 0)) // CHARS_PER_TOKEN
@@ -0,0 +1,3 @@
+from .triples import TriplePipeline, get_fake_triples
+
+__all__ = ['TriplePipeline', 'get_fake_triples']
\ No newline at end of file
@@ -0,0 +1,17 @@
+import argparse
+import asyncio
+
+from .triples import main, CHUNK_TOKENS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extract knowledge graph triples from a contact's conversations, resuming from the last run")
+    parser.add_argument("--contact", default="ravens")
+    parser.add_argument("--db", default="sqlite+aiosqlite:///yui.db")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--include-open", action="store_true", help="also extract from the conversation that is still going")
+    parser.add_argument("--fake", action="store_true", help="use a local fake model instead of the api")
+    parser.add_argument("--fake-latency", type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
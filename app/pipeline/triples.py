@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import re
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from anthropic.types import ToolUseBlock
+
+from app.repository import Repository
+from app.model import Conversation, ExtractionCheckpoint, MessageRecord, MessageType, Role
+from app.gateway import CompletionGateway, RequestScheduler, ActionType
+from app.backend import ScriptedBackend, tool_use
+from app.knowledge import normalize_entity, normalize_predicate
+
+
+CHUNK_TOKENS = 6000 # corpus per extract_triples request, leaves room for the tool schema and the response
+
+
+@dataclass
+class PipelineStats():
+    conversations: int = 0
+    skipped: int = 0
+    chunks: int = 0
+    triples: int = 0
+    elapsed: float = 0.0
+
+
+def format_line(message: MessageRecord) -> str:
+    return f"{'assistant' if message.role == Role.ASSISTANT else 'user'}: {message.content}"
+
+
+def merge_triples(chunk_triples: List[List[dict]]) -> List[dict]:
+    # the same fact usually comes out of several chunks, keep one copy at its highest importance
+    merged: Dict[Tuple[str, str, str], dict] = {}
+    for triples in chunk_triples:
+        for t in triples:
+            key = (normalize_entity(t['subject']), normalize_predicate(t['predicate']), normalize_entity(t['object']))
+            if key not in merged or t['importance'] > merged[key]['importance']:
+                merged[key] = t
+    return list(merged.values())
+
+
+class TriplePipeline():
+    def __init__(self, repository: Repository, completion_gateway: CompletionGateway, concurrency: int = 4, chunk_tokens: int = CHUNK_TOKENS, batch_size: int = 500):
+        self.repository = repository
+        self.completion_gateway = completion_gateway
+        self.chunk_tokens = chunk_tokens
+        self.batch_size = batch_size
+        self.requests = asyncio.Semaphore(concurrency) # extract_triples calls in flight
+        self.conversations = asyncio.Semaphore(concurrency * 2) # conversations with chunks in memory
+        self.write_lock = asyncio.Lock()
+        self.stats = PipelineStats()
+
+    async def get_chunks(self, conversation: Conversation) -> AsyncIterator[Tuple[str, int]]:
+        # yields (corpus, message count) chunks of a conversation's chat messages, split on the token budget
+        lines, tokens, count = [], 0, 0
+        async for batch in self.repository.iter_conversation_messages(conversation.id, self.batch_size):
+            for message in batch:
+                if message.message_type != MessageType.CHAT:
+                    continue
+                if lines and tokens + message.token_estimate > self.chunk_tokens:
+                    yield '\n'.join(lines), count
+                    lines, tokens, count = [], 0, 0
+                lines.append(format_line(message))
+                tokens += message.token_estimate
+                count += 1
+        if lines:
+            yield '\n'.join(lines), count
+
+    async def extract(self, corpus: str) -> List[dict]:
+        async with self.requests:
+            return await self.completion_gateway.extract_triples(corpus)
+
+    async def process_conversation(self, conversation: Conversation):
+        async with self.conversations:
+            tasks, message_count = [], 0
+            async for corpus, count in self.get_chunks(conversation):
+                tasks.append(asyncio.create_task(self.extract(corpus)))
+                message_count += count
+            triples = merge_triples(await asyncio.gather(*tasks))
+
+            async with self.write_lock:
+                if triples:
+                    await self.completion_gateway.add_triples(conversation.contact_id, triples)
+                # only written once the triples are, so an interrupted run redoes this conversation
+                await self.repository.create_checkpoint(ExtractionCheckpoint(conversation_id=conversation.id, contact_id=conversation.contact_id, message_count=message_count, chunk_count=len(tasks), triple_count=len(triples)))
+            self.stats.conversations += 1
+            self.stats.chunks += len(tasks)
+            self.stats.triples += len(triples)
+
+    async def run(self, contact_id: str, include_open: bool = False) -> PipelineStats:
+        started = time.perf_counter()
+        done = await self.repository.get_checkpointed_conversations(contact_id)
+        conversations = await self.repository.get_conversations(contact_id) # newest first
+        # the open conversation is still growing, it gets picked up once a topic change closes it
+        pending = [c for i, c in enumerate(conversations) if c.id not in done and (include_open or c.end_time or i > 0)]
+        self.stats.skipped = len(conversations) - len(pending)
+        await asyncio.gather(*(self.process_conversation(c) for c in reversed(pending)))
+        self.stats.elapsed = time.perf_counter() - started
+        return self.stats
+
+
+def get_fake_triples(request: dict) -> List[ToolUseBlock]:
+    # stands in for the model offline: "extracts" a triple per capitalized phrase
+    corpus = request['messages'][-1]['content']
+    triples = [{'subject': 'user', 'predicate': 'mentioned', 'object': phrase, 'importance': 1 + len(phrase) % 10} for phrase in re.findall(r"(?<=[a-z] )[A-Z][\w'-]+(?: [A-Z][\w'-]+)*", corpus)]
+    return [tool_use(ActionType.EXTRACT_TRIPLES.value, {'triples': triples})]
+
+
+async def main(args: argparse.Namespace):
+    async with Repository(args.db) as repository:
+        contact = await repository.get_contact(args.contact)
+        if not contact:
+            raise SystemExit(f"no contact named {args.contact!r}")
+
+        if args.fake:
+            fake = ScriptedBackend(get_fake_triples, latency=args.fake_latency)
+            completion_gateway = CompletionGateway(repository, backend=fake, scheduler=RequestScheduler(fake, requests_per_minute=1e9, tokens_per_minute=1e12, max_concurrency=args.concurrency)) # no rate limits offline
+        else:
+            completion_gateway = CompletionGateway(repository)
+        pipeline = TriplePipeline(repository, completion_gateway, concurrency=args.concurrency, chunk_tokens=args.chunk_tokens, batch_size=args.batch_size)
+        stats = await pipeline.run(contact.id, include_open=args.include_open)
+        print(f"{stats.conversations} conversations ({stats.skipped} already done or still open), {stats.chunks} chunks, {stats.triples} triples in {stats.elapsed:.2f}s")
+
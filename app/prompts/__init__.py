@@ -1,3 +1,3 @@
-from .prompts import get_chat_system_prompt, get_facts_prompt, get_prior_conversations_prompt, BASE_SYSTEM_PROMPT
+from .prompts import get_chat_system_prompt, get_facts_prompt, get_prior_conversations_prompt, get_persona_prompt, get_facts_section, get_prior_conversations_section, get_knowledge_prompt, get_recall_prompt, get_current_time_prompt, BASE_SYSTEM_PROMPT
 
-__all__ = ["get_chat_system_prompt", "get_facts_prompt", "get_prior_conversations_prompt", "BASE_SYSTEM_PROMPT"]
\ No newline at end of file
+__all__ = ["get_chat_system_prompt", "get_facts_prompt", "get_prior_conversations_prompt", "get_persona_prompt", "get_facts_section", "get_prior_conversations_section", "get_knowledge_prompt", "get_recall_prompt", "get_current_time_prompt", "BASE_SYSTEM_PROMPT"]
\ No newline at end of file
@@ -1,6 +1,6 @@
-from typing import List
+from typing import List, Union
 
-from app.model import Fact, Conversation
+from app.model import Fact, Conversation, ConversationRollup, RollupPeriod
 from app.constants import UTC, DEFAULT_TIMEZONE 
 
 
@@ -21,24 +21,65 @@ def get_facts_prompt(facts: List[Fact]) -> str:
         return '- you have no known facts about the user yet and have likely never spoken before. You should ask the user about themselves, including their name!'
 
 
-def get_prior_conversations_prompt(prior_conversations: List[Conversation]) -> str:
+ROLLUP_PERIOD_FORMATS = {
+    RollupPeriod.DAY: 'on %B %d, %Y',
+    RollupPeriod.WEEK: 'the week of %B %d, %Y',
+    RollupPeriod.MONTH: 'during %B %Y',
+    RollupPeriod.YEAR: 'during %Y',
+}
+
+
+def get_prior_conversation_line(c: Union[Conversation, ConversationRollup]) -> str:
+    if isinstance(c, ConversationRollup):
+        return f"- {c.summary} ({c.period_start.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime(ROLLUP_PERIOD_FORMATS[c.period])})\n"
+    return f"- {c.summary} ({c.start_time.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime('%B %d, %Y at %I:%M %p PT')} - {c.end_time.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime('%B %d, %Y at %I:%M %p PT')})\n"
+
+
+def get_prior_conversations_prompt(prior_conversations: List[Union[Conversation, ConversationRollup]]) -> str:
+    # rollups stand in for older conversations, see app.gateway.rollup
     if prior_conversations:
-        return "\n".join(f"- {c.summary} ({c.start_time.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime('%B %d, %Y at %I:%M %p PT')} - {c.end_time.replace(tzinfo=UTC).astimezone(tz=DEFAULT_TIMEZONE).strftime('%B %d, %Y at %I:%M %p PT')})\n" for c in prior_conversations)
+        return "\n".join(get_prior_conversation_line(c) for c in prior_conversations)
     else:
         return '- you have no prior conversations with this user.'
 
 
-def get_chat_system_prompt(facts, prior_conversations, current_time) -> str:
+def get_persona_prompt() -> str:
     return f'''
 {BASE_SYSTEM_PROMPT}
 
 **you never mention when you use tools or that you are remembering facts or a new topic has started.** these tools are hidden from the user for the best experience.
+'''
+
 
+def get_facts_section(facts) -> str:
+    return f'''
 facts you know about the user:
 {facts}
+'''
+
 
+def get_prior_conversations_section(prior_conversations) -> str:
+    return f'''
 prior conversations with this user:
 {prior_conversations}
+'''
+
+
+def get_knowledge_prompt(knowledge: List[str]) -> str:
+    if knowledge:
+        return "things you know that may be relevant right now:\n" + "\n".join(f"- {k}" for k in knowledge)
+    return ''
+
 
-approximate current time (accurate within 10 minutes): {current_time}
-'''
\ No newline at end of file
+def get_recall_prompt(recalled: List[str]) -> str:
+    if recalled:
+        return "things said in past conversations that may be relevant right now:\n" + "\n".join(f"- {r}" for r in recalled)
+    return ''
+
+
+def get_current_time_prompt(current_time) -> str:
+    return f'approximate current time (accurate within 10 minutes): {current_time}'
+
+
+def get_chat_system_prompt(facts, prior_conversations, current_time) -> str:
+    return get_persona_prompt() + get_facts_section(facts) + get_prior_conversations_section(prior_conversations) + '\n' + get_current_time_prompt(current_time) + '\n'
\ No newline at end of file
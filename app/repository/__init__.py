@@ -1,3 +1,4 @@
-from .repository import Repository
+from .repository import Repository, MessageCursor, SearchResult
+from .unit_of_work import UnitOfWork, GroupCommitter
 
-__all__ = ['Repository']
\ No newline at end of file
+__all__ = ['Repository', 'MessageCursor', 'SearchResult', 'UnitOfWork', 'GroupCommitter']
\ No newline at end of file
@@ -0,0 +1,21 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Sequence
+
+from app.model import MessageRecord, MessageType, Role
+
+
+ARCHIVE_AFTER = timedelta(days=30) # summarized conversations that ended longer ago than this are archived
+ARCHIVE_CACHE_SIZE = 8 # unpacked archives kept by the repository
+COMPACT_PAGES = 4096 # freed pages released per incremental vacuum, it holds the write lock while it runs
+
+
+def pack_messages(rows: Sequence[tuple]) -> bytes:
+    # rows in MESSAGE_RECORD_COLUMNS order, the conversation id is left out since the archive row has it
+    return zlib.compress(json.dumps([[m, t.isoformat(), r.value, mt.value, c, tid, tn, tj, e] for m, t, r, mt, c, tid, tn, tj, e, _ in rows], separators=(",", ":")).encode(), 9)
+
+
+def unpack_messages(data: bytes, conversation_id: str) -> List[MessageRecord]:
+    # oldest first, as they were archived
+    return [MessageRecord(m, datetime.fromisoformat(t), Role(r), MessageType(mt), c, tid, tn, tj, e, conversation_id) for m, t, r, mt, c, tid, tn, tj, e in json.loads(zlib.decompress(data))]
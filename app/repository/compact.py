@@ -0,0 +1,25 @@
+import argparse
+import asyncio
+import time
+from datetime import timedelta
+
+from .repository import Repository
+
+
+async def main(args: argparse.Namespace):
+    async with Repository(args.db) as repository:
+        started = time.perf_counter()
+        archived = await repository.archive_conversations(older_than=timedelta(days=args.older_than_days))
+        print(f"archived {archived} conversations in {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        before, after = await repository.compact(full=args.full)
+        print(f"{before} -> {after} pages in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="archive old conversations for every contact, then compact the database")
+    parser.add_argument("--db", default="sqlite+aiosqlite:///yui.db")
+    parser.add_argument("--older-than-days", type=float, default=30)
+    parser.add_argument("--full", action="store_true", help="VACUUM the whole file, blocks writers while it runs. needed once for databases created before auto vacuum")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,35 @@
+import argparse
+import asyncio
+import time
+
+from .repository import Repository
+
+
+async def main(args: argparse.Namespace):
+    async with Repository(args.db) as repository:
+        if args.command == "rebuild":
+            started = time.perf_counter()
+            count = await repository.rebuild_message_search()
+            print(f"indexed {count} messages in {time.perf_counter() - started:.2f}s")
+        else:
+            contact = await repository.get_contact(args.contact)
+            if not contact:
+                raise SystemExit(f"no contact named {args.contact!r}")
+            started = time.perf_counter()
+            results = await repository.search_messages(contact.id, args.text, args.limit)
+            elapsed = time.perf_counter() - started
+            for result in results:
+                print(f"{result.score:7.2f}  {result.timestamp:%Y-%m-%d}  {result.role.lower()}: {result.content[:100]}")
+            print(f"{len(results)} results in {elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rebuild or query the full text index over chat messages")
+    parser.add_argument("--db", default="sqlite+aiosqlite:///yui.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="reindex every chat message, e.g. after restoring a backup")
+    search = commands.add_parser("search")
+    search.add_argument("text")
+    search.add_argument("--contact", default="ravens")
+    search.add_argument("--limit", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
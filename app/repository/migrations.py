@@ -0,0 +1,82 @@
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Connection
+
+from app.model.tokens import CHARS_PER_TOKEN, MESSAGE_OVERHEAD_TOKENS
+
+
+INDEX_MESSAGE_SQL = "INSERT INTO message_fts (content, contact_id, message_id, conversation_id, role, timestamp) {source}"
+
+# append only. each migration runs once per database, in order, and must be safe on a database that
+# create_all has just built from the current models (i.e. use IF NOT EXISTS / check before altering)
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = []
+
+
+def migration(version: int, name: str):
+    def register(fn: Callable[[Connection], None]):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.exec_driver_sql(f"PRAGMA table_info({table})"))
+
+
+def get_version(conn: Connection) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(conn: Connection) -> List[int]:
+    applied = []
+    version = get_version(conn)
+    for migration_version, _, fn in sorted(MIGRATIONS):
+        if migration_version <= version:
+            continue
+        fn(conn)
+        conn.exec_driver_sql(f"PRAGMA user_version = {migration_version}")
+        applied.append(migration_version)
+    return applied
+
+
+@migration(1, "indexes for contact, conversation, message and fact lookups")
+def create_indexes(conn: Connection):
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_message_contact_id_timestamp ON message (contact_id, timestamp, id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_message_conversation_id_timestamp ON message (conversation_id, timestamp)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_conversation_contact_id_start_time ON conversation (contact_id, start_time)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fact_contact_id_timestamp ON fact (contact_id, timestamp)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_contact_name ON contact (name)")
+
+
+@migration(2, "per message token estimates")
+def add_message_token_estimate(conn: Connection):
+    if not has_column(conn, "message", "token_estimate"):
+        conn.exec_driver_sql("ALTER TABLE message ADD COLUMN token_estimate INTEGER NOT NULL DEFAULT 0")
+    # same arithmetic as app.model.estimate_message_tokens, a None input is stored as the json string 'null'
+    conn.exec_driver_sql(f"UPDATE message SET token_estimate = {MESSAGE_OVERHEAD_TOKENS} + (length(content) + coalesce(length(nullif(tool_use_input, 'null')), 0)) / {CHARS_PER_TOKEN} WHERE token_estimate = 0")
+
+
+@migration(3, "message conversation index covers the id tie break for keyset pagination")
+def extend_message_conversation_index(conn: Connection):
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_message_conversation_id_timestamp_id ON message (conversation_id, timestamp, id)")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_message_conversation_id_timestamp")
+
+
+@migration(4, "full text index over chat messages")
+def create_message_search(conn: Connection):
+    # the index keeps its own copy of the text so archived messages stay searchable, hence no delete trigger.
+    # contact_id is indexed without hyphens so a contact is one token rather than a phrase, see Repository.search_messages
+    conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(content, contact_id, message_id UNINDEXED, conversation_id UNINDEXED, role UNINDEXED, timestamp UNINDEXED, tokenize = 'porter unicode61')")
+    index_new = INDEX_MESSAGE_SQL.format(source="VALUES (new.content, replace(new.contact_id, '-', ''), new.id, new.conversation_id, new.role, new.timestamp)")
+    conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message WHEN new.message_type = 'CHAT' BEGIN {index_new}; END")
+    conn.exec_driver_sql("DELETE FROM message_fts")
+    conn.exec_driver_sql(INDEX_MESSAGE_SQL.format(source="SELECT content, replace(contact_id, '-', ''), id, conversation_id, role, timestamp FROM message WHERE message_type = 'CHAT'"))
+
+
+@migration(5, "fact mentions and last seen, for evicting facts over capacity")
+def add_fact_usage(conn: Connection):
+    if not has_column(conn, "fact", "mentions"):
+        conn.exec_driver_sql("ALTER TABLE fact ADD COLUMN mentions INTEGER NOT NULL DEFAULT 1")
+    if not has_column(conn, "fact", "last_seen"):
+        conn.exec_driver_sql("ALTER TABLE fact ADD COLUMN last_seen DATETIME")
+        conn.exec_driver_sql("UPDATE fact SET last_seen = timestamp")
@@ -0,0 +1,70 @@
+import asyncio
+import sys
+from datetime import datetime, UTC
+from typing import List, Tuple
+
+from sqlalchemy import event
+
+from .repository import Repository
+
+
+async def get_query_plans(repository: Repository) -> List[Tuple[str, List[str]]]:
+    # run every read path once, capture the SQL it emits and EXPLAIN it against the live schema
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(repository.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        cursor = (datetime.now(tz=UTC), "")
+        await repository.get_contact("")
+        await repository.get_conversation("")
+        await repository.get_conversations("")
+        await repository.get_messages("")
+        await repository.get_messages_before("", cursor)
+        await repository.get_messages_after("", cursor)
+        await repository.get_messages_for_conversation("")
+        await repository.get_conversation_for_message("")
+        await repository.get_history_page("", cursor)
+        await repository.get_archived_messages("")
+        await repository.get_facts("")
+        await repository.get_rollups("")
+        await repository.get_entities("")
+        await repository.get_triples("")
+        await repository.get_checkpointed_conversations("")
+        async for _ in repository.iter_conversation_messages(""):
+            pass
+    finally:
+        event.remove(repository.engine.sync_engine, "before_cursor_execute", capture)
+
+    plans = []
+    async with repository.engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)).all()
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+def is_indexed(plan: List[str]) -> bool:
+    # full table or index scans and sorts that don't come from an index all grow with the table
+    return not any(step.startswith("SCAN") or "TEMP B-TREE" in step for step in plan)
+
+
+async def main(db_url: str):
+    async with Repository(db_url) as repository:
+        plans = await get_query_plans(repository)
+
+    unindexed = 0
+    for statement, plan in plans:
+        ok = is_indexed(plan)
+        unindexed += not ok
+        print(f"{'ok' if ok else 'UNINDEXED'}: {' '.join(statement.split())}")
+        for step in plan:
+            print(f"    {step}")
+    return unindexed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "sqlite+aiosqlite://")) else 0)
@@ -1,29 +1,98 @@
-from datetime import datetime, UTC
-from typing import List, AsyncGenerator
+import re
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Iterable, List, AsyncGenerator, AsyncIterator, NamedTuple, Optional, Set, Tuple
 from contextlib import asynccontextmanager
 
-from sqlmodel import SQLModel, select
+from sqlmodel import SQLModel, select, tuple_
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Table, Text, delete, event, insert, type_coerce
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
 
-from app.model import Contact, Conversation, Message, Fact
+from app.tracing import traced
+from app.model import Contact, Conversation, ConversationRollup, ConversationArchive, Message, MessageRecord, MessageType, Fact, Entity, Triple, ExtractionCheckpoint
+from .migrations import migrate, INDEX_MESSAGE_SQL
+from .archive import ARCHIVE_AFTER, ARCHIVE_CACHE_SIZE, COMPACT_PAGES, pack_messages, unpack_messages
+from .unit_of_work import UnitOfWork, GroupCommitter, Writes
+
+
+MessageCursor = Tuple[datetime, str] # (timestamp, id) keyset position of a message
+
+SEARCH_STOPWORDS = {"the", "and", "for", "with", "you", "your", "that", "this", "are", "was", "have", "has", "but", "not", "what", "about", "just", "like", "its", "it's", "how", "can", "did", "don't", "get", "got"}
+SEARCH_MAX_TERMS = 24
+SEARCH_CANDIDATES = 2000 # only the newest matches are ranked, scoring every match of a common word is linear in history
+
+
+class SearchResult(NamedTuple):
+    message_id: str
+    conversation_id: str
+    role: str
+    timestamp: datetime
+    content: str
+    score: float # bm25, lower is better
+
+
+def get_match_query(text: str) -> Optional[str]:
+    # any of the distinct words in the text, quoted so user input can't break the fts5 query syntax
+    terms = list(dict.fromkeys(t for t in re.findall(r"\w+", text.lower()) if len(t) > 2 and t not in SEARCH_STOPWORDS))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return "content : (" + " OR ".join(f'"{t}"' for t in terms) + ")"
+
+
+# the columns of a MessageRecord, in its argument order. tool_use_input comes back as its stored json
+MESSAGE_RECORD_COLUMNS = (Message.id, Message.timestamp, Message.role, Message.message_type, Message.content, Message.tool_use_id, Message.tool_use_name, type_coerce(Message.tool_use_input, Text), Message.token_estimate, Message.conversation_id)
+
+
+SQLITE_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL", # only takes on a new database, older ones switch at their next full VACUUM, see compact
+    "journal_mode": "WAL", # readers don't block the writer
+    "synchronous": "NORMAL", # fsync at checkpoints rather than every commit, safe with WAL
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024, # negative is KiB, so 64MiB of page cache per connection
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def get_insert_rows(objects: List[SQLModel]) -> List[Tuple[Table, List[dict]]]:
+    # grouped by table, parents before the tables that reference them
+    rows: Dict[Table, List[dict]] = {}
+    for obj in objects:
+        rows.setdefault(obj.__table__, []).append(obj.model_dump())
+    return [(table, rows[table]) for table in SQLModel.metadata.sorted_tables if table in rows]
 
 
 class Repository:
-    def __init__(self, db_url: str = "sqlite+aiosqlite:///yui.db"):
+    # write_behind is how many seconds committed units wait to be group committed with others, None commits each on its own
+    def __init__(self, db_url: str = "sqlite+aiosqlite:///yui.db", write_behind: Optional[float] = None):
         self.engine = create_async_engine(db_url)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine.sync_engine, "connect", set_sqlite_pragmas)
         self.async_session_maker = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.group_committer = GroupCommitter(self, write_behind) if write_behind is not None else None
+        self.archives: Dict[str, List[MessageRecord]] = {} # conversation id -> unpacked archive, least recently used first
+        self.versions: Dict[str, int] = {} # contact id -> writes committed, so caches of what was read can tell they're stale
      
     async def initialize_db(self):
         async with self.engine.begin() as conn:
             await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(migrate)
 
     async def __aenter__(self):
         await self.initialize_db()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.group_committer:
+            await self.group_committer.close()
         await self.engine.dispose()
 
     @asynccontextmanager
@@ -37,75 +106,335 @@ class Repository:
         finally:
             await session.close()
 
+    def unit_of_work(self) -> UnitOfWork:
+        return UnitOfWork(self)
+
+    def get_version(self, contact_id: str) -> int:
+        return self.versions.get(contact_id, 0)
+
+    def mark_written(self, contact_ids: Iterable[str]):
+        # after commits that change what a turn's context is built from
+        for contact_id in set(contact_ids):
+            self.versions[contact_id] = self.versions.get(contact_id, 0) + 1
+
+    async def write(self, writes: Writes):
+        if self.group_committer:
+            await self.group_committer.submit(writes)
+        else:
+            await self.write_now(writes)
+
+    @traced("repository")
+    async def write_now(self, writes: Writes):
+        # new rows go in as one executemany per table rather than through the orm's flush, which costs far more per row
+        added, merged = writes
+        async with self.session() as session:
+            conn = await session.connection()
+            for table, rows in get_insert_rows(added):
+                await conn.execute(insert(table), rows)
+            for obj in merged:
+                await session.merge(obj)
+            await session.commit()
+        self.mark_written(contact_id for o in (*added, *merged) if (contact_id := getattr(o, "contact_id", None)))
+
+    @traced("repository")
     async def get_contact(self, name: str) -> Contact:
         async with self.session() as session:
             result = await session.exec(select(Contact).where(Contact.name == name))
             return result.first()
     
+    @traced("repository")
     async def create_contact(self, name: str) -> Contact:
-        async with self.session() as session:
-            contact = Contact(name=name)
-            session.add(contact)
-            await session.commit()
-            return contact
+        async with self.unit_of_work() as uow:
+            return uow.add(Contact(name=name))
 
+    @traced("repository")
     async def get_conversation(self, contact_id: str) -> Conversation:
         async with self.session() as session:
             result = await session.exec(select(Conversation).where(Conversation.contact_id == contact_id).order_by(Conversation.start_time.desc()))
             return result.first()
         
+    @traced("repository")
     async def get_conversations(self, contact_id: str) -> List[Conversation]:
         async with self.session() as session:
             result = await session.exec(select(Conversation).where(Conversation.contact_id == contact_id).order_by(Conversation.start_time.desc()))
             return result.all()
 
+    @traced("repository")
     async def create_conversation(self, contact_id: str) -> Conversation:
-        async with self.session() as session:
-            conversation = Conversation(contact_id=contact_id)
-            session.add(conversation)
-            await session.commit()
-            return conversation
+        async with self.unit_of_work() as uow:
+            return uow.add(Conversation(contact_id=contact_id))
     
+    @traced("repository")
     async def update_conversation(self, conversation: Conversation) -> Conversation:
+        async with self.unit_of_work() as uow:
+            return uow.merge(conversation)
+
+    @traced("repository")
+    async def get_rollups(self, contact_id: str) -> List[ConversationRollup]:
+        async with self.session() as session:
+            result = await session.exec(select(ConversationRollup).where(ConversationRollup.contact_id == contact_id).order_by(ConversationRollup.period, ConversationRollup.period_start))
+            return result.all()
+
+    @traced("repository")
+    async def save_rollups(self, rollups: List[ConversationRollup]) -> List[ConversationRollup]:
         async with self.session() as session:
-            await session.merge(conversation)
+            for rollup in rollups:
+                await session.merge(rollup)
             await session.commit()
-            return conversation
+            self.mark_written(r.contact_id for r in rollups)
+            return rollups
 
-    async def get_messages(self, contact_id: str) -> List[Message]:
+    @traced("repository")
+    async def get_messages(self, contact_id: str) -> List[MessageRecord]:
         async with self.session() as session:
-            result = await session.exec(select(Message).where(Message.contact_id == contact_id).order_by(Message.timestamp.desc()))
-            return result.all()
+            result = await session.exec(select(*MESSAGE_RECORD_COLUMNS).where(Message.contact_id == contact_id).order_by(Message.timestamp.desc()))
+            return [MessageRecord(*row) for row in result]
     
-    async def create_message(self, message: Message) -> Message:
+    @traced("repository")
+    async def get_messages_before(self, contact_id: str, before: Optional[MessageCursor] = None, limit: int = 100) -> List[MessageRecord]:
         async with self.session() as session:
-            session.add(message)
-            await session.commit()
-            return message
+            query = select(*MESSAGE_RECORD_COLUMNS).where(Message.contact_id == contact_id)
+            if before is not None:
+                query = query.where(tuple_(Message.timestamp, Message.id) < tuple_(*before))
+            result = await session.exec(query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit))
+            return [MessageRecord(*row) for row in result]
+
+    @traced("repository")
+    async def get_messages_after(self, contact_id: str, after: MessageCursor) -> List[MessageRecord]:
+        async with self.session() as session:
+            result = await session.exec(select(*MESSAGE_RECORD_COLUMNS).where(Message.contact_id == contact_id, tuple_(Message.timestamp, Message.id) > tuple_(*after)).order_by(Message.timestamp.desc(), Message.id.desc()))
+            return [MessageRecord(*row) for row in result]
+
+    @traced("repository")
+    async def get_message_window(self, contact_id: str, conversation_id: str, limit: int = 100) -> List[MessageRecord]:
+        # the last `limit` messages for the contact, extended back to the start of the current conversation
+        messages = await self.get_messages_before(contact_id, limit=limit)
+        while len(messages) >= limit and messages[-1].conversation_id == conversation_id:
+            older = await self.get_messages_before(contact_id, before=(messages[-1].timestamp, messages[-1].id), limit=limit)
+            older = [m for m in older if m.conversation_id == conversation_id]
+            if not older:
+                break
+            messages.extend(older)
+        return messages
+
+    @traced("repository")
+    async def create_message(self, message: Message) -> Message:
+        async with self.unit_of_work() as uow:
+            return uow.add(message)
     
+    @traced("repository")
     async def create_messages(self, messages: List[Message]) -> List[Message]:
-        async with self.session() as session:
-            session.add_all(messages)
-            await session.commit()
-            return messages
+        async with self.unit_of_work() as uow:
+            uow.add(*messages)
+        return messages
 
+    @traced("repository")
     async def get_facts(self, contact_id: str) -> List[Fact]:
         async with self.session() as session:
-            result = await session.exec(select(Fact).where(Fact.contact_id == contact_id))
+            result = await session.exec(select(Fact).where(Fact.contact_id == contact_id).order_by(Fact.timestamp))
             return result.all()
     
+    @traced("repository")
     async def create_fact(self, fact: Fact) -> Fact:
+        async with self.unit_of_work() as uow:
+            return uow.add(fact)
+
+    @traced("repository")
+    async def save_facts(self, contact_id: str, facts: List[Fact], deleted: List[str]):
+        # consolidated and evicted facts go together, see CompletionGateway.consolidate_facts
         async with self.session() as session:
-            session.add(fact)
+            for fact in facts:
+                await session.merge(fact)
+            if deleted:
+                conn = await session.connection()
+                await conn.execute(delete(Fact).where(Fact.id.in_(deleted)))
             await session.commit()
-            return fact
+        self.mark_written([contact_id])
     
-    async def get_messages_for_conversation(self, conversation_id: str) -> List[Message]:
+    @traced("repository")
+    async def get_entities(self, contact_id: str) -> List[Tuple[str, str]]:
+        # (id, name) rows rather than models, there can be a lot of them
         async with self.session() as session:
-            result = await session.exec(select(Message).where(Message.conversation_id == conversation_id).order_by(Message.timestamp.desc()))
+            result = await session.exec(select(Entity.id, Entity.name).where(Entity.contact_id == contact_id))
             return result.all()
+
+    @traced("repository")
+    async def get_triples(self, contact_id: str) -> List[Tuple[str, str, str, str, int, int, datetime]]:
+        # (id, subject id, predicate, object id, importance, mentions, timestamp) rows
+        async with self.session() as session:
+            result = await session.exec(select(Triple.id, Triple.subject_id, Triple.predicate, Triple.object_id, Triple.importance, Triple.mentions, Triple.timestamp).where(Triple.contact_id == contact_id))
+            return result.all()
+
+    @traced("repository")
+    async def save_knowledge(self, entities: List[Entity], triples: List[Triple]):
+        async with self.session() as session:
+            session.add_all(entities)
+            for triple in triples:
+                await session.merge(triple)
+            await session.commit()
+
+    @traced("repository")
+    async def get_messages_for_conversation(self, conversation_id: str) -> List[MessageRecord]:
+        async with self.session() as session:
+            result = await session.exec(select(*MESSAGE_RECORD_COLUMNS).where(Message.conversation_id == conversation_id).order_by(Message.timestamp.desc()))
+            messages = [MessageRecord(*row) for row in result]
+        return messages or list(reversed(await self.get_archived_messages(conversation_id)))
     
+    async def iter_conversation_messages(self, conversation_id: str, batch_size: int = 500) -> AsyncIterator[List[MessageRecord]]:
+        # oldest first, in keyset paginated batches so a long conversation is never loaded at once
+        after = None
+        while True:
+            async with self.session() as session:
+                query = select(*MESSAGE_RECORD_COLUMNS).where(Message.conversation_id == conversation_id)
+                if after is not None:
+                    query = query.where(tuple_(Message.timestamp, Message.id) > tuple_(*after))
+                batch = [MessageRecord(*row) for row in await session.exec(query.order_by(Message.timestamp, Message.id).limit(batch_size))]
+            if not batch:
+                if after is None: # nothing in the message table, the conversation may be archived
+                    archived = await self.get_archived_messages(conversation_id)
+                    for start in range(0, len(archived), batch_size):
+                        yield archived[start:start + batch_size]
+                return
+            yield batch
+            after = (batch[-1].timestamp, batch[-1].id)
+
+    @traced("repository")
+    async def search_messages(self, contact_id: str, text: str, limit: int = 5, before: Optional[datetime] = None) -> List[SearchResult]:
+        # bm25 ranked chat messages for the contact, optionally only those older than `before` (e.g. what's already in context).
+        # kept in sync by a trigger on message inserts, see migrations.py
+        match = get_match_query(text)
+        if match is None:
+            return []
+        # the contact token is in every one of the contact's rows, so it only goes in the unranked query that finds where the
+        # newest candidates start. bm25 reads the whole posting list of every phrase it ranks
+        contact_token = contact_id.replace("-", "")
+        before = (before.astimezone(UTC).replace(tzinfo=None) if before.tzinfo else before) if before else datetime.max
+        async with self.engine.connect() as conn:
+            rows = await conn.exec_driver_sql(
+                "SELECT message_id, conversation_id, role, timestamp, content, bm25(message_fts) AS score FROM message_fts "
+                "WHERE message_fts MATCH ?1 AND contact_id = ?2 AND timestamp < ?3 "
+                "AND rowid >= coalesce((SELECT rowid FROM message_fts WHERE message_fts MATCH ?4 ORDER BY rowid DESC LIMIT 1 OFFSET ?5), 0) "
+                "ORDER BY score LIMIT ?6",
+                (match, contact_token, before.strftime("%Y-%m-%d %H:%M:%S.%f"), f'contact_id : "{contact_token}" AND {match}', SEARCH_CANDIDATES, limit),
+            )
+            return [SearchResult(m, c, r, datetime.fromisoformat(t), content, score) for m, c, r, t, content, score in rows]
+
+    @traced("repository")
+    async def rebuild_message_search(self) -> int:
+        async with self.engine.begin() as conn:
+            await conn.exec_driver_sql("DELETE FROM message_fts")
+            await conn.exec_driver_sql(INDEX_MESSAGE_SQL.format(source="SELECT content, replace(contact_id, '-', ''), id, conversation_id, role, timestamp FROM message WHERE message_type = 'CHAT'"))
+            # archived messages too, stored the way the insert trigger stores them
+            archives = await conn.execute(select(ConversationArchive.conversation_id, ConversationArchive.contact_id, ConversationArchive.data))
+            for conversation_id, contact_id, data in archives.all():
+                rows = [(m.content, contact_id.replace("-", ""), m.id, conversation_id, m.role.name, m.timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")) for m in unpack_messages(data, conversation_id) if m.message_type == MessageType.CHAT]
+                if rows:
+                    await conn.exec_driver_sql(INDEX_MESSAGE_SQL.format(source="VALUES (?, ?, ?, ?, ?, ?)"), rows)
+            await conn.exec_driver_sql("INSERT INTO message_fts (message_fts) VALUES ('optimize')")
+            return (await conn.exec_driver_sql("SELECT count(*) FROM message_fts")).scalar()
+
+    @traced("repository")
+    async def get_checkpointed_conversations(self, contact_id: str) -> Set[str]:
+        async with self.session() as session:
+            result = await session.exec(select(ExtractionCheckpoint.conversation_id).where(ExtractionCheckpoint.contact_id == contact_id))
+            return set(result.all())
+
+    @traced("repository")
+    async def create_checkpoint(self, checkpoint: ExtractionCheckpoint) -> ExtractionCheckpoint:
+        async with self.session() as session:
+            await session.merge(checkpoint)
+            await session.commit()
+            return checkpoint
+
+    @traced("repository")
     async def get_conversation_for_message(self, message_id: str) -> Conversation:
         async with self.session() as session:
-            result = await session.exec(select(Conversation).where(Conversation.id == Message.conversation_id))
+            result = await session.exec(select(Conversation).join(Message, Message.conversation_id == Conversation.id).where(Message.id == message_id))
             return result.first()
+
+    @traced("repository")
+    async def get_history_page(self, contact_id: str, before: Optional[MessageCursor] = None, limit: int = 20) -> List[Tuple[MessageRecord, Optional[str]]]:
+        # messages newest first, each with the summary of the conversation it belongs to. archived conversations are read
+        # newest first as well, until there are enough of their messages before `before` to fill the page
+        async with self.session() as session:
+            query = select(*MESSAGE_RECORD_COLUMNS, Conversation.summary).join(Conversation, Conversation.id == Message.conversation_id).where(Message.contact_id == contact_id)
+            if before is not None:
+                query = query.where(tuple_(Message.timestamp, Message.id) < tuple_(*before))
+            result = await session.exec(query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit))
+            page = [(MessageRecord(*row[:-1]), row[-1]) for row in result]
+
+            archived = []
+            query = select(ConversationArchive.conversation_id, Conversation.summary).join(Conversation, Conversation.id == ConversationArchive.conversation_id).where(ConversationArchive.contact_id == contact_id)
+            if before is not None:
+                before = (before[0].astimezone(UTC).replace(tzinfo=None) if before[0].tzinfo else before[0], before[1]) # archived timestamps are naive utc, like the columns
+                query = query.where(ConversationArchive.start_time < before[0])
+            if len(page) == limit: # usually everything archived is older than a full page, then nothing is read
+                query = query.where(Conversation.end_time > page[-1][0].timestamp)
+            for conversation_id, summary in (await session.exec(query.order_by(ConversationArchive.start_time.desc()))).all():
+                archived.extend((m, summary) for m in reversed(await self.load_archive(session, conversation_id)) if before is None or (m.timestamp, m.id) < before)
+                if len(archived) >= limit:
+                    break
+        if not archived:
+            return page
+        return sorted(page + archived, key=lambda ms: (ms[0].timestamp, ms[0].id), reverse=True)[:limit]
+
+    async def load_archive(self, session: AsyncSession, conversation_id: str) -> List[MessageRecord]:
+        # archives never change once written, so the last few read stay unpacked for paging back through them
+        messages = self.archives.pop(conversation_id, None)
+        if messages is None:
+            data = (await session.exec(select(ConversationArchive.data).where(ConversationArchive.conversation_id == conversation_id))).first()
+            messages = unpack_messages(data, conversation_id) if data is not None else []
+        self.archives[conversation_id] = messages
+        while len(self.archives) > ARCHIVE_CACHE_SIZE:
+            del self.archives[next(iter(self.archives))]
+        return messages
+
+    @traced("repository")
+    async def get_archived_messages(self, conversation_id: str) -> List[MessageRecord]:
+        # oldest first, empty unless the conversation is archived
+        async with self.session() as session:
+            return list(await self.load_archive(session, conversation_id))
+
+    @traced("repository")
+    async def archive_conversations(self, contact_id: Optional[str] = None, older_than: timedelta = ARCHIVE_AFTER) -> int:
+        # moves the messages of summarized conversations that ended more than `older_than` ago out of the message table into
+        # one compressed row per conversation, then releases the pages that freed up. one transaction per conversation.
+        # they stay searchable, the search index keeps its own copy of the text. returns how many were archived
+        cutoff = datetime.now(tz=UTC) - older_than
+        async with self.session() as session:
+            query = select(Conversation.id, Conversation.contact_id, Conversation.start_time).outerjoin(ConversationArchive, ConversationArchive.conversation_id == Conversation.id).where(Conversation.summary.is_not(None), Conversation.end_time < cutoff, ConversationArchive.conversation_id.is_(None))
+            if contact_id is not None:
+                query = query.where(Conversation.contact_id == contact_id)
+            conversations = (await session.exec(query)).all()
+
+        for conversation_id, conversation_contact_id, start_time in conversations:
+            async with self.session() as session:
+                conn = await session.connection()
+                rows = (await conn.execute(select(*MESSAGE_RECORD_COLUMNS).where(Message.conversation_id == conversation_id).order_by(Message.timestamp, Message.id))).all()
+                await conn.execute(insert(ConversationArchive), [dict(conversation_id=conversation_id, start_time=start_time, message_count=len(rows), data=pack_messages(rows), archived_at=datetime.now(tz=UTC), contact_id=conversation_contact_id)])
+                await conn.execute(delete(Message).where(Message.conversation_id == conversation_id))
+                await session.commit()
+            self.mark_written([conversation_contact_id])
+        if conversations:
+            await self.compact()
+        return len(conversations)
+
+    @traced("repository")
+    async def compact(self, full: bool = False) -> Tuple[int, int]:
+        # gives pages freed by archiving back to the filesystem and returns the page count (before, after). normally that's an
+        # incremental vacuum of up to COMPACT_PAGES, which is quick. `full` rewrites the whole file with VACUUM, which blocks
+        # every writer while it runs but also switches a database created before auto vacuum to incremental
+        if self.engine.dialect.name != "sqlite":
+            return 0, 0
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT") # VACUUM can't run in a transaction
+            before = (await conn.exec_driver_sql("PRAGMA page_count")).scalar()
+            if full:
+                await conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                await conn.exec_driver_sql("VACUUM")
+            elif (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() == 2: # incremental
+                # through executescript, the driver's execute steps it once and that frees a single page
+                await (await conn.get_raw_connection()).driver_connection.executescript(f"PRAGMA incremental_vacuum({COMPACT_PAGES})")
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            await conn.exec_driver_sql("PRAGMA optimize")
+            return before, (await conn.exec_driver_sql("PRAGMA page_count")).scalar()
@@ -0,0 +1,132 @@
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlmodel import SQLModel
+
+from app.model import Message, estimate_message_tokens
+
+
+Writes = Tuple[List[SQLModel], List[SQLModel]] # (added, merged)
+
+
+def resolve(future: asyncio.Future, error: Optional[BaseException] = None):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    elif isinstance(error, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(error)
+
+
+class UnitOfWork():
+    # writes gathered in memory and committed together in one transaction, or not at all. nothing is visible to reads until
+    # commit, so callers that need their own writes back (e.g. the chat request for a turn) use `messages`
+    def __init__(self, repository):
+        self.repository = repository
+        self.added: List[SQLModel] = []
+        self.merged: List[SQLModel] = []
+        self.callbacks: List[Callable[[], Awaitable]] = []
+
+    async def __aenter__(self) -> "UnitOfWork":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.commit()
+
+    def add(self, *objects: SQLModel) -> SQLModel:
+        # returns the first object, for `message = uow.add(Message(...))`
+        for o in objects:
+            if isinstance(o, Message):
+                o.token_estimate = estimate_message_tokens(o.content, o.tool_use_input)
+        self.added.extend(objects)
+        return objects[0] if objects else None
+
+    def merge(self, obj: SQLModel) -> SQLModel:
+        self.merged.append(obj)
+        return obj
+
+    def after_commit(self, fn: Callable[[], Awaitable]):
+        # e.g. background jobs that read what this unit writes
+        self.callbacks.append(fn)
+
+    @property
+    def messages(self) -> List[Message]:
+        return [o for o in self.added if isinstance(o, Message)]
+
+    async def commit(self):
+        writes, callbacks = (self.added, self.merged), self.callbacks
+        self.added, self.merged, self.callbacks = [], [], []
+        if writes[0] or writes[1]:
+            await self.repository.write(writes)
+        for fn in callbacks:
+            await fn()
+
+
+class GroupCommitter():
+    # write behind for many concurrent writers. committed units queue up and one task writes everything that arrived in the
+    # last `interval` seconds in a single transaction, so concurrent turns share a commit rather than queueing for sqlite's
+    # write lock one by one. commit still waits for its batch, so a unit is durable once commit returns. if a batch fails its
+    # units are retried one by one, so a bad unit only fails its own commit
+    def __init__(self, repository, interval: float = 0.005, max_batch: int = 256):
+        self.repository = repository
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending: List[Tuple[Writes, asyncio.Future]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.units = 0
+
+    async def submit(self, writes: Writes):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((writes, future))
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), context=contextvars.Context()) # not part of whichever turn happened to start it
+        await asyncio.shield(future) # once queued it's written, even if the caller goes away
+
+    async def run(self):
+        try:
+            while self.pending:
+                if len(self.pending) < self.max_batch:
+                    await asyncio.sleep(self.interval)
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+                await self.flush(batch)
+        finally:
+            self.task = None
+            # only left when the task was cancelled or a flush raised, their commits would otherwise wait forever
+            pending, self.pending = self.pending, []
+            for _, future in pending:
+                resolve(future, asyncio.CancelledError())
+
+    async def flush(self, batch: List[Tuple[Writes, asyncio.Future]]):
+        try:
+            try:
+                await self.repository.write_now(([o for (added, _), _ in batch for o in added], [o for (_, merged), _ in batch for o in merged]))
+                for _, future in batch:
+                    resolve(future)
+            except Exception as e:
+                if len(batch) == 1:
+                    resolve(batch[0][1], e)
+                else:
+                    for writes, future in batch:
+                        try:
+                            await self.repository.write_now(writes)
+                            resolve(future)
+                        except Exception as unit_error:
+                            resolve(future, unit_error)
+        except BaseException as e:
+            # cancelled, e.g. at shutdown. units not written by then fail rather than leave their commits waiting
+            for _, future in batch:
+                resolve(future, e)
+            raise
+        finally:
+            self.batches += 1
+            self.units += len(batch)
+
+    async def close(self):
+        # waits for queued writes, call before the engine goes away
+        while self.task is not None:
+            await asyncio.shield(self.task)
@@ -0,0 +1,23 @@
+import argparse
+import asyncio
+
+from .server import main
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve chat for many contacts over http")
+    parser.add_argument("--db", default="sqlite+aiosqlite:///yui.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=2, help="background job concurrency")
+    parser.add_argument("--max-active-turns", type=int, default=8, help="turns talking to the model at once, across contacts")
+    parser.add_argument("--max-pending-per-contact", type=int, default=2)
+    parser.add_argument("--max-queued-turns", type=int, default=64)
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--max-contacts", type=int, default=1024, help="contacts whose sessions and caches are kept, the least recently used idle ones go first")
+    parser.add_argument("--archive-hours", type=float, default=6, help="archive old conversations for every contact this often, 0 to only archive when a session opens")
+    parser.add_argument("--write-behind", type=float, help="seconds to gather writes from concurrent turns into one commit, e.g. 0.005")
+    parser.add_argument("--trace", help="write a span per repository call, model call and turn to this jsonl file")
+    parser.add_argument("--warm-cache", action="store_true", help="after each turn, write the prompt cache for the contact's next one with a one token request")
+    parser.add_argument("--metrics", action="store_true", help="serve prometheus metrics at /metrics")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import json
+import re
+import signal
+import traceback
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+
+from app.model import Message
+from app.repository import Repository
+from app.gateway import CompletionGateway
+from app.controller import ChatSession
+from app.worker import BackgroundWorker
+from app.tracing import tracer
+
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_HEADER_LINES = 64
+READ_TIMEOUT = 30.0
+CONTACT_PATH = re.compile(r"^/contacts/([\w.-]{1,64})/messages$")
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large", 429: "Too Many Requests", 431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class ContactSlot():
+    # turns for one contact run one at a time, in arrival order
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    pending: int = 0
+    session: Optional[ChatSession] = None
+
+
+class ChatServer():
+    # chat over http for many contacts from one process: one repository engine, one model client and one background worker.
+    # POST /contacts/{name}/messages {"content": "..."} streams the turn back as newline delimited json events.
+    # turns are serialized per contact and run in parallel across contacts, with at most `max_active_turns` talking to the
+    # model at once. admission is checked before any work: a contact with `max_pending_per_contact` turns already queued
+    # gets 429, and once `max_queued_turns` are waiting overall everyone gets 503. past `max_contacts` the least recently
+    # used idle contacts are dropped along with what the gateway caches for them, their next turn reads it all again
+    def __init__(self, repository: Repository, completion_gateway: CompletionGateway, worker: BackgroundWorker, max_active_turns: int = 8, max_pending_per_contact: int = 2, max_queued_turns: int = 64, max_connections: int = 256, max_contacts: int = 1024):
+        self.repository = repository
+        self.completion_gateway = completion_gateway
+        self.worker = worker
+        self.max_pending_per_contact = max_pending_per_contact
+        self.max_queued_turns = max_queued_turns
+        self.max_connections = max_connections
+        self.max_contacts = max_contacts
+        self.turns = asyncio.Semaphore(max_active_turns)
+        self.slots: Dict[str, ContactSlot] = {} # least recently used first
+        self.streaming: Set[asyncio.StreamWriter] = set() # connections whose response head went out, errors can't change it now
+        self.queued = 0
+        self.active = 0
+        self.connections = 0
+
+    async def serve(self, host: str, port: int, archive_every: Optional[float] = None):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_BODY_BYTES)
+        archiving = asyncio.create_task(self.archive_periodically(archive_every)) if archive_every else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if archiving:
+                archiving.cancel()
+
+    async def archive_periodically(self, every: float):
+        # sessions archive when they open, but a contact that stays in the server never opens one again
+        while True:
+            await asyncio.sleep(every)
+            await self.worker.submit("archive_conversations", self.repository.archive_conversations)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                raise HttpError(503, "too many connections")
+            method, path, body = await asyncio.wait_for(read_request(reader), timeout=READ_TIMEOUT)
+            if path == "/health":
+                await write_json(writer, 200, {"active": self.active, "queued": self.queued, "contacts": len(self.slots), "connections": self.connections, "failed_jobs": self.worker.failures})
+                return
+            if path == "/metrics":
+                if not tracer.metrics:
+                    raise HttpError(404, "metrics are off, start the server with --metrics")
+                await write_body(writer, 200, "text/plain; version=0.0.4", tracer.metrics.render(*self.get_metrics()).encode())
+                return
+            match = CONTACT_PATH.match(path)
+            if not match:
+                raise HttpError(404, "not found")
+            if method != "POST":
+                raise HttpError(405, "use POST")
+            try:
+                content = json.loads(body)["content"]
+            except (ValueError, KeyError, TypeError):
+                raise HttpError(400, 'expected {"content": "..."}')
+            if not isinstance(content, str) or not content.strip():
+                raise HttpError(400, "content must be a non-empty string")
+            await self.run_turn(match.group(1), content, writer)
+        except HttpError as e:
+            await write_json(writer, e.status, {"error": str(e)})
+        except asyncio.TimeoutError:
+            await write_json(writer, 408, {"error": "timed out reading the request"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            if writer not in self.streaming:
+                await write_json(writer, 500, {"error": "internal error"})
+        finally:
+            self.streaming.discard(writer)
+            self.connections -= 1
+            writer.close()
+
+    def get_metrics(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        # (gauges, counters) on top of the tracer's span and token metrics
+        scheduler = self.completion_gateway.scheduler
+        gauges = {
+            "active_turns": self.active,
+            "queued_turns": self.queued,
+            "contacts": len(self.slots),
+            "connections": self.connections,
+            "queued_jobs": self.worker.queue.qsize(),
+            "model_requests_waiting": len(scheduler.waiting),
+            "cache_hit_rate": self.completion_gateway.context_builder.cache_hit_rate,
+        }
+        counters = {"failed_jobs": self.worker.failures, "model_retries": scheduler.retries, "model_requests_coalesced": scheduler.coalesced}
+        return gauges, counters
+
+    def admit(self, name: str) -> ContactSlot:
+        # a rejected request leaves the contacts as they were
+        slot = self.slots.get(name)
+        if slot is not None and slot.pending >= self.max_pending_per_contact:
+            raise HttpError(429, "too many turns queued for this contact")
+        if self.queued >= self.max_queued_turns:
+            raise HttpError(503, "server is busy")
+        if slot is None:
+            slot = ContactSlot()
+        else:
+            del self.slots[name]
+        self.evict()
+        self.slots[name] = slot
+        return slot
+
+    def evict(self):
+        for name in list(self.slots):
+            if len(self.slots) < self.max_contacts:
+                break
+            slot = self.slots[name]
+            if slot.pending or slot.lock.locked():
+                continue
+            del self.slots[name]
+            if slot.session:
+                slot.session.close()
+                self.completion_gateway.forget(slot.session.contact.id)
+
+    async def run_turn(self, name: str, content: str, writer: asyncio.StreamWriter):
+        slot = self.admit(name)
+        slot.pending += 1
+        self.queued += 1
+        queued = True
+        try:
+            async with slot.lock, self.turns:
+                self.queued -= 1
+                self.active += 1
+                queued = False
+                try:
+                    if slot.session is None:
+                        slot.session = await self.open_session(name)
+                    await self.stream_turn(slot.session, content, writer)
+                    slot.session.prefetch() # the contact's next turn picks it up, after waiting on this lock
+                finally:
+                    self.active -= 1
+        finally:
+            slot.pending -= 1
+            if queued:
+                self.queued -= 1
+
+    async def open_session(self, name: str) -> ChatSession:
+        contact = await self.repository.get_contact(name)
+        if not contact:
+            contact = await self.repository.create_contact(name)
+        return await ChatSession.open(self.repository, self.completion_gateway, self.worker, contact)
+
+    async def stream_turn(self, session: ChatSession, content: str, writer: asyncio.StreamWriter):
+        # the turn always runs to the end so history stays consistent, a client that goes away just stops getting events.
+        # writes wait for the client to drain, so a slow reader slows its own turn rather than buffering it in memory
+        connected = True
+
+        async def send(event: dict):
+            nonlocal connected
+            if not connected:
+                return
+            try:
+                data = json.dumps(event).encode() + b"\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+        writer.write(get_head(200, "application/x-ndjson", chunked=True))
+        self.streaming.add(writer)
+        while session.notices:
+            title, text = session.notices.pop(0)
+            await send({"type": "notice", "title": title, "content": text})
+        try:
+            async for response in session.turn(content):
+                await send({"type": "text", "text": response} if isinstance(response, str) else get_message_event(response))
+        except Exception as e:
+            await send({"type": "error", "error": str(e)})
+        await send({"type": "done"})
+        if connected:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+    try:
+        method, path, _ = (await reader.readuntil(b"\r\n")).decode("latin-1").split(" ", 2)
+    except (ValueError, asyncio.LimitOverrunError):
+        raise HttpError(400, "malformed request line")
+
+    content_length = 0
+    for _ in range(MAX_HEADER_LINES):
+        try:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1").strip()
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, "header line too long")
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            try:
+                content_length = int(value)
+            except ValueError:
+                raise HttpError(400, "bad content-length")
+            if content_length < 0:
+                raise HttpError(400, "bad content-length")
+    else:
+        raise HttpError(400, "too many headers")
+
+    if content_length > MAX_BODY_BYTES:
+        raise HttpError(413, f"body is limited to {MAX_BODY_BYTES} bytes")
+    return method, path.split("?", 1)[0], await reader.readexactly(content_length)
+
+
+def get_head(status: int, content_type: str, chunked: bool = False, content_length: int = 0) -> bytes:
+    length = "Transfer-Encoding: chunked" if chunked else f"Content-Length: {content_length}"
+    return f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Type: {content_type}\r\n{length}\r\nConnection: close\r\n\r\n".encode()
+
+
+async def write_body(writer: asyncio.StreamWriter, status: int, content_type: str, data: bytes):
+    try:
+        writer.write(get_head(status, content_type, content_length=len(data)) + data)
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+
+async def write_json(writer: asyncio.StreamWriter, status: int, body: dict):
+    await write_body(writer, status, "application/json", json.dumps(body).encode())
+
+
+def get_message_event(message: Message) -> dict:
+    return {
+        "type": "message",
+        "id": message.id,
+        "role": message.role.value,
+        "message_type": message.message_type.value,
+        "content": message.content,
+        "tool_use_name": message.tool_use_name,
+        "tool_use_input": message.tool_use_input,
+        "timestamp": message.timestamp.isoformat(),
+    }
+
+
+async def main(args: argparse.Namespace):
+    # SIGINT/SIGTERM stop accepting connections, then queued background jobs drain before the repository closes
+    task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, task.cancel)
+
+    tracer.configure(args.trace, metrics=args.metrics)
+    async with Repository(args.db, write_behind=args.write_behind) as repository, BackgroundWorker(concurrency=args.workers) as worker:
+        completion_gateway = CompletionGateway(repository=repository, warm_cache=args.warm_cache)
+        server = ChatServer(repository, completion_gateway, worker, max_active_turns=args.max_active_turns, max_pending_per_contact=args.max_pending_per_contact, max_queued_turns=args.max_queued_turns, max_connections=args.max_connections, max_contacts=args.max_contacts)
+        print(f"listening on http://{args.host}:{args.port}")
+        try:
+            await server.serve(args.host, args.port, archive_every=args.archive_hours * 3600)
+        except asyncio.CancelledError:
+            pass
+    tracer.close()
@@ -0,0 +1,4 @@
+from .tracer import Tracer, Span, TraceWriter, tracer, traced
+from .metrics import Metrics
+
+__all__ = ['Tracer', 'Span', 'TraceWriter', 'tracer', 'traced', 'Metrics']
\ No newline at end of file
@@ -0,0 +1,66 @@
+import bisect
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0] # seconds
+METRIC_PREFIX = "yui"
+
+
+@dataclass
+class Histogram():
+    counts: List[int] = field(default_factory=lambda: [0] * (len(DURATION_BUCKETS) + 1)) # the last is +Inf
+    total: float = 0.0
+    errors: int = 0
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def get_labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+class Metrics():
+    # span durations and model token counts since startup, rendered in the prometheus text format
+    def __init__(self):
+        self.durations: Dict[str, Histogram] = {} # by span name
+        self.tokens: Dict[Tuple[str, str], int] = {} # (model, usage field) -> count
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        histogram = self.durations.get(name)
+        if histogram is None:
+            histogram = self.durations[name] = Histogram()
+        histogram.counts[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+        histogram.total += seconds
+        histogram.errors += error
+
+    def count_tokens(self, model: str, counts: Dict[str, int]):
+        for kind, count in counts.items():
+            self.tokens[(model, kind)] = self.tokens.get((model, kind), 0) + count
+
+    def render(self, gauges: Dict[str, float] = {}, counters: Dict[str, float] = {}) -> str:
+        # `gauges` and `counters` are the caller's own, e.g. the server's queue depth and the scheduler's retries
+        lines = [f"# TYPE {METRIC_PREFIX}_span_duration_seconds histogram"]
+        for name, histogram in sorted(self.durations.items()):
+            cumulative = 0
+            for le, count in zip([*DURATION_BUCKETS, "+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f"{METRIC_PREFIX}_span_duration_seconds_bucket{get_labels(span=name, le=le)} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}_span_duration_seconds_sum{get_labels(span=name)} {histogram.total}")
+            lines.append(f"{METRIC_PREFIX}_span_duration_seconds_count{get_labels(span=name)} {cumulative}")
+
+        lines.append(f"# TYPE {METRIC_PREFIX}_span_errors_total counter")
+        lines.extend(f"{METRIC_PREFIX}_span_errors_total{get_labels(span=name)} {h.errors}" for name, h in sorted(self.durations.items()))
+
+        lines.append(f"# TYPE {METRIC_PREFIX}_model_tokens_total counter")
+        lines.extend(f"{METRIC_PREFIX}_model_tokens_total{get_labels(model=model, type=kind.removesuffix('_tokens'))} {count}" for (model, kind), count in sorted(self.tokens.items()))
+
+        for name, value in gauges.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_PREFIX}_{name} {value}")
+        for name, value in counters.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,187 @@
+import functools
+import json
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from .metrics import Metrics
+
+
+USAGE_FIELDS = ["input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"]
+TRACE_MAX_BYTES = 16 * 1024 * 1024
+TRACE_BACKUPS = 3
+MAX_BUFFERED_SPANS = 1000 # a long background job writes its spans as it goes rather than all at the end
+
+
+class TraceWriter():
+    # appends json lines, rolling trace.jsonl over to trace.jsonl.1 and so on once it passes max_bytes
+    def __init__(self, path: str, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, lines: List[str]):
+        data = "".join(lines)
+        if self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+
+    def close(self):
+        self.file.close()
+
+
+class Trace():
+    # everything under one root span, e.g. a chat turn or a background job
+    def __init__(self):
+        self.id = f"{random.getrandbits(64):016x}"
+        self.self_ms: Dict[str, float] = {} # time spent in each category's own code, children excluded
+        self.usage: Dict[str, int] = dict.fromkeys(USAGE_FIELDS, 0)
+        self.lines: List[str] = []
+        self.done = False # spans from tasks that outlive the root are written as they finish
+
+
+class Span():
+    def __init__(self, tracer: "Tracer", name: str, attrs: Dict[str, Any], parent: Optional["Span"]):
+        self.tracer = tracer
+        self.name = name
+        self.category = name.split(".", 1)[0]
+        self.attrs = attrs
+        self.parent = parent
+        self.trace = parent.trace if parent else Trace()
+        self.id = f"{random.getrandbits(64):016x}"
+        self.child_ms = 0.0
+        self.token = None
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end(exc_type)
+
+    def end(self, error: Optional[type] = None):
+        if self.token is not None:
+            try:
+                current_span.reset(self.token)
+            except ValueError:
+                pass # an async generator closed from another context, e.g. by garbage collection
+            self.token = None
+        self.tracer.finish(self, (time.perf_counter() - self.started) * 1000, error)
+
+
+class NoopSpan():
+    # what every span call returns while tracing is off, so instrumented code doesn't have to check
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self) -> "NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def end(self, error: Optional[type] = None):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer():
+    # spans nest through a context var, so they follow a turn across awaits and into tasks it starts. each finished span is a
+    # json line in the trace file, and the root's line also breaks its time down by category (the part of the span name
+    # before the first dot) and sums the model usage under it. off until configured, and then a span costs one attribute check
+    def __init__(self):
+        self.enabled = False
+        self.writer: Optional[TraceWriter] = None
+        self.metrics: Optional[Metrics] = None
+
+    def configure(self, path: Optional[str] = None, metrics: bool = False, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+        self.close()
+        self.writer = TraceWriter(path, max_bytes, backups) if path else None
+        self.metrics = Metrics() if metrics else None
+        self.enabled = bool(self.writer or self.metrics)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.writer = None
+        self.metrics = None
+        self.enabled = False
+
+    def span(self, name: str, **attrs) -> Span:
+        # use as a context manager, or call end() when the span can't be a with block
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attrs, current_span.get())
+
+    def record_usage(self, span: Span, usage: Any):
+        # model token usage, on the span, the trace totals and the token counters
+        if not self.enabled or usage is None or span is NOOP_SPAN:
+            return
+        counts = {f: getattr(usage, f, None) or 0 for f in USAGE_FIELDS}
+        span.set(**counts)
+        for f, count in counts.items():
+            span.trace.usage[f] += count
+        if self.metrics:
+            self.metrics.count_tokens(span.attrs.get("model", ""), counts)
+
+    def finish(self, span: Span, duration_ms: float, error: Optional[type]):
+        trace = span.trace
+        trace.self_ms[span.category] = trace.self_ms.get(span.category, 0.0) + duration_ms - span.child_ms
+        if span.parent:
+            span.parent.child_ms += duration_ms
+        if error is not None:
+            span.attrs["error"] = error.__name__
+        if self.metrics:
+            self.metrics.observe(span.name, duration_ms / 1000, error is not None)
+        if not self.writer:
+            return
+
+        record = {"trace": trace.id, "span": span.id, "parent": span.parent.id if span.parent else None, "name": span.name, "start": span.timestamp, "duration_ms": round(duration_ms, 3), **span.attrs}
+        if span.parent is None:
+            record["breakdown_ms"] = {category: round(ms, 3) for category, ms in trace.self_ms.items()}
+            record["usage"] = trace.usage
+        trace.lines.append(json.dumps(record, default=str) + "\n")
+        trace.done = trace.done or span.parent is None
+        if trace.done or len(trace.lines) >= MAX_BUFFERED_SPANS:
+            # one small blocking write per trace, it doesn't pay to hand it to a thread
+            self.writer.write(trace.lines)
+            trace.lines = []
+
+
+tracer = Tracer()
+
+
+def traced(category: str):
+    # wraps a coroutine method in a span named category.method
+    def decorate(fn):
+        name = f"{category}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return await fn(*args, **kwargs)
+            with tracer.span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
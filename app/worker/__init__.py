@@ -0,0 +1,3 @@
+from .worker import BackgroundWorker, Job
+
+__all__ = ['BackgroundWorker', 'Job']
\ No newline at end of file
@@ -0,0 +1,88 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+import anthropic
+
+from app.tracing import tracer
+
+
+@dataclass
+class Job():
+    name: str
+    fn: Callable[..., Awaitable[Any]]
+    args: tuple = ()
+    retries: int = 3
+    on_done: Optional[Callable[[Any], None]] = None
+    attempts: int = 0
+    error: Optional[BaseException] = field(default=None, repr=False)
+
+
+class BackgroundWorker():
+    def __init__(self, concurrency: int = 2, max_queue: int = 100, retry_delay: float = 1.0, drain_timeout: float = 30.0, keep_failed: int = 100):
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.drain_timeout = drain_timeout
+        self.queue: asyncio.Queue[Job] = asyncio.Queue(maxsize=max_queue)
+        self.tasks: List[asyncio.Task] = []
+        self.failed: Deque[Job] = deque(maxlen=keep_failed) # the latest ones, for debugging
+        self.failures = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.drain()
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    async def submit(self, name: str, fn: Callable[..., Awaitable[Any]], *args, retries: int = 3, on_done: Optional[Callable[[Any], None]] = None) -> Job:
+        job = Job(name=name, fn=fn, args=args, retries=retries, on_done=on_done)
+        await self.queue.put(job) # waits when the queue is full so producers can't outrun the workers
+        return job
+
+    async def drain(self):
+        # let queued jobs finish, then stop the workers. a second cancel (e.g. another SIGINT) abandons the drain
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.tasks = []
+
+    async def run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.execute(job)
+            finally:
+                self.queue.task_done()
+
+    async def execute(self, job: Job):
+        while True:
+            job.attempts += 1
+            try:
+                with tracer.span(f"job.{job.name}", attempt=job.attempts):
+                    result = await job.fn(*job.args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.error = e
+                # model errors come out of the scheduler, which already retried them or knows they won't succeed
+                if job.attempts > job.retries or isinstance(e, anthropic.APIError):
+                    self.failed.append(job)
+                    self.failures += 1
+                    return
+                await asyncio.sleep(self.retry_delay * 2 ** (job.attempts - 1))
+                continue
+
+            if job.on_done:
+                job.on_done(result)
+            return
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from app.repository import Repository
+from .data import DatasetSize, generate
+from .knowledge_graph import WORDS, percentiles
+
+
+async def measure(repository: Repository, contact_id: str, conversation_id: str, cursor, rng: random.Random, iterations: int) -> dict:
+    queries = {
+        "get_message_window": lambda: repository.get_message_window(contact_id, conversation_id),
+        "get_history_page": lambda: repository.get_history_page(contact_id, limit=20),
+        "get_history_page (old)": lambda: repository.get_history_page(contact_id, before=cursor, limit=20),
+        "search_messages": lambda: repository.search_messages(contact_id, f"remember {rng.choice(WORDS)} {rng.choice(WORDS)}"),
+    }
+    results = {}
+    for name, query in queries.items():
+        await query()
+        times = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            await query()
+            times.append(time.perf_counter() - started)
+        results[name] = percentiles(times)[0]
+    return results
+
+
+async def bench(n: int, iterations: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        async with Repository(f"sqlite+aiosqlite:///{path}") as repository:
+            contact, = await generate(repository, DatasetSize(messages=n))
+            conversation = await repository.get_conversation(contact.id)
+            rng = random.Random(0)
+            page = await repository.get_history_page(contact.id, limit=n // 2) # halfway back, in what gets archived
+            cursor = (page[-1][0].timestamp, page[-1][0].id)
+
+            await repository.compact(full=True)
+            sizes = [os.path.getsize(path)]
+            timings = [await measure(repository, contact.id, conversation.id, cursor, rng, iterations)]
+
+            started = time.perf_counter()
+            archived = await repository.archive_conversations(older_than=timedelta(0))
+            archive_time = time.perf_counter() - started
+            await repository.compact(full=True)
+            sizes.append(os.path.getsize(path))
+            timings.append(await measure(repository, contact.id, conversation.id, cursor, rng, iterations))
+
+    print(f"{n:>9} messages  archived {archived} conversations in {archive_time:.2f}s  db {sizes[0] / 2 ** 20:7.1f}MiB -> {sizes[1] / 2 ** 20:7.1f}MiB")
+    for name in timings[0]:
+        print(f"    {name:<24} p50 {timings[0][name]:7.2f}ms -> {timings[1][name]:7.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="database size and read latency before and after archiving closed conversations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+    for n in args.sizes:
+        asyncio.run(bench(n, args.iterations))
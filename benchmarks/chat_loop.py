@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from app.backend import ScriptedBackend, tool_use
+from app.controller import ChatSession
+from app.gateway import CompletionGateway, RequestScheduler, ActionType
+from app.repository import Repository
+from app.worker import BackgroundWorker
+from .knowledge_graph import WORDS, percentiles
+
+
+# one pass through every branch of the turn loop: plain replies, a follow up, a fact, and a topic change that closes the
+# conversation and queues its summary
+CHAT_SCRIPT = [
+    "that sounds like a lot of fun, tell me more about it",
+    [tool_use(ActionType.REQUIRES_FOLLOW_UP.value)],
+    "oh and one more thing i meant to ask earlier",
+    ["noted, i'll remember that", tool_use(ActionType.REMEMBER_FACT.value, {"fact": "likes long walks"})],
+    "haha yeah i know what you mean",
+    [tool_use(ActionType.TOPIC_CHANGED.value)],
+    "okay, new topic then! what's up",
+]
+
+
+def get_script():
+    chat = itertools.cycle(CHAT_SCRIPT)
+
+    def respond(request: dict):
+        # chat requests carry the chat tools, summaries don't, so background jobs can't shift the chat script
+        if request.get("tools") and not request.get("tool_choice"):
+            return next(chat)
+        return "we talked about a few things and it was nice"
+
+    return respond
+
+
+async def bench(turns: int, latency: float, chunk_delay: float):
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}") as repository, BackgroundWorker() as worker:
+            backend = ScriptedBackend(get_script(), latency=latency, chunk_delay=chunk_delay)
+            gateway = CompletionGateway(repository, backend=backend, scheduler=RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12))
+            contact = await repository.create_contact("bench")
+            session = await ChatSession.open(repository, gateway, worker, contact)
+
+            first_token_times, turn_times, messages = [], [], 0
+            for i in range(turns):
+                started = time.perf_counter()
+                first_token = None
+                async for response in session.turn(f"been thinking about {WORDS[i % len(WORDS)]} again today"):
+                    if isinstance(response, str):
+                        first_token = first_token or time.perf_counter() - started
+                    else:
+                        messages += 1
+                turn_times.append(time.perf_counter() - started)
+                first_token_times.append(first_token or turn_times[-1])
+            requests = len(backend.requests)
+        failed = worker.failures
+
+    first_p50, first_p99 = percentiles(first_token_times)
+    turn_p50, turn_p99 = percentiles(turn_times)
+    print(f"{turns:>6} turns  {messages:>6} messages  {requests:>5} requests  first token p50 {first_p50:7.2f}ms p99 {first_p99:7.2f}ms  turn p50 {turn_p50:7.2f}ms p99 {turn_p99:7.2f}ms  failed jobs {failed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time the chat turn loop, tool handling included, against a scripted model")
+    parser.add_argument("--turns", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--latency", type=float, default=0.0, help="scripted model latency, 0 times only our own overhead")
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    for turns in args.turns:
+        asyncio.run(bench(turns, args.latency, args.chunk_delay))
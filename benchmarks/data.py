@@ -0,0 +1,80 @@
+import random
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+from typing import List, Optional
+
+from sqlalchemy import insert
+
+from app.gateway import ActionType
+from app.model import Contact, Conversation, Fact, Message, MessageType, Role, estimate_message_tokens
+from app.repository import Repository
+from .knowledge_graph import WORDS
+
+
+FILLER = ["i", "think", "we", "should", "the", "was", "really", "about", "today", "maybe", "went", "with", "my", "friend", "and", "then", "it", "felt", "like", "a"]
+BATCH_SIZE = 10_000
+
+
+@dataclass
+class DatasetSize():
+    contacts: int = 1
+    conversations: int = 50 # per contact, all but the newest closed with a summary
+    messages: int = 10_000 # chat messages per contact, tool use pairs come on top
+    facts: int = 200 # per contact
+    tool_use_every: int = 20 # turns between remember_fact tool use pairs
+
+
+def get_content(rng: random.Random) -> str:
+    words = rng.choices(FILLER, k=rng.randint(8, 40))
+    for _ in range(rng.randint(1, 3)):
+        words.insert(rng.randrange(len(words)), f"{rng.choice(WORDS)}{rng.randrange(1000) if rng.random() < 0.5 else ''}")
+    return " ".join(words)
+
+
+def get_message_row(rng: random.Random, role: Role, timestamp: datetime, conversation_id: str, contact_id: str, content: Optional[str] = None, **kwargs) -> dict:
+    content = get_content(rng) if content is None else content
+    return dict(id=str(uuid.uuid4()), timestamp=timestamp, role=role, content=content, token_estimate=estimate_message_tokens(content, kwargs.get("tool_use_input")), conversation_id=conversation_id, contact_id=contact_id, **kwargs)
+
+
+async def insert_rows(repository: Repository, table, rows: List[dict]):
+    for start in range(0, len(rows), BATCH_SIZE):
+        async with repository.engine.begin() as conn:
+            await conn.execute(insert(table), rows[start:start + BATCH_SIZE])
+
+
+async def generate(repository: Repository, size: DatasetSize, seed: int = 0) -> List[Contact]:
+    # a year of history per contact, written with bulk inserts rather than the repository so big sizes build in seconds.
+    # the message search index fills from its trigger as usual
+    rng = random.Random(seed)
+    contacts = []
+    for c in range(size.contacts):
+        contact = await repository.create_contact(f"contact{c}")
+        contacts.append(contact)
+        start = datetime.now(tz=UTC) - timedelta(days=365)
+        step = timedelta(days=365) / max(size.messages, 1)
+
+        conversations = [dict(id=str(uuid.uuid4()), start_time=start + i * timedelta(days=365) / size.conversations, contact_id=contact.id) for i in range(size.conversations)]
+        for conversation, next_conversation in zip(conversations, conversations[1:]):
+            conversation.update(end_time=next_conversation["start_time"] - step, summary=f"we talked about {rng.choice(WORDS)} and {rng.choice(WORDS)}")
+        conversations[-1].update(end_time=None, summary=None)
+        await insert_rows(repository, Conversation, conversations)
+
+        messages = []
+        per_conversation = max(size.messages // size.conversations, 2)
+        for i in range(size.messages):
+            conversation_id = conversations[min(i // per_conversation, size.conversations - 1)]["id"]
+            timestamp = start + i * step
+            role = Role.USER if i % 2 == 0 else Role.ASSISTANT
+            messages.append(get_message_row(rng, role, timestamp, conversation_id, contact.id))
+            if role == Role.ASSISTANT and size.tool_use_every and (i // 2) % size.tool_use_every == 0:
+                tool_use = dict(message_type=MessageType.TOOL_USE, tool_use_id=f"toolu_{uuid.uuid4().hex[:24]}", tool_use_name=ActionType.REMEMBER_FACT.value, tool_use_input={"fact": f"likes {rng.choice(WORDS)}"})
+                messages.append(get_message_row(rng, Role.ASSISTANT, timestamp + step / 3, conversation_id, contact.id, content="", **tool_use))
+                messages.append(get_message_row(rng, Role.USER, timestamp + step * 2 / 3, conversation_id, contact.id, content="", **tool_use))
+        await insert_rows(repository, Message, messages)
+
+        facts = [dict(id=str(uuid.uuid4()), content=f"likes {rng.choice(WORDS)} {i}", timestamp=start + i * timedelta(days=365) / max(size.facts, 1), contact_id=contact.id) for i in range(size.facts)]
+        for fact in facts:
+            fact.update(mentions=1, last_seen=fact["timestamp"])
+        await insert_rows(repository, Fact, facts)
+    return contacts
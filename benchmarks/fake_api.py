@@ -0,0 +1,109 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+
+@dataclass
+class FakeApiStats():
+    requests: int = 0
+    rate_limited: int = 0
+    overloaded: int = 0
+
+
+class FakeAnthropicApi():
+    # a local stand in for POST /v1/messages that enforces its own requests per minute limit, answering 429 with retry-after
+    # when it's exceeded and 529 at random, so the real sdk and anything in front of it can be run against throttling offline.
+    # point a client at it with anthropic.AsyncAnthropic(base_url=api.url, api_key="fake")
+    def __init__(self, requests_per_minute: float = 120, burst_seconds: float = 10, latency: float = 0.2, overloaded_rate: float = 0.0, seed: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.capacity = requests_per_minute / 60 * burst_seconds
+        self.latency = latency
+        self.overloaded_rate = overloaded_rate
+        self.rng = random.Random(seed)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.stats = FakeApiStats()
+        self.server = None
+        self.url = ""
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def admit(self) -> float:
+        # 0 when the request is allowed, otherwise the seconds until it would be
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.requests_per_minute / 60)
+        self.updated = now
+        if self.level >= 1:
+            self.level -= 1
+            return 0
+        return (1 - self.level) * 60 / self.requests_per_minute
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n")
+            content_length = 0
+            while (line := (await reader.readuntil(b"\r\n")).strip()):
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    content_length = int(value)
+            request = json.loads(await reader.readexactly(content_length))
+            self.stats.requests += 1
+
+            retry_after = self.admit()
+            if retry_after:
+                self.stats.rate_limited += 1
+                await write_error(writer, 429, "rate_limit_error", retry_after)
+            elif self.rng.random() < self.overloaded_rate:
+                self.stats.overloaded += 1
+                await write_error(writer, 529, "overloaded_error")
+            elif request.get("stream"):
+                await self.write_stream(writer, request)
+            else:
+                await asyncio.sleep(self.latency)
+                await write_response(writer, 200, "application/json", json.dumps(get_message(request)).encode())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_stream(self, writer: asyncio.StreamWriter, request: dict):
+        message = get_message(request)
+        text = message["content"][0]["text"]
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        events = [("message_start", {"message": {**message, "content": [], "stop_reason": None}}), ("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})]
+        events += [("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": word + " "}}) for word in text.split()]
+        events += [("content_block_stop", {"index": 0}), ("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": len(text.split())}}), ("message_stop", {})]
+        for name, data in events:
+            await asyncio.sleep(self.latency / len(events))
+            writer.write(f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n".encode())
+            await writer.drain()
+
+
+def get_message(request: dict) -> dict:
+    input_tokens = len(json.dumps(request.get("messages", []))) // 4
+    return {
+        "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": request.get("model", "fake"),
+        "content": [{"type": "text", "text": "this is a fake response from the local api"}],
+        "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": 9},
+    }
+
+
+async def write_response(writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes, headers: str = ""):
+    writer.write(f"HTTP/1.1 {status} Fake\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n{headers}Connection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+
+async def write_error(writer: asyncio.StreamWriter, status: int, error_type: str, retry_after: float = 0):
+    body = json.dumps({"type": "error", "error": {"type": error_type, "message": error_type}}).encode()
+    await write_response(writer, status, "application/json", body, f"retry-after: {retry_after:.3f}\r\n" if retry_after else "")
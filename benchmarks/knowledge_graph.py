@@ -0,0 +1,72 @@
+import argparse
+import random
+import resource
+import statistics
+import time
+
+from app.knowledge import KnowledgeGraph
+
+
+PREDICATES = ["likes", "is working on", "visited", "knows", "owns", "is learning", "enjoys books", "enjoys films", "dislikes", "feels"]
+WORDS = ["abyss", "shell", "ghost", "python", "graph", "memory", "anime", "coffee", "tokyo", "guitar", "novel", "garden", "chess", "piano", "river", "sunset"]
+
+
+def get_entity(rng: random.Random, n_entities: int) -> str:
+    # zipf-ish, a few entities show up everywhere and most show up once or twice
+    i = int(n_entities ** rng.random()) - 1
+    return f"{WORDS[i % len(WORDS)]} {i}"
+
+
+def get_triples(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    n_entities = max(n // 3, 10)
+    start = time.time() - 365 * 86400
+    for i in range(n):
+        subject = "user" if rng.random() < 0.4 else get_entity(rng, n_entities)
+        yield subject, rng.choice(PREDICATES), get_entity(rng, n_entities), rng.randint(1, 10), start + i * 365 * 86400 / n
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples) * 1000, samples[int(len(samples) * 0.99) - 1] * 1000
+
+
+def bench(n: int, inserts: int, queries: int):
+    graph = KnowledgeGraph()
+    triples = list(get_triples(n + inserts))
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    for subject, predicate, object, importance, timestamp in triples[:n]:
+        graph.add_triple(subject, predicate, object, importance, timestamp, push=False)
+    graph.push()
+    load = time.perf_counter() - started
+    rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024
+
+    insert_times = []
+    for subject, predicate, object, importance, timestamp in triples[n:]:
+        started = time.perf_counter()
+        graph.add_triple(subject, predicate, object, importance, timestamp)
+        insert_times.append(time.perf_counter() - started)
+
+    rng = random.Random(1)
+    query_times = []
+    for _ in range(queries):
+        text = f"been thinking about {rng.choice(WORDS)} and {rng.choice(WORDS)} lately"
+        started = time.perf_counter()
+        graph.get_relevant_triples(text, 10)
+        query_times.append(time.perf_counter() - started)
+
+    insert_p50, insert_p99 = percentiles(insert_times)
+    query_p50, query_p99 = percentiles(query_times)
+    print(f"{n:>9} triples  {len(graph.names):>8} entities  load {load:7.2f}s  max rss +{rss:7.1f}MiB  insert p50 {insert_p50:7.3f}ms p99 {insert_p99:7.3f}ms  query p50 {query_p50:7.2f}ms p99 {query_p99:7.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="knowledge graph load, incremental insert and top-k query latency")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--inserts", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    for n in args.sizes:
+        bench(n, args.inserts, args.queries)
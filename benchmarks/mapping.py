@@ -0,0 +1,62 @@
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, UTC
+
+from app.gateway.context import ContextBuilder
+from app.gateway.completion import TOOLS
+from app.gateway.scheduler import get_request_tokens
+from app.model import MessageRecord, MessageType, Role, estimate_message_tokens
+from .data import get_content
+
+
+def get_record(rng: random.Random, role: Role, timestamp: datetime, **kwargs) -> MessageRecord:
+    content = get_content(rng)
+    return MessageRecord(str(uuid.uuid4()), timestamp, role, kwargs.get("message_type", MessageType.CHAT), content, kwargs.get("tool_use_id"), kwargs.get("tool_use_name"), kwargs.get("tool_use_json"), estimate_message_tokens(content, None), "conversation")
+
+
+def get_turn(rng: random.Random, timestamp: datetime, tool_use: bool) -> list:
+    # a user message, a reply, and now and then a tool use pair
+    turn = [get_record(rng, Role.USER, timestamp), get_record(rng, Role.ASSISTANT, timestamp)]
+    if tool_use:
+        pair = dict(message_type=MessageType.TOOL_USE, tool_use_id=f"toolu_{rng.getrandbits(64):x}", tool_use_name="remember_fact", tool_use_json='{"fact": "likes tea"}')
+        turn += [get_record(rng, Role.ASSISTANT, timestamp, **pair), get_record(rng, Role.USER, timestamp, **pair)]
+    return turn
+
+
+def bench(n: int, turns: int):
+    rng = random.Random(0)
+    start = datetime.now(tz=UTC)
+    history = []
+    while len(history) < n:
+        history += get_turn(rng, start + timedelta(seconds=len(history)), len(history) % 40 == 0)
+    work = [get_turn(rng, start + timedelta(seconds=n + i), i % 10 == 0) for i in range(turns)]
+
+    for mode in ["full", "incremental"]:
+        builder = ContextBuilder()
+        messages = list(history)
+        builder.build("contact", TOOLS, "", "", messages, "now") # warm, a turn after the first
+        times = []
+        for turn in work:
+            messages += turn
+            started = time.perf_counter()
+            if mode == "full":
+                # how every turn was built before: all history mapped again, then serialized to count its tokens
+                builder = ContextBuilder()
+                context = builder.build("contact", TOOLS, "", "", messages, "now")
+                get_request_tokens(context)
+            else:
+                context = builder.build("contact", TOOLS, "", "", messages, "now")
+            times.append(time.perf_counter() - started)
+        times.sort()
+        print(f"{n:>7} messages  {mode:<12} p50 {times[len(times) // 2] * 1000:8.3f}ms  {len(messages):>7} messages as {len(context['messages']):>7} api messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per turn cost of mapping history to an api request, mapped whole every turn versus incrementally")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000])
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    for n in args.sizes:
+        bench(n, args.turns)
@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from app.backend import ScriptedBackend
+from app.gateway import CompletionGateway, RequestScheduler
+from app.model import Message, Role
+from app.repository import Repository
+from .data import DatasetSize, generate, get_content
+from .knowledge_graph import percentiles
+
+
+async def bench(n: int, turns: int):
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}") as repository:
+            contact, = await generate(repository, DatasetSize(messages=n))
+            conversation = await repository.get_conversation(contact.id)
+            backend = ScriptedBackend(["ok"])
+            gateway = CompletionGateway(repository, backend=backend, scheduler=RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12))
+            rng = random.Random(0)
+            await gateway.get_chat_request(contact, conversation) # the history window is read once per session either way
+
+            results = {}
+            for mode in ["after input", "prefetched"]:
+                times = []
+                for _ in range(turns):
+                    # the last turn's rows, which leave whatever was read before them stale
+                    await repository.create_messages([Message(role=role, content=get_content(rng), conversation_id=conversation.id, contact_id=contact.id) for role in (Role.USER, Role.ASSISTANT)])
+                    if mode == "prefetched":
+                        await gateway.prefetch(contact, conversation) # while the user types
+                    pending = [Message(role=Role.USER, content=get_content(rng), conversation_id=conversation.id, contact_id=contact.id)]
+                    started = time.perf_counter()
+                    await gateway.get_chat_request(contact, conversation, pending)
+                    times.append(time.perf_counter() - started)
+                results[mode] = percentiles(times)
+
+    print(f"{n:>9} messages  " + "  ".join(f"{mode} p50 {p50:6.2f}ms p99 {p99:6.2f}ms" for mode, (p50, p99) in results.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time from the user's message to the chat request being ready, with the context read after the input versus prefetched while typing")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    for n in args.sizes:
+        asyncio.run(bench(n, args.turns))
@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sqlmodel import select
+
+from app.mapper import messages_to_anthropic_message
+from app.model import Message
+from app.repository import Repository
+from .data import DatasetSize, generate
+
+
+async def load_models(repository: Repository, contact_id: str):
+    # full Message models, how history was read before records
+    async with repository.session() as session:
+        return (await session.exec(select(Message).where(Message.contact_id == contact_id).order_by(Message.timestamp.desc()))).all()
+
+
+async def measure(load, repository: Repository, contact_id: str):
+    gc.collect()
+    started = time.perf_counter()
+    messages = list(reversed(await load(repository, contact_id)))
+    load_ms = (time.perf_counter() - started) * 1000
+
+    # retained memory is measured on a second load, the first also warms sqlalchemy's caches
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    retained = await load(repository, contact_id)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(retained)
+    del retained
+    gc.collect()
+
+    map_times = []
+    for _ in range(3): # best of three, a gc pass over a big history lands in one of them
+        started = time.perf_counter()
+        messages_to_anthropic_message(messages)
+        map_times.append((time.perf_counter() - started) * 1000)
+    map_ms = min(map_times)
+    return count, (after - before) / count, load_ms, map_ms
+
+
+async def bench(n: int):
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}") as repository:
+            contact, = await generate(repository, DatasetSize(messages=n))
+            for name, load in [("Message", load_models), ("MessageRecord", lambda r, c: r.get_messages(c))]:
+                count, per_message, load_ms, map_ms = await measure(load, repository, contact.id)
+                print(f"{count:>8} x {name:<14} {per_message:7.0f} bytes each  load {load_ms:8.1f}ms  map {map_ms:7.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="memory and load time of history read as full models versus slotted records")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+    for n in args.sizes:
+        asyncio.run(bench(n))
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, UTC
+
+from app.model import Message, Role
+from app.repository import Repository
+from .data import BATCH_SIZE, get_content, get_message_row, insert_rows
+from .knowledge_graph import WORDS, percentiles
+
+
+async def load(repository: Repository, contact_id: str, conversation_id: str, n: int, rng: random.Random):
+    # bulk insert, the fts trigger indexes each row as it goes in
+    start = datetime.now(tz=UTC) - timedelta(days=365)
+    for offset in range(0, n, BATCH_SIZE):
+        rows = [get_message_row(rng, Role.USER if i % 2 == 0 else Role.ASSISTANT, start + timedelta(seconds=i * 365 * 86400 / n), conversation_id, contact_id) for i in range(offset, min(offset + BATCH_SIZE, n))]
+        await insert_rows(repository, Message, rows)
+
+
+async def bench(n: int, inserts: int, queries: int):
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}") as repository:
+            contact = await repository.create_contact("bench")
+            conversation = await repository.create_conversation(contact.id)
+            rng = random.Random(0)
+
+            started = time.perf_counter()
+            await load(repository, contact.id, conversation.id, n, rng)
+            load_time = time.perf_counter() - started
+
+            insert_times = []
+            for _ in range(inserts):
+                message = Message(role=Role.USER, content=get_content(rng), conversation_id=conversation.id, contact_id=contact.id)
+                started = time.perf_counter()
+                await repository.create_message(message)
+                insert_times.append(time.perf_counter() - started)
+
+            query_times = []
+            for _ in range(queries):
+                text = f"do you remember what i said about {rng.choice(WORDS)} and {rng.choice(WORDS)}"
+                started = time.perf_counter()
+                await repository.search_messages(contact.id, text, 5, before=datetime.now(tz=UTC) - timedelta(days=1))
+                query_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await repository.rebuild_message_search()
+            rebuild_time = time.perf_counter() - started
+            size = os.path.getsize(os.path.join(directory, "bench.db")) / 1024 / 1024
+
+    insert_p50, insert_p99 = percentiles(insert_times)
+    query_p50, query_p99 = percentiles(query_times)
+    print(f"{n:>9} messages  load {load_time:7.2f}s  db {size:7.1f}MiB  create_message p50 {insert_p50:6.2f}ms p99 {insert_p99:6.2f}ms  search p50 {query_p50:7.2f}ms p99 {query_p99:7.2f}ms  rebuild {rebuild_time:7.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="full text message search latency, write overhead and rebuild time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--inserts", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    for n in args.sizes:
+        asyncio.run(bench(n, args.inserts, args.queries))
@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import time
+
+import anthropic
+
+from app.gateway import RequestScheduler, Priority
+from app.backend import AnthropicBackend
+from .fake_api import FakeAnthropicApi
+from .knowledge_graph import percentiles
+
+
+REQUEST = dict(model="fake", max_tokens=100, system="you are a benchmark")
+
+
+async def chat(client, scheduler, i: int) -> float:
+    # seconds until the whole streamed reply is in
+    started = time.perf_counter()
+    request = dict(REQUEST, messages=[{"role": "user", "content": f"chat message {i}"}])
+    async with (scheduler.stream(Priority.INTERACTIVE, **request) if scheduler else client.messages.stream(**request)) as stream:
+        async for _ in stream:
+            pass
+    return time.perf_counter() - started
+
+
+async def extract(client, scheduler, i: int, requests: asyncio.Semaphore):
+    request = dict(REQUEST, messages=[{"role": "user", "content": f"corpus chunk {i} " * 200}])
+    async with requests:
+        if scheduler:
+            await scheduler.create(Priority.BACKGROUND, **request)
+        else:
+            await client.messages.create(**request)
+
+
+async def run(scheduled: bool, args: argparse.Namespace):
+    async with FakeAnthropicApi(requests_per_minute=args.rpm, burst_seconds=args.burst_seconds, latency=args.latency, overloaded_rate=args.overloaded_rate) as api:
+        # unscheduled is the client as it was before the scheduler: the sdk's own two retries and nothing else
+        client = anthropic.AsyncAnthropic(base_url=api.url, api_key="fake", max_retries=0 if scheduled else 2)
+        scheduler = RequestScheduler(AnthropicBackend(client), requests_per_minute=args.rpm, tokens_per_minute=1e9, base_delay=0.25, burst_seconds=args.burst_seconds) if scheduled else None
+
+        started = time.perf_counter()
+        requests = asyncio.Semaphore(args.concurrency)
+        batch = asyncio.gather(*[extract(client, scheduler, i, requests) for i in range(args.background)], return_exceptions=True)
+
+        latencies, failures = [], 0
+        for i in range(args.chats):
+            try:
+                latencies.append(await chat(client, scheduler, i))
+            except anthropic.APIStatusError:
+                failures += 1
+            await asyncio.sleep(args.think_time)
+
+        background_failures = sum(isinstance(r, Exception) for r in await batch)
+        elapsed = time.perf_counter() - started
+
+    p50, p99 = percentiles(latencies) if latencies else (float("nan"), float("nan"))
+    print(f"{'scheduled' if scheduled else 'unscheduled':>11}  chat p50 {p50:7.0f}ms p99 {p99:7.0f}ms failed {failures:>3}/{args.chats}  background failed {background_failures:>3}/{args.background}  done in {elapsed:5.1f}s  api saw {api.stats.requests} requests, {api.stats.rate_limited} 429s, {api.stats.overloaded} 529s" + (f", {scheduler.retries} retries" if scheduler else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chat latency while background requests saturate a rate limited fake api, with and without the scheduler")
+    parser.add_argument("--rpm", type=float, default=120)
+    parser.add_argument("--burst-seconds", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--overloaded-rate", type=float, default=0.02)
+    parser.add_argument("--background", type=int, default=150)
+    parser.add_argument("--concurrency", type=int, default=8, help="background requests in flight, like the triple pipeline")
+    parser.add_argument("--chats", type=int, default=15)
+    parser.add_argument("--think-time", type=float, default=0.5)
+    args = parser.parse_args()
+    for scheduled in (False, True):
+        asyncio.run(run(scheduled, args))
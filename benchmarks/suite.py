@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import gc
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List
+
+from rich.console import Console
+
+from app.backend import ScriptedBackend
+from app.controller import ChatController
+from app.controller.chat import CHAT_THEME
+from app.gateway import CompletionGateway, RequestScheduler
+from app.gateway.context import ContextBuilder
+from app.gateway.completion import TOOLS
+from app.mapper import messages_to_anthropic_message
+from app.model import Message, MessageType, Role
+from app.prompts import get_chat_system_prompt, get_facts_prompt, get_prior_conversations_prompt
+from app.repository import Repository
+from app.worker import BackgroundWorker
+from .data import DatasetSize, generate, get_content
+from .knowledge_graph import WORDS, percentiles
+
+
+REGRESSION_TOLERANCE = 0.25 # p50 slower than the baseline by this much is a regression...
+REGRESSION_FLOOR_MS = 0.5 # ...as long as it's also slower by this much, sub-millisecond stages are mostly noise
+AFTER_MESSAGES = 50 # rows behind the newest that get_messages_after reads from
+
+
+class Stages():
+    # every stage of a chat turn, each runnable on its own against one contact of a generated database
+    def __init__(self, repository: Repository, worker: BackgroundWorker, contact, rng: random.Random):
+        self.repository = repository
+        self.worker = worker
+        self.contact = contact
+        self.rng = rng
+        self.backend = ScriptedBackend(["sounds good, tell me more"])
+        self.scheduler = RequestScheduler(self.backend, requests_per_minute=1e9, tokens_per_minute=1e12)
+        self.gateway = CompletionGateway(repository, backend=self.backend, scheduler=self.scheduler)
+        self.console = Console(file=io.StringIO(), width=100, theme=CHAT_THEME)
+
+    async def setup(self):
+        # run before every stage, so each starts from the rows the stages before it left rather than from the first setup
+        self.conversation = await self.repository.get_conversation(self.contact.id)
+        self.window = list(reversed(await self.repository.get_message_window(self.contact.id, self.conversation.id)))
+        self.facts = await self.repository.get_facts(self.contact.id)
+        self.prior_conversations = [c for c in reversed(await self.repository.get_conversations(self.contact.id)) if c.summary]
+        cursor = self.window[-min(AFTER_MESSAGES + 1, len(self.window))]
+        self.cursor = (cursor.timestamp, cursor.id)
+        self.context_builder = ContextBuilder() # kept across a stage's iterations, like the gateway's
+        self.turn_window = list(self.window)
+
+    def get_stages(self) -> Dict[str, Callable[[], Awaitable]]:
+        # stages that write go last, so what the reads see doesn't depend on which writes ran
+        return {
+            "repository.get_message_window": lambda: self.repository.get_message_window(self.contact.id, self.conversation.id),
+            "repository.get_messages_after": lambda: self.repository.get_messages_after(self.contact.id, self.cursor),
+            "repository.get_history_page": lambda: self.repository.get_history_page(self.contact.id, limit=20),
+            "repository.get_facts": lambda: self.repository.get_facts(self.contact.id),
+            "repository.get_conversations": lambda: self.repository.get_conversations(self.contact.id),
+            "repository.get_rollups": lambda: self.repository.get_rollups(self.contact.id),
+            "repository.search_messages": lambda: self.repository.search_messages(self.contact.id, f"remember {self.rng.choice(WORDS)} {self.rng.choice(WORDS)}"),
+            "mapper.messages_to_anthropic_message": self.map_messages,
+            "prompts.get_chat_system_prompt": self.get_system_prompt,
+            "context.build": self.build_context,
+            "context.build.cold": self.build_context_cold,
+            "startup.history": self.load_history,
+            "repository.create_message": self.create_message,
+            "repository.create_messages": self.create_tool_use,
+            "turn.complete": self.complete,
+        }
+
+    async def create_message(self):
+        await self.repository.create_message(Message(role=Role.USER, content=get_content(self.rng), conversation_id=self.conversation.id, contact_id=self.contact.id))
+
+    async def create_tool_use(self):
+        tool_use = dict(message_type=MessageType.TOOL_USE, tool_use_id=f"toolu_{self.rng.getrandbits(64):x}", tool_use_name="remember_fact", tool_use_input={"fact": "likes tea"}, conversation_id=self.conversation.id, contact_id=self.contact.id)
+        await self.repository.create_messages([Message(role=Role.ASSISTANT, **tool_use), Message(role=Role.USER, **tool_use)])
+
+    async def map_messages(self):
+        messages_to_anthropic_message(self.window)
+
+    async def get_system_prompt(self):
+        get_chat_system_prompt(get_facts_prompt(self.facts), get_prior_conversations_prompt(self.prior_conversations), datetime.now().strftime('%B %d, %Y at %I:%M %p PT'))
+
+    async def build_context(self):
+        # a turn's build: one new message on the history the builder has already mapped
+        self.turn_window.append(Message(role=Role.USER, content=get_content(self.rng), conversation_id=self.conversation.id, contact_id=self.contact.id))
+        self.context_builder.build(self.contact.id, TOOLS, get_facts_prompt(self.facts), get_prior_conversations_prompt(self.prior_conversations), self.turn_window, datetime.now().strftime('%B %d, %Y at %I:%M %p PT'))
+
+    async def build_context_cold(self):
+        # the first build for a contact, with the whole window to map
+        ContextBuilder().build(self.contact.id, TOOLS, get_facts_prompt(self.facts), get_prior_conversations_prompt(self.prior_conversations), self.window, datetime.now().strftime('%B %d, %Y at %I:%M %p PT'))
+
+    async def load_history(self):
+        # what opening the chat costs: the first page on screen and the gateway's first history window
+        await ChatController(self.repository, self.gateway, self.worker).print_history(self.contact, self.console, 20)
+        await CompletionGateway(self.repository, backend=self.backend, scheduler=self.scheduler).get_history(self.contact, self.conversation)
+
+    async def complete(self):
+        # a whole turn without rendering: save the user message, build the request, call the model, save the reply
+        await self.create_message()
+        await self.repository.create_messages(await self.gateway.complete(self.contact, self.conversation))
+
+
+async def measure(fn: Callable[[], Awaitable], iterations: int, warmup: int) -> dict:
+    gc.collect() # garbage from generating the data or earlier stages would otherwise be collected in whichever stage runs next
+    for _ in range(warmup):
+        await fn()
+    times = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn()
+        times.append(time.perf_counter() - started)
+    p50, p99 = percentiles(times)
+
+    # a separate traced run, tracemalloc would skew the timings
+    tracemalloc.start()
+    await fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"p50_ms": round(p50, 3), "p99_ms": round(p99, 3), "peak_kib": round(peak / 1024, 1)}
+
+
+async def bench(size: DatasetSize, iterations: int, warmup: int, only: List[str]) -> Dict[str, dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}") as repository, BackgroundWorker() as worker:
+            started = time.perf_counter()
+            contacts = await generate(repository, size)
+            print(f"\n{size.messages} messages x {size.contacts} contacts, {size.conversations} conversations and {size.facts} facts each, generated in {time.perf_counter() - started:.1f}s")
+
+            stages = Stages(repository, worker, contacts[0], random.Random(1))
+            results = {}
+            for name, fn in stages.get_stages().items():
+                if only and not any(name.startswith(o) for o in only):
+                    continue
+                await stages.setup()
+                results[name] = await measure(fn, iterations, warmup)
+                print(f"  {name:<40} p50 {results[name]['p50_ms']:9.3f}ms  p99 {results[name]['p99_ms']:9.3f}ms  peak {results[name]['peak_kib']:9.1f}KiB")
+            return results
+
+
+def compare(results: Dict[str, Dict[str, dict]], baseline: Dict[str, Dict[str, dict]]) -> List[str]:
+    regressions = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            before = baseline.get(size, {}).get(name)
+            if before and result["p50_ms"] > before["p50_ms"] * (1 + REGRESSION_TOLERANCE) and result["p50_ms"] - before["p50_ms"] > REGRESSION_FLOOR_MS:
+                regressions.append(f"{name} at {size} messages: p50 {before['p50_ms']:.3f}ms -> {result['p50_ms']:.3f}ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per stage latency and peak memory of the chat turn against generated databases")
+    parser.add_argument("--messages", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="chat messages per contact, one database per size")
+    parser.add_argument("--contacts", type=int, default=2)
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--facts", type=int, default=200)
+    parser.add_argument("--tool-use-every", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--only", nargs="*", default=[], help="stage name prefixes, e.g. repository turn")
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="json from an earlier --output, exits 1 on regressions")
+    args = parser.parse_args()
+
+    results = {}
+    for messages in args.messages:
+        size = DatasetSize(contacts=args.contacts, conversations=args.conversations, messages=messages, facts=args.facts, tool_use_every=args.tool_use_every)
+        results[str(messages)] = asyncio.run(bench(size, args.iterations, args.warmup, args.only))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        print("\n" + ("\n".join(f"regression: {r}" for r in regressions) if regressions else "no regressions against the baseline"))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from app.model import Fact, Message, MessageType, Role
+from app.repository import Repository
+from .data import get_content
+from .knowledge_graph import percentiles
+
+
+def get_turn(rng: random.Random, contact_id: str, conversation_id: str):
+    # what a turn that remembers a fact writes: the user message, the reply, the tool use pair and the fact
+    tool_use = dict(message_type=MessageType.TOOL_USE, tool_use_id=f"toolu_{rng.getrandbits(64):x}", tool_use_name="remember_fact", tool_use_input={"fact": "likes tea"}, conversation_id=conversation_id, contact_id=contact_id)
+    return (
+        Message(role=Role.USER, content=get_content(rng), conversation_id=conversation_id, contact_id=contact_id),
+        Message(role=Role.ASSISTANT, content=get_content(rng), conversation_id=conversation_id, contact_id=contact_id),
+        [Message(role=Role.ASSISTANT, **tool_use), Message(role=Role.USER, **tool_use)],
+        Fact(content="likes tea", contact_id=contact_id),
+    )
+
+
+async def write_separately(repository: Repository, turn):
+    # one commit per write, how turns used to be saved
+    message, reply, tool_use, fact = turn
+    await repository.create_message(message)
+    await repository.create_message(reply)
+    await repository.create_messages(tool_use)
+    await repository.create_fact(fact)
+
+
+async def write_unit(repository: Repository, turn):
+    message, reply, tool_use, fact = turn
+    async with repository.unit_of_work() as uow:
+        uow.add(message, reply, *tool_use, fact)
+
+
+async def bench(mode: str, contacts: int, turns: int, write_behind: float):
+    with tempfile.TemporaryDirectory() as directory:
+        async with Repository(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}", write_behind=write_behind if mode == "write_behind" else None) as repository:
+            rng = random.Random(0)
+            ids = []
+            for i in range(contacts):
+                contact = await repository.create_contact(f"contact{i}")
+                ids.append((contact.id, (await repository.create_conversation(contact.id)).id))
+            write = write_separately if mode == "separate" else write_unit
+            times = []
+
+            # built up front, constructing models costs more than writing them
+            work = [[get_turn(rng, *i) for _ in range(turns)] for i in ids]
+            if repository.group_committer:
+                repository.group_committer.batches = repository.group_committer.units = 0
+
+            async def run(contact_turns: list):
+                for turn in contact_turns:
+                    started = time.perf_counter()
+                    await write(repository, turn)
+                    times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[run(t) for t in work])
+            elapsed = time.perf_counter() - started
+            batches = f"  {repository.group_committer.units / repository.group_committer.batches:5.1f} turns per commit" if repository.group_committer else ""
+
+    p50, p99 = percentiles(times)
+    print(f"{mode:<13} {contacts:>4} contacts  {contacts * turns / elapsed:8.0f} turns/s  write p50 {p50:7.2f}ms p99 {p99:7.2f}ms{batches}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="turn write throughput with a commit per write, a unit of work per turn, and group commits across contacts")
+    parser.add_argument("--contacts", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--turns", type=int, default=50, help="per contact")
+    parser.add_argument("--write-behind", type=float, default=0.005, help="seconds a group commit waits for more turns")
+    args = parser.parse_args()
+    for contacts in args.contacts:
+        for mode in ["separate", "unit_of_work", "write_behind"]:
+            asyncio.run(bench(mode, contacts, args.turns, args.write_behind))
@@ -1,11 +1,11 @@
 import asyncio
+import argparse
 import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent)) # dirty dirty hack
 
-from app.repository import Repository
-from app.gateway.completion import CompletionGateway
+from app.pipeline.triples import main, CHUNK_TOKENS
 
 
 TEST_TRIPLES = [
@@ -26,21 +26,6 @@ TEST_TRIPLES = [
 ]
 
 
-async def fetch_triples():
-    async with Repository() as repository:
-        contact = await repository.get_contact('ravens')
-        messages = await repository.get_messages(contact.id)
-
-        completion_gateway = CompletionGateway(repository)
-        triples = await completion_gateway.extract_triples('\n'.join([f"{'assistant' if m.role == 'assistant' else 'user'}: {m.content}" for m in reversed(messages)]))
-        return triples
-
-
-async def main():
-    triples = await fetch_triples()
-    print(triples)
-
-
+# superseded by `python -m app.pipeline`, kept so the old entry point still works
 if __name__ == "__main__":
-    asyncio.run(main()) 
-    
\ No newline at end of file
+    asyncio.run(main(argparse.Namespace(contact='ravens', db="sqlite+aiosqlite:///yui.db", concurrency=4, chunk_tokens=CHUNK_TOKENS, batch_size=500, include_open=False, fake=False, fake_latency=0.0)))
@@ -1,29 +1,34 @@
 import asyncio
+import os
 import signal
-import sys
 
 from app.repository import Repository
 from app.controller import ChatController
 from app.gateway import CompletionGateway
+from app.worker import BackgroundWorker
+from app.tracing import tracer
 
 
-def handle_sigint(sig, frame):
-    print("")
-    sys.exit(0)
-
-signal.signal(signal.SIGINT, handle_sigint)
+async def main():
+    # SIGINT cancels the chat, the worker then drains queued jobs before the repository closes. a second SIGINT abandons the drain
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGINT, task.cancel)
 
+    tracer.configure(os.getenv('TRACE_FILE')) # off when unset
 
-async def main():
-    async with Repository() as repository:
-        completion_gateway = CompletionGateway(repository=repository)
-        chat_controller = ChatController(repository=repository, completion_gateway=completion_gateway)
+    async with Repository() as repository, BackgroundWorker() as worker:
+        completion_gateway = CompletionGateway(repository=repository, warm_cache=bool(os.getenv('WARM_CACHE'))) # off when unset
+        chat_controller = ChatController(repository=repository, completion_gateway=completion_gateway, worker=worker)
 
         contact = await repository.get_contact('ravens')
         if not contact:
             contact = await repository.create_contact('ravens')
 
-        await chat_controller.run_chat(contact=contact)
+        try:
+            await chat_controller.run_chat(contact=contact)
+        except asyncio.CancelledError:
+            print("")
+    tracer.close()
 
 
 if __name__ == "__main__":
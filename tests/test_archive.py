@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+
+from app.model import Conversation, Message, Role
+from app.repository import Repository
+
+
+async def get_pages(repository: Repository, contact_id: str, limit: int):
+    pages, before = [], None
+    while True:
+        page = await repository.get_history_page(contact_id, before=before, limit=limit)
+        pages.append([(m.id, m.content, summary) for m, summary in page])
+        if len(page) < limit:
+            return pages
+        before = (page[-1][0].timestamp, page[-1][0].id)
+
+
+def test_history_pages_read_across_archived_and_live_rows(tmp_path):
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{tmp_path / 'archive.db'}") as repository:
+            contact = await repository.create_contact("a")
+            now = datetime.now(tz=UTC)
+            conversations = [
+                Conversation(contact_id=contact.id, start_time=now - timedelta(days=90), end_time=now - timedelta(days=89), summary="about tea"),
+                Conversation(contact_id=contact.id, start_time=now - timedelta(days=60), end_time=now - timedelta(days=59), summary="about dogs"),
+                Conversation(contact_id=contact.id, start_time=now - timedelta(days=2), end_time=now - timedelta(days=1), summary="about work"), # too recent to archive
+                Conversation(contact_id=contact.id, start_time=now - timedelta(minutes=5)),
+            ]
+            async with repository.unit_of_work() as uow:
+                uow.add(*conversations)
+                for c in conversations:
+                    for i in range(7):
+                        uow.add(Message(role=Role.USER if i % 2 == 0 else Role.ASSISTANT, content=f"{c.summary} {i}", timestamp=c.start_time + timedelta(minutes=i), conversation_id=c.id, contact_id=contact.id))
+
+            before = await get_pages(repository, contact.id, limit=5)
+            archived = await repository.archive_conversations(contact.id)
+            after = await get_pages(repository, contact.id, limit=5)
+            return before, archived, after, len(await repository.get_messages(contact.id))
+
+    before, archived, after, live = asyncio.run(main())
+    assert archived == 2 and live == 14
+    assert after == before
+    assert len([m for page in after for m in page]) == 28
+    # newest first in pages of 5 over 14 live rows, the third page has the last 4 live ones and the first archived one
+    assert [summary for _, _, summary in after[2]] == ["about work"] * 4 + ["about dogs"]
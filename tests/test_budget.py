@@ -0,0 +1,35 @@
+from app.gateway.budget import trim_history
+from app.model import Message, MessageType, Role
+
+
+def get_message(role: Role, message_type: MessageType = MessageType.CHAT, tokens: int = 10) -> Message:
+    return Message(role=role, message_type=message_type, content="", token_estimate=tokens, conversation_id="c", contact_id="c")
+
+
+def trim(messages, budget: int, low_water: float = 1.0) -> int:
+    return trim_history(messages, sum(m.token_estimate for m in messages), budget, low_water)
+
+
+def test_trims_oldest_first_to_a_turn_start():
+    messages = [get_message(Role.USER), get_message(Role.ASSISTANT)] * 5 # 100 tokens, 5 turns
+    assert trim(messages, 100) == 0
+    assert trim(messages, 90) == 2
+    assert trim(messages, 90, low_water=0.5) == 6 # down to 45, then on to the next turn
+    # a turn start that isn't at the front is cut to even within budget
+    assert trim(messages[1:], 100) == 1
+
+
+def test_without_a_turn_start_keeps_the_newest_messages_that_fit():
+    # the window starts mid tool loop: result, use, result, use, result, reply
+    messages = [
+        get_message(Role.USER, MessageType.TOOL_USE),
+        get_message(Role.ASSISTANT, MessageType.TOOL_USE),
+        get_message(Role.USER, MessageType.TOOL_USE),
+        get_message(Role.ASSISTANT, MessageType.TOOL_USE),
+        get_message(Role.USER, MessageType.TOOL_USE),
+        get_message(Role.ASSISTANT),
+    ]
+    assert trim(messages, 100) == 1 # only the result whose use is gone
+    assert trim(messages, 30) == 3 # the newest three fit and start with a tool use
+    assert trim(messages, 20) == 5 # the newest two would start with a result whose use was cut
+    assert trim(messages, 5) == 6
@@ -0,0 +1,64 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+
+from app.backend import ScriptedBackend
+from app.gateway import CompletionGateway, RequestScheduler
+from app.knowledge import FactMemory
+from app.model import Fact
+from app.repository import Repository
+
+
+NOW = datetime(2025, 6, 1, tzinfo=UTC)
+
+
+def get_fact(content: str, days_ago: float = 0, mentions: int = 1) -> Fact:
+    return Fact(content=content, timestamp=NOW - timedelta(days=days_ago), last_seen=NOW - timedelta(days=days_ago), mentions=mentions, contact_id="c")
+
+
+def test_near_duplicate_reinforces_the_known_fact():
+    known = get_fact("has a dog named Max", days_ago=10)
+    memory = FactMemory("c", [known, get_fact("works as a nurse", days_ago=5)])
+
+    fact, reinforced = memory.remember("Has a dog named Max!", now=NOW)
+    assert reinforced and fact.id == known.id and fact.content == known.content and fact.mentions == 2 and fact.last_seen == NOW
+
+    fact, reinforced = memory.remember("is learning to play the cello", now=NOW)
+    assert not reinforced and fact.id != known.id and fact.mentions == 1
+
+
+def test_eviction_keeps_the_most_mentioned_and_recent():
+    facts = [get_fact("lives in lisbon", days_ago=400, mentions=6), get_fact("likes green tea", days_ago=300), get_fact("runs on sundays", days_ago=20), get_fact("has a sister called ana", days_ago=1)]
+    memory = FactMemory("c", facts, capacity=3)
+    assert [f.content for f in memory.get_evictions(NOW)] == ["likes green tea"]
+    assert FactMemory("c", facts, capacity=4).get_evictions(NOW) == []
+
+
+def test_consolidation_merges_related_facts_and_evicts_over_capacity(tmp_path):
+    def respond(request: dict) -> str:
+        # the merge request lists the cluster oldest first
+        assert request["messages"][0]["content"] == "- likes long walks on the beach\n- likes long walks on the beach at sunset"
+        return "- likes long walks on the beach, best at sunset"
+
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{tmp_path / 'facts.db'}") as repository:
+            backend = ScriptedBackend(respond)
+            gateway = CompletionGateway(repository, backend=backend, scheduler=RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12))
+            contact = await repository.create_contact("a")
+            facts = [
+                Fact(content="likes long walks on the beach", timestamp=NOW - timedelta(days=30), last_seen=NOW - timedelta(days=30), mentions=2, contact_id=contact.id),
+                Fact(content="likes long walks on the beach at sunset", timestamp=NOW - timedelta(days=2), last_seen=NOW - timedelta(days=2), contact_id=contact.id),
+                Fact(content="works as a nurse", timestamp=NOW - timedelta(days=800), last_seen=NOW - timedelta(days=800), contact_id=contact.id),
+                Fact(content="has a cat called pip", timestamp=NOW - timedelta(days=1), last_seen=NOW - timedelta(days=1), contact_id=contact.id),
+            ]
+            async with repository.unit_of_work() as uow:
+                uow.add(*facts)
+            gateway.fact_memories[contact.id] = FactMemory(contact.id, await repository.get_facts(contact.id), capacity=2)
+
+            saved = await gateway.consolidate_facts(contact.id)
+            return saved, await repository.get_facts(contact.id), gateway.fact_memories[contact.id]
+
+    saved, stored, memory = asyncio.run(main())
+    assert [(f.content, f.mentions) for f in saved] == [("likes long walks on the beach, best at sunset", 3)]
+    # the merged fact takes the oldest one's place, the nurse fact is long unmentioned and over capacity
+    assert [f.content for f in stored] == ["likes long walks on the beach, best at sunset", "has a cat called pip"]
+    assert [f.content for f in memory.get_facts()] == [f.content for f in stored] and not memory.unchecked
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import threading
+from typing import Dict
+
+from app.backend import ScriptedBackend
+from app.gateway import CompletionGateway, RequestScheduler
+from app.knowledge import KnowledgeGraph
+from app.knowledge.graph import ALPHA
+from app.model import Message, Role
+from app.repository import Repository
+
+
+def test_turn_goes_without_knowledge_until_the_graph_is_loaded(tmp_path, monkeypatch):
+    release = threading.Event()
+    load = KnowledgeGraph.load
+
+    def slow_load(self, entities, triples):
+        release.wait(5)
+        load(self, entities, triples)
+
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{tmp_path / 'knowledge.db'}") as repository:
+            backend = ScriptedBackend(["ok"])
+            def get_gateway():
+                return CompletionGateway(repository, backend=backend, scheduler=RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12))
+            contact = await repository.create_contact("a")
+            conversation = await repository.create_conversation(contact.id)
+            await get_gateway().add_triples(contact.id, [{"subject": "user", "predicate": "likes", "object": "green tea", "importance": 8}])
+
+            monkeypatch.setattr(KnowledgeGraph, "load", slow_load)
+            gateway = get_gateway()
+            pending = [Message(role=Role.USER, content="should I have some green tea?", conversation_id=conversation.id, contact_id=contact.id)]
+            first, _ = await asyncio.wait_for(gateway.get_chat_request(contact, conversation, pending), timeout=2) # doesn't wait on the load
+            release.set()
+            await gateway.get_knowledge_graph(contact.id)
+            second, _ = await gateway.get_chat_request(contact, conversation, pending)
+            return first, second
+
+    first, second = asyncio.run(main())
+    get_turn_context = lambda request: request["messages"][-1]["content"][-1]["text"]
+    assert "green tea" not in get_turn_context(first)
+    assert "user likes green tea" in get_turn_context(second)
+
+
+TRIPLES = [
+    ("user", "likes", "green tea", 8), ("user", "has a dog named", "max", 9), ("max", "is a", "beagle", 5),
+    ("user", "lives in", "lisbon", 7), ("lisbon", "is in", "portugal", 4), ("ana", "is the sister of", "user", 8),
+    ("ana", "lives in", "porto", 6), ("porto", "is in", "portugal", 4), ("green tea", "comes from", "japan", 3),
+    ("user", "likes", "green tea", 6), ("max", "likes", "long walks", 5), ("user", "plays", "the cello", 6),
+]
+
+
+def get_reference_rank(graph: KnowledgeGraph, seeds: Dict[str, float], iterations: int = 500) -> Dict[str, float]:
+    # dense power iteration of rank = alpha * seeds + (1 - alpha) * rank P
+    nodes = list(graph.names)
+    rank = {u: 0.0 for u in nodes}
+    for _ in range(iterations):
+        spread = {u: ALPHA * seeds.get(u, 0.0) for u in nodes}
+        for x in nodes:
+            targets = {v: w / graph.degree[x] for v, w in graph.adjacency[x].items()} if graph.adjacency.get(x) else seeds
+            for v, share in targets.items():
+                spread[v] += (1 - ALPHA) * rank[x] * share
+        rank = spread
+    return rank
+
+
+def test_pagerank_matches_power_iteration_as_triples_arrive():
+    graph = KnowledgeGraph(epsilon=1e-12)
+    for triple in random.Random(1).sample(TRIPLES, len(TRIPLES)):
+        graph.add_triple(*triple) # every edge updates the rank in place
+        reference = get_reference_rank(graph, {graph.seed: 1.0})
+        assert max(abs(graph.rank.get(u, 0.0) - r) for u, r in reference.items()) < 1e-8
+
+    # a bulk load pushes once at the end. its edges weigh a repeated triple's top importance times its mentions
+    loaded = KnowledgeGraph(epsilon=1e-12)
+    loaded.load(graph.names.items(), [(t.id, t.subject, t.predicate, t.object, t.importance, t.mentions, t.timestamp) for t in graph.triples.values()])
+    reference = get_reference_rank(loaded, {loaded.seed: 1.0})
+    assert max(abs(loaded.rank.get(u, 0.0) - r) for u, r in reference.items()) < 1e-8
+
+
+def test_turn_rank_is_close_to_power_iteration_from_the_turn_entities():
+    graph = KnowledgeGraph()
+    for triple in TRIPLES:
+        graph.add_triple(*triple)
+    rank = graph.get_turn_rank("how is max doing, and ana?")
+    names = {name: entity_id for entity_id, name in graph.names.items()}
+    reference = get_reference_rank(graph, {names["max"]: 0.5, names["ana"]: 0.5})
+    assert max(abs(rank.get(u, 0.0) - r) for u, r in reference.items()) < 0.01
@@ -0,0 +1,48 @@
+import copy
+
+from app.mapper import MessageMapper
+from app.model import Message, MessageType, Role
+
+
+def get_turn(n: int, tool: bool = False) -> list:
+    # a user message and the reply, with a tool use and its result in between when `tool`
+    messages = [Message(role=Role.USER, content=f"hi {n}", conversation_id="c", contact_id="c")]
+    if tool:
+        messages += [
+            Message(role=Role.ASSISTANT, content=f"noting {n}", conversation_id="c", contact_id="c"),
+            Message(role=Role.ASSISTANT, message_type=MessageType.TOOL_USE, tool_use_id=f"t{n}", tool_use_name="remember_fact", tool_use_input={"fact": f"fact {n}"}, conversation_id="c", contact_id="c"),
+            Message(role=Role.USER, message_type=MessageType.TOOL_USE, tool_use_id=f"t{n}", content="ok", conversation_id="c", contact_id="c"),
+        ]
+    return messages + [Message(role=Role.ASSISTANT, content=f"hello {n}", conversation_id="c", contact_id="c")]
+
+
+def test_incremental_mapping_matches_a_full_rebuild():
+    turns = [get_turn(n, tool=n % 3 == 1) for n in range(12)]
+    flat = lambda first, last: [m for turn in turns[first:last] for m in turn]
+    pending = [Message(role=Role.USER, content="not committed", conversation_id="c", contact_id="c")]
+    histories = [
+        flat(0, 1),
+        flat(0, 1) + turns[1][:2], # a reply so far
+        flat(0, 2), # appends, the tool use joins the reply's message
+        flat(0, 3),
+        flat(0, 3) + pending, # a turn's uncommitted message
+        flat(0, 4), # then what it committed instead
+        flat(0, 4)[:-1], # a reply that wasn't kept
+        flat(0, 6),
+        flat(2, 6), # trimmed from the front
+        flat(2, 7),
+        flat(5, 7), # a topic change, the new conversation's window starts elsewhere
+        flat(5, 9),
+        flat(9, 12),
+        flat(0, 12),
+    ]
+
+    mapper = MessageMapper()
+    mapped = []
+    for i, history in enumerate(histories):
+        breakpoints = {len(history) // 2} if i % 2 else {len(history) - 1, len(history) // 2} # without the last one, the result holds the message appends join
+        result = mapper.map(history, breakpoints)
+        assert result == MessageMapper().map(history, breakpoints), i
+        mapped.append((result, copy.deepcopy(result)))
+    # later calls share blocks with earlier results but never change them
+    assert all(result == snapshot for result, snapshot in mapped)
@@ -0,0 +1,53 @@
+import asyncio
+import sqlite3
+
+from app.model import estimate_message_tokens
+from app.repository import Repository
+from app.repository.migrations import MIGRATIONS
+
+
+# the tables as the first release created them, before any migration
+OLD_SCHEMA = """
+CREATE TABLE contact (id VARCHAR NOT NULL, name VARCHAR NOT NULL, PRIMARY KEY (id));
+CREATE TABLE conversation (id VARCHAR NOT NULL, start_time DATETIME NOT NULL, end_time DATETIME, summary VARCHAR, contact_id VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(contact_id) REFERENCES contact (id));
+CREATE TABLE fact (id VARCHAR NOT NULL, content VARCHAR NOT NULL, timestamp DATETIME NOT NULL, contact_id VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(contact_id) REFERENCES contact (id));
+CREATE TABLE message (id VARCHAR NOT NULL, timestamp DATETIME NOT NULL, role VARCHAR(9) NOT NULL, content VARCHAR NOT NULL, message_type VARCHAR(8) NOT NULL, tool_use_id VARCHAR, tool_use_name VARCHAR, tool_use_input JSON, conversation_id VARCHAR NOT NULL, contact_id VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(conversation_id) REFERENCES conversation (id), FOREIGN KEY(contact_id) REFERENCES contact (id));
+INSERT INTO contact VALUES ('c0ffee00-0000-0000-0000-000000000000', 'a');
+INSERT INTO conversation VALUES ('conversation', '2024-05-01 10:00:00.000000', NULL, NULL, 'c0ffee00-0000-0000-0000-000000000000');
+INSERT INTO fact VALUES ('fact', 'has a dog named max', '2024-05-01 10:01:00.000000', 'c0ffee00-0000-0000-0000-000000000000');
+INSERT INTO message VALUES ('m1', '2024-05-01 10:00:00.000000', 'USER', 'my dog max chewed the sofa', 'CHAT', NULL, NULL, 'null', 'conversation', 'c0ffee00-0000-0000-0000-000000000000');
+INSERT INTO message VALUES ('m2', '2024-05-01 10:00:05.000000', 'ASSISTANT', '', 'TOOL_USE', 't1', 'remember_fact', '{"fact": "has a dog named max"}', 'conversation', 'c0ffee00-0000-0000-0000-000000000000');
+"""
+
+
+def test_an_old_database_upgrades_to_the_latest_version(tmp_path):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(OLD_SCHEMA)
+
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{path}") as repository:
+            contact_id = "c0ffee00-0000-0000-0000-000000000000"
+            return await repository.get_messages(contact_id), await repository.get_facts(contact_id), await repository.search_messages(contact_id, "sofa")
+
+    messages, facts, found = asyncio.run(main())
+    with sqlite3.connect(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    assert version == max(v for v, _, _ in MIGRATIONS)
+    assert sorted((m.id, m.token_estimate) for m in messages) == sorted((m.id, estimate_message_tokens(m.content, m.tool_use_input)) for m in messages)
+    assert [(f.content, f.mentions, f.last_seen == f.timestamp) for f in facts] == [("has a dog named max", 1, True)]
+    assert [r.message_id for r in found] == ["m1"] # chat messages from before the index are searchable
+
+
+def test_opening_a_current_database_again_leaves_it_at_the_latest_version(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'new.db'}"
+
+    async def main():
+        for _ in range(2):
+            async with Repository(url) as repository:
+                await repository.create_contact("a")
+
+    asyncio.run(main())
+    with sqlite3.connect(tmp_path / "new.db") as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == max(v for v, _, _ in MIGRATIONS)
+        assert conn.execute("SELECT count(*) FROM contact").fetchone()[0] == 2
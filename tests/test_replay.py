@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from app.backend import ReplayBackend, ScriptedBackend, get_request_key
+from app.constants import DEFAULT_TIMEZONE
+from app.controller import ChatSession
+from app.gateway import CompletionGateway, RequestScheduler
+from app.model import Conversation, MessageType
+from app.repository import Repository
+from app.worker import BackgroundWorker
+
+
+async def run_turn(db_path: str, backend, now: datetime) -> str:
+    # a fresh database each run, with a summarized conversation that ended the day before `now`
+    async with Repository(f"sqlite+aiosqlite:///{db_path}") as repository, BackgroundWorker() as worker:
+        gateway = CompletionGateway(repository, backend=backend, scheduler=RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12), clock=lambda: now)
+        contact = await repository.create_contact("replay")
+        async with repository.unit_of_work() as uow:
+            uow.add(Conversation(contact_id=contact.id, start_time=now - timedelta(days=1, hours=1), end_time=now - timedelta(days=1), summary="talked about tea"))
+            uow.add(Conversation(contact_id=contact.id, start_time=now - timedelta(minutes=5)))
+
+        session = await ChatSession.open(repository, gateway, worker, contact)
+        return "".join([r.content async for r in session.turn("what did we talk about?") if not isinstance(r, str) and r.message_type == MessageType.CHAT and r.role.value == "assistant"])
+
+
+def test_recorded_turn_replays_in_a_later_run(tmp_path):
+    recorded = asyncio.run(run_turn(str(tmp_path / "first.db"), ReplayBackend(str(tmp_path / "replay"), ScriptedBackend(["we talked about tea"])), datetime(2025, 3, 4, 9, 30, tzinfo=DEFAULT_TIMEZONE)))
+    # replay only, a request it hasn't seen raises CacheMiss
+    replay = ReplayBackend(str(tmp_path / "replay"))
+    replayed = asyncio.run(run_turn(str(tmp_path / "second.db"), replay, datetime(2025, 7, 21, 18, 5, tzinfo=DEFAULT_TIMEZONE)))
+
+    assert recorded == replayed == "we talked about tea"
+    assert replay.hits == 1 and replay.misses == 0
+
+
+def test_request_key_keeps_what_was_said():
+    request = dict(model="m", system="s", tools=[], messages=[{"role": "user", "content": [{"type": "text", "text": "see you March 05, 2025"}]}])
+    other = dict(request, messages=[{"role": "user", "content": [{"type": "text", "text": "see you March 06, 2025"}]}])
+    assert get_request_key(request) != get_request_key(other)
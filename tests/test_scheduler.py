@@ -0,0 +1,109 @@
+import asyncio
+from typing import List, Tuple
+
+import anthropic
+import httpx
+
+from app.backend import CompletionBackend
+from app.gateway import RequestScheduler, Priority
+
+
+class HangingOpen():
+    async def __aenter__(self):
+        await asyncio.Event().wait()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class HangingBackend(CompletionBackend):
+    # streams never finish opening, creates never return
+    async def create(self, **request):
+        await asyncio.Event().wait()
+
+    def stream(self, **request):
+        return HangingOpen()
+
+
+def test_cancelling_a_stream_while_it_opens_releases_its_slot():
+    async def main():
+        scheduler = RequestScheduler(HangingBackend(), requests_per_minute=1e9, tokens_per_minute=1e12, max_concurrency=2)
+
+        async def open_stream():
+            async with scheduler.stream(Priority.INTERACTIVE, 10, messages=[]):
+                pass
+
+        tasks = [asyncio.create_task(open_stream()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        opening = scheduler.active
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return opening, scheduler.active
+
+    assert asyncio.run(main()) == (2, 0)
+
+
+class RecordingBackend(CompletionBackend):
+    # answers with the request's name and records when each call reached it. `failures` are raised first, one per call
+    def __init__(self, failures: List[Exception] = []):
+        self.failures = list(failures)
+        self.calls: List[Tuple[str, float]] = []
+
+    async def create(self, **request):
+        self.calls.append((request["name"], asyncio.get_running_loop().time()))
+        if self.failures:
+            raise self.failures.pop(0)
+        return request["name"]
+
+    def stream(self, **request):
+        raise NotImplementedError
+
+
+def test_background_requests_leave_the_reserve_to_interactive_ones():
+    async def main():
+        backend = RecordingBackend()
+        # 10 requests of burst refilling at one a second, background ones stop with 2 left
+        scheduler = RequestScheduler(backend, requests_per_minute=60, tokens_per_minute=1e12, burst_seconds=10)
+        await asyncio.gather(*[scheduler.create(Priority.BACKGROUND, 1, name=f"batch {i}") for i in range(8)])
+        background = asyncio.create_task(scheduler.create(Priority.BACKGROUND, 1, name="batch 8"))
+        interactive = await asyncio.wait_for(asyncio.gather(*[scheduler.create(Priority.INTERACTIVE, 1, name=f"chat {i}") for i in range(2)]), timeout=0.5)
+        await asyncio.sleep(0.1)
+        waiting = not background.done()
+        background.cancel()
+        return interactive, waiting
+
+    assert asyncio.run(main()) == (["chat 0", "chat 1"], True)
+
+
+def test_interactive_requests_go_first_when_a_slot_frees():
+    async def main():
+        backend = RecordingBackend()
+        scheduler = RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12, max_concurrency=1)
+        await scheduler.acquire(Priority.BACKGROUND, 1) # holds the only slot
+        tasks = [asyncio.create_task(scheduler.create(priority, 1, name=name)) for priority, name in [(Priority.BACKGROUND, "batch"), (Priority.INTERACTIVE, "chat")]]
+        await asyncio.sleep(0.01)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return [name for name, _ in backend.calls]
+
+    assert asyncio.run(main()) == ["chat", "batch"]
+
+
+def test_retry_after_pauses_every_request():
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    rate_limited = anthropic.RateLimitError("rate limited", response=httpx.Response(429, headers={"retry-after": "0.2"}, request=request), body=None)
+
+    async def main():
+        backend = RecordingBackend([rate_limited])
+        scheduler = RequestScheduler(backend, requests_per_minute=1e9, tokens_per_minute=1e12, base_delay=0.001)
+        first = asyncio.create_task(scheduler.create(Priority.INTERACTIVE, 1, name="first"))
+        await asyncio.sleep(0.05) # the first has been told to wait
+        second = await scheduler.create(Priority.INTERACTIVE, 1, name="second")
+        return [await first, second], backend.calls, scheduler.retries
+
+    responses, calls, retries = asyncio.run(main())
+    assert responses == ["first", "second"] and retries == 1
+    (_, limited), *later = calls
+    assert sorted(name for name, _ in later) == ["first", "second"]
+    assert all(at - limited >= 0.19 for _, at in later)
@@ -0,0 +1,44 @@
+import asyncio
+
+from app.model import Message, Role
+from app.repository import Repository
+
+
+def test_cancelled_group_commit_fails_its_commits(tmp_path):
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{tmp_path / 'uow.db'}", write_behind=0.001) as repository:
+            contact = await repository.create_contact("a")
+            conversation = await repository.create_conversation(contact.id)
+
+            started = asyncio.Event()
+            async def stuck(writes):
+                started.set()
+                await asyncio.Event().wait()
+            repository.write_now = stuck
+
+            commits = [asyncio.create_task(repository.create_message(Message(role=Role.USER, content=f"hi {i}", conversation_id=conversation.id, contact_id=contact.id))) for i in range(3)]
+            await started.wait()
+            repository.group_committer.task.cancel()
+            return await asyncio.wait_for(asyncio.gather(*commits, return_exceptions=True), timeout=5)
+
+    results = asyncio.run(main())
+    assert len(results) == 3 and all(isinstance(r, asyncio.CancelledError) for r in results)
+
+
+def test_failed_unit_in_group_commit_leaves_the_others(tmp_path):
+    async def main():
+        async with Repository(f"sqlite+aiosqlite:///{tmp_path / 'uow.db'}", write_behind=0.05) as repository:
+            contact = await repository.create_contact("a")
+            conversation = await repository.create_conversation(contact.id)
+            existing = await repository.create_message(Message(role=Role.USER, content="first", conversation_id=conversation.id, contact_id=contact.id))
+
+            batches = repository.group_committer.batches
+            units = [Message(role=Role.USER, content=f"hi {i}", conversation_id=conversation.id, contact_id=contact.id) for i in range(3)]
+            units[1].id = existing.id # its insert fails on the primary key, and with it the batch
+            results = await asyncio.gather(*(repository.create_message(m) for m in units), return_exceptions=True)
+            return results, repository.group_committer.batches - batches, [m.content for m in reversed(await repository.get_messages(contact.id))]
+
+    results, batches, contents = asyncio.run(main())
+    assert batches == 1 # one batch, then each unit on its own once it failed
+    assert isinstance(results[1], Exception) and not isinstance(results[0], Exception) and not isinstance(results[2], Exception)
+    assert contents == ["first", "hi 0", "hi 2"]
@@ -0,0 +1,29 @@
+import asyncio
+
+import anthropic
+import httpx
+
+from app.worker import BackgroundWorker
+
+
+def test_model_errors_are_not_retried_and_failures_are_bounded():
+    calls = {"model": 0, "db": 0}
+
+    async def model_job():
+        calls["model"] += 1
+        raise anthropic.APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+
+    async def db_job():
+        calls["db"] += 1
+        raise OSError("database is locked")
+
+    async def main():
+        async with BackgroundWorker(retry_delay=0, keep_failed=2) as worker:
+            await worker.submit("model", model_job)
+            for _ in range(3):
+                await worker.submit("db", db_job, retries=1)
+        return worker
+
+    worker = asyncio.run(main())
+    assert calls == {"model": 1, "db": 6}
+    assert worker.failures == 4 and [job.name for job in worker.failed] == ["db", "db"]